@@ -0,0 +1,44 @@
+"""index routes.acme_user_id
+
+Revision ID: 4a8e2b6c0d93
+Revises: e51c7a9d3f28
+Create Date: 2026-10-17 19:02:47.550193
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "4a8e2b6c0d93"
+down_revision = "e51c7a9d3f28"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+def upgrade_cdn():
+    op.create_index(
+        op.f("idx_routes_acme_user_id"), "routes", ["acme_user_id"], unique=False
+    )
+
+
+def downgrade_cdn():
+    op.drop_index(op.f("idx_routes_acme_user_id"), table_name="routes")
+
+
+def upgrade_domain():
+    op.create_index(
+        op.f("idx_routes_acme_user_id"), "routes", ["acme_user_id"], unique=False
+    )
+
+
+def downgrade_domain():
+    op.drop_index(op.f("idx_routes_acme_user_id"), table_name="routes")
@@ -0,0 +1,77 @@
+"""add renew_after to routes
+
+Revision ID: 7c1d2e9a4b50
+Revises: 95e3ab2a28dd
+Create Date: 2026-10-17 14:02:11.418237
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "7c1d2e9a4b50"
+down_revision = "95e3ab2a28dd"
+branch_labels = None
+depends_on = None
+
+# this is config.RENEW_BEFORE_DAYS at the time of this migration
+RENEW_BEFORE_DAYS = 30
+
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+def backfill_renew_after(route_key, certificate_route_key):
+    """
+    set renew_after from each route's newest certificate, so the first scan
+    after this migration doesn't need to fall back to looking at certificates
+    """
+    op.execute(f"""
+        UPDATE routes
+        SET renew_after = newest.expires - interval '{RENEW_BEFORE_DAYS} days'
+        FROM (
+            SELECT {certificate_route_key} AS route_key, max(expires) AS expires
+            FROM certificates
+            GROUP BY {certificate_route_key}
+        ) AS newest
+        WHERE newest.route_key = routes.{route_key}
+        """)
+
+
+def upgrade_cdn():
+    op.add_column(
+        "routes",
+        sa.Column("renew_after", postgresql.TIMESTAMP(timezone=True), nullable=True),
+    )
+    op.create_index(
+        op.f("idx_routes_renew_after"), "routes", ["renew_after"], unique=False
+    )
+    backfill_renew_after("id", "route_id")
+
+
+def downgrade_cdn():
+    op.drop_index(op.f("idx_routes_renew_after"), table_name="routes")
+    op.drop_column("routes", "renew_after")
+
+
+def upgrade_domain():
+    op.add_column(
+        "routes",
+        sa.Column("renew_after", postgresql.TIMESTAMP(timezone=True), nullable=True),
+    )
+    op.create_index(
+        op.f("idx_routes_renew_after"), "routes", ["renew_after"], unique=False
+    )
+    backfill_renew_after("guid", "route_guid")
+
+
+def downgrade_domain():
+    op.drop_index(op.f("idx_routes_renew_after"), table_name="routes")
+    op.drop_column("routes", "renew_after")
@@ -0,0 +1,59 @@
+"""add renewal info to certificates
+
+Revision ID: 9d6b1f3e7a42
+Revises: 4a8e2b6c0d93
+Create Date: 2026-10-17 20:41:12.301877
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "9d6b1f3e7a42"
+down_revision = "4a8e2b6c0d93"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+def add_renewal_info_columns():
+    for column in (
+        "renewal_window_start",
+        "renewal_window_end",
+        "renewal_info_retry_after",
+    ):
+        op.add_column(
+            "certificates",
+            sa.Column(column, postgresql.TIMESTAMP(timezone=True), nullable=True),
+        )
+
+
+def drop_renewal_info_columns():
+    op.drop_column("certificates", "renewal_info_retry_after")
+    op.drop_column("certificates", "renewal_window_end")
+    op.drop_column("certificates", "renewal_window_start")
+
+
+def upgrade_cdn():
+    add_renewal_info_columns()
+
+
+def downgrade_cdn():
+    drop_renewal_info_columns()
+
+
+def upgrade_domain():
+    add_renewal_info_columns()
+
+
+def downgrade_domain():
+    drop_renewal_info_columns()
@@ -0,0 +1,71 @@
+"""track in progress operations
+
+Revision ID: b3f0a6d2c871
+Revises: 7c1d2e9a4b50
+Create Date: 2026-10-17 16:40:52.731904
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "b3f0a6d2c871"
+down_revision = "7c1d2e9a4b50"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+def upgrade_cdn():
+    op.add_column(
+        "operations",
+        sa.Column(
+            "created_at",
+            postgresql.TIMESTAMP(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=True,
+        ),
+    )
+    op.create_index(
+        "idx_operations_route_id_state",
+        "operations",
+        ["route_id", "state"],
+        unique=False,
+    )
+
+
+def downgrade_cdn():
+    op.drop_index("idx_operations_route_id_state", table_name="operations")
+    op.drop_column("operations", "created_at")
+
+
+def upgrade_domain():
+    op.add_column(
+        "operations",
+        sa.Column(
+            "created_at",
+            postgresql.TIMESTAMP(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=True,
+        ),
+    )
+    op.create_index(
+        "idx_operations_route_guid_state",
+        "operations",
+        ["route_guid", "state"],
+        unique=False,
+    )
+
+
+def downgrade_domain():
+    op.drop_index("idx_operations_route_guid_state", table_name="operations")
+    op.drop_column("operations", "created_at")
@@ -0,0 +1,40 @@
+"""track uploaded challenges
+
+Revision ID: c5e8a1f0b6d4
+Revises: 9d6b1f3e7a42
+Create Date: 2026-10-18 10:12:47.512093
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "c5e8a1f0b6d4"
+down_revision = "9d6b1f3e7a42"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+def upgrade_cdn():
+    op.add_column("challenges", sa.Column("uploaded", sa.Boolean(), nullable=True))
+
+
+def downgrade_cdn():
+    op.drop_column("challenges", "uploaded")
+
+
+def upgrade_domain():
+    op.add_column("challenges", sa.Column("uploaded", sa.Boolean(), nullable=True))
+
+
+def downgrade_domain():
+    op.drop_column("challenges", "uploaded")
@@ -0,0 +1,51 @@
+"""add private_key_created_at to certificates
+
+Revision ID: e51c7a9d3f28
+Revises: b3f0a6d2c871
+Create Date: 2026-10-17 18:12:04.318226
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "e51c7a9d3f28"
+down_revision = "b3f0a6d2c871"
+branch_labels = None
+depends_on = None
+
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+def upgrade_cdn():
+    op.add_column(
+        "certificates",
+        sa.Column(
+            "private_key_created_at", postgresql.TIMESTAMP(timezone=True), nullable=True
+        ),
+    )
+
+
+def downgrade_cdn():
+    op.drop_column("certificates", "private_key_created_at")
+
+
+def upgrade_domain():
+    op.add_column(
+        "certificates",
+        sa.Column(
+            "private_key_created_at", postgresql.TIMESTAMP(timezone=True), nullable=True
+        ),
+    )
+
+
+def downgrade_domain():
+    op.drop_column("certificates", "private_key_created_at")
@@ -1,20 +1,165 @@
+import base64
+from collections import defaultdict
+from contextlib import contextmanager
 import datetime
+import json
+import threading
 import time
+from typing import List, Optional, Tuple
 
-from acme.client import ClientV2
+from cryptography import x509
+import josepy
+from acme.client import ClientNetwork, ClientV2
 from acme import messages
-from acme import errors
+
+from renewer.extensions import config
+
+USER_AGENT = "cloud.gov legacy domain renewer"
+
+
+def new_network(private_key_pem: str, account=None) -> ClientNetwork:
+    """
+    build a ClientNetwork for an account key. Accounts can have RSA or ECDSA
+    keys, so we detect which from the PEM and sign with RS256 or ES256 to match
+    """
+    key = josepy.JWK.load(private_key_pem.encode())
+    alg = josepy.ES256 if isinstance(key, josepy.JWKEC) else josepy.RS256
+    return ClientNetwork(key, alg=alg, user_agent=USER_AGENT, account=account)
+
+
+def renewal_info_cert_id(cert: x509.Certificate) -> Optional[str]:
+    """
+    the certificate's ARI CertID (RFC 9773): its authority key identifier and
+    its serial number's DER integer bytes, base64url-encoded without padding,
+    joined by a dot. None if the certificate has no key identifier to use
+    """
+    try:
+        aki = cert.extensions.get_extension_for_class(x509.AuthorityKeyIdentifier)
+    except x509.ExtensionNotFound:
+        return None
+    if aki.value.key_identifier is None:
+        return None
+    serial = cert.serial_number
+    # DER integers are signed, so leave room for a sign bit
+    serial_bytes = serial.to_bytes((serial.bit_length() + 8) // 8, "big", signed=True)
+    return ".".join(
+        base64.urlsafe_b64encode(part).decode().rstrip("=")
+        for part in (aki.value.key_identifier, serial_bytes)
+    )
 
 
 class AcmeClient(ClientV2):
-    def get_cert_for_finalized_order(self, orderr, deadline):
-        while datetime.datetime.now() < deadline:
-            time.sleep(1)
-            response = self._post_as_get(orderr.uri)
-            body = messages.Order.from_json(response.json())
-            if body.error is not None:
-                raise errors.IssuanceError(body.error)
-            if body.certificate is not None:
-                certificate_response = self._post_as_get(body.certificate).text
-                return orderr.update(body=body, fullchain_pem=certificate_response)
-        raise errors.TimeoutError()
+    def check_order(self, orderr) -> Tuple[messages.OrderResource, float]:
+        """
+        fetch the order's current state, once. Returns the updated order and
+        how many seconds the CA asked us to wait before checking again
+        """
+        response = self._post_as_get(orderr.uri)
+        body = messages.Order.from_json(response.json())
+        retry_at = self.retry_after(response, 0)
+        retry_after = (retry_at - datetime.datetime.now()).total_seconds()
+        return orderr.update(body=body), max(retry_after, 0)
+
+    def download_certificate(self, orderr) -> messages.OrderResource:
+        response = self._post_as_get(orderr.body.certificate)
+        return orderr.update(fullchain_pem=response.text)
+
+    def failed_authorizations(self, orderr) -> List[messages.AuthorizationResource]:
+        failed = []
+        for url in orderr.body.authorizations:
+            authzr = self._authzr_from_response(self._post_as_get(url), uri=url)
+            if authzr.body.status == messages.STATUS_INVALID:
+                failed.append(authzr)
+        return failed
+
+    def renewal_info(
+        self, leaf_pem: str
+    ) -> Tuple[Optional[messages.RenewalInfo], datetime.datetime]:
+        """
+        fetch the CA's suggested renewal window for a certificate (ACME
+        Renewal Information). Returns the renewal info, or None if the CA
+        doesn't offer it, and when we may ask again
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        default_retry = now + datetime.timedelta(
+            seconds=config.ACME_RENEWAL_INFO_RETRY_SECONDS
+        )
+        renewal_info_url = getattr(self.directory, "renewalInfo", None)
+        if renewal_info_url is None:
+            return None, default_retry
+        cert = x509.load_pem_x509_certificate(leaf_pem.encode())
+        cert_id = renewal_info_cert_id(cert)
+        if cert_id is None:
+            return None, default_retry
+        url = renewal_info_url.rstrip("/") + "/" + cert_id
+        response = self.net.get(url, content_type="application/json")
+        renewal_info = messages.RenewalInfo.from_json(response.json())
+        # retry_after works in naive local time
+        retry_at = self.retry_after(response, config.ACME_RENEWAL_INFO_RETRY_SECONDS)
+        retry_after = now + (retry_at - datetime.datetime.now())
+        return renewal_info, retry_after
+
+
+class AcmeClientPool:
+    """
+    Per-process pool of ACME clients, keyed by account.
+
+    Setting up a client means decoding the account key, opening a new HTTP
+    session, and fetching the directory. Keeping clients between tasks lets us
+    reuse their keep-alive connections and replay nonces instead. The
+    directory is shared by all clients and refetched after
+    ACME_DIRECTORY_TTL_SECONDS.
+
+    ClientNetwork isn't safe to share between threads, so each client is
+    checked out to one task at a time. A client whose task raises is thrown
+    away rather than returned, in case its connection or nonces are bad.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list)
+        self.directory = None
+        self.directory_fetched_at = 0.0
+
+    @contextmanager
+    def client_for(self, acme_user):
+        # the uri is there in case an account row is ever replaced under
+        # the same id, which would otherwise hand us a client for a stale key
+        key = (type(acme_user).__name__, acme_user.id, acme_user.uri)
+        with self.lock:
+            idle = self.idle[key]
+            client_acme = idle.pop() if idle else None
+        if client_acme is None:
+            client_acme = self.new_client(acme_user)
+        else:
+            client_acme.directory = self.get_directory(client_acme.net)
+        yield client_acme
+        with self.lock:
+            self.idle[key].append(client_acme)
+
+    def new_client(self, acme_user) -> AcmeClient:
+        net = new_network(
+            acme_user.private_key_pem, account=json.loads(acme_user.registration_json)
+        )
+        return AcmeClient(self.get_directory(net), net=net)
+
+    def get_directory(self, net) -> messages.Directory:
+        with self.lock:
+            directory = self.directory
+            age = time.monotonic() - self.directory_fetched_at
+        if directory is not None and age < config.ACME_DIRECTORY_TTL_SECONDS:
+            return directory
+        directory = messages.Directory.from_json(net.get(config.ACME_DIRECTORY).json())
+        with self.lock:
+            self.directory = directory
+            self.directory_fetched_at = time.monotonic()
+        return directory
+
+    def clear(self):
+        with self.lock:
+            self.idle.clear()
+            self.directory = None
+            self.directory_fetched_at = 0.0
+
+
+acme_clients = AcmeClientPool()
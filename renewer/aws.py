@@ -1,4 +1,5 @@
 import boto3
+from botocore.config import Config
 
 from renewer.extensions import config
 
@@ -17,5 +18,12 @@ alb = govcloud_session.client("elbv2")
 cloudfront = commercial_session.client("cloudfront")
 iam_govcloud = govcloud_session.client("iam")
 iam_commercial = commercial_session.client("iam")
-s3_govcloud = govcloud_session.client("s3")
-s3_commercial = commercial_session.client("s3")
+
+# challenge uploads share these clients across threads, so give them a
+# connection per upload thread
+s3_config = Config(
+    max_pool_connections=config.S3_MAX_CONCURRENT_UPLOADS,
+    retries={"max_attempts": config.S3_MAX_ATTEMPTS, "mode": "standard"},
+)
+s3_govcloud = govcloud_session.client("s3", config=s3_config)
+s3_commercial = commercial_session.client("s3", config=s3_config)
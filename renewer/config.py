@@ -2,7 +2,9 @@ import re
 import logging
 
 from cfenv import AppEnv
-from environs import Env
+from environs import Env, validate
+
+KEY_TYPES = ["rsa", "ecdsa"]
 
 
 def config_from_env():
@@ -31,8 +33,140 @@ class Config:
         self.cf_env_parser = AppEnv()
         self.ENV = self.env_parser("ENV")
         self.RENEW_BEFORE_DAYS = 30
-        self.ACME_POLL_TIMEOUT_IN_SECONDS = self.env_parser(
-            "ACME_POLL_TIMEOUT_IN_SECONDS", 90
+        # how many routes to load per query when scanning the broker databases
+        self.SCAN_CHUNK_SIZE = self.env_parser.int("SCAN_CHUNK_SIZE", 100)
+        # renewal pipelines are released at most this many per minute, each
+        # at a random point in its slot, and never scheduled further out than
+        # the window. Routes that don't fit are left for the next scan
+        self.RENEWAL_DISPATCH_RATE = self.env_parser.int("RENEWAL_DISPATCH_RATE", 20)
+        self.RENEWAL_DISPATCH_WINDOW = self.env_parser.int(
+            "RENEWAL_DISPATCH_WINDOW", 3 * 60 * 60
+        )
+        # stop releasing pipelines while more than this many tasks are queued or
+        # scheduled in huey, or more than this many operations are in progress on
+        # the broker being scanned
+        self.RENEWAL_MAX_PENDING_TASKS = self.env_parser.int(
+            "RENEWAL_MAX_PENDING_TASKS", 100
+        )
+        self.RENEWAL_MAX_IN_PROGRESS_OPERATIONS = self.env_parser.int(
+            "RENEWAL_MAX_IN_PROGRESS_OPERATIONS", 500
+        )
+        # how long to wait between checks while paused, and how long to stay
+        # paused before giving up until the next scan
+        self.RENEWAL_DISPATCH_PAUSE_SECONDS = self.env_parser.int(
+            "RENEWAL_DISPATCH_PAUSE_SECONDS", 30
+        )
+        self.RENEWAL_DISPATCH_MAX_PAUSE_SECONDS = self.env_parser.int(
+            "RENEWAL_DISPATCH_MAX_PAUSE_SECONDS", 30 * 60
+        )
+        # how long a route's renewal lease lasts after its pipeline last ran a
+        # task. Every task extends it, so this only needs to outlast the
+        # longest wait between two tasks: the dispatch delay before the first
+        # one, then retry and polling delays. An operation whose lease ran out
+        # is marked failed, and its route is renewed again
+        self.RENEWAL_LEASE_SECONDS = self.env_parser.int(
+            "RENEWAL_LEASE_SECONDS", 12 * 60 * 60
+        )
+        # how many pre-generated private keys to keep per route type, and how
+        # many to generate each minute while the pool is short. 0 disables it
+        self.KEY_POOL_SIZE = self.env_parser.int("KEY_POOL_SIZE", 50)
+        self.KEY_POOL_REFILL_PER_MINUTE = self.env_parser.int(
+            "KEY_POOL_REFILL_PER_MINUTE", 10
+        )
+        # the kind of private key certificates are issued with, per route type.
+        # ECDSA P-256 keys are much cheaper to generate and to handshake with
+        self.ALB_CERTIFICATE_KEY_TYPE = self.env_parser(
+            "ALB_CERTIFICATE_KEY_TYPE", "rsa", validate=validate.OneOf(KEY_TYPES)
+        )
+        self.CDN_CERTIFICATE_KEY_TYPE = self.env_parser(
+            "CDN_CERTIFICATE_KEY_TYPE", "rsa", validate=validate.OneOf(KEY_TYPES)
+        )
+        # like certbot's --reuse-key: renewals keep the route's current
+        # private key until it's CERTIFICATE_MAX_KEY_AGE_DAYS old
+        self.CERTIFICATE_REUSE_KEY = self.env_parser.bool(
+            "CERTIFICATE_REUSE_KEY", False
+        )
+        self.CERTIFICATE_MAX_KEY_AGE_DAYS = self.env_parser.int(
+            "CERTIFICATE_MAX_KEY_AGE_DAYS", 365
+        )
+        # the kind of key new ACME accounts get. Every ACME request is signed
+        # with it, and ES256 signatures are much cheaper than RS256
+        self.ACME_ACCOUNT_KEY_TYPE = self.env_parser(
+            "ACME_ACCOUNT_KEY_TYPE", "rsa", validate=validate.OneOf(KEY_TYPES)
+        )
+        # processes for CPU-bound crypto like key generation. 0 runs it inline.
+        # Each process is another interpreter with cryptography loaded, so
+        # only turn this on with the memory for it
+        self.CRYPTO_PROCESS_POOL_SIZE = self.env_parser.int(
+            "CRYPTO_PROCESS_POOL_SIZE", 0
+        )
+        # how many of a route's domains we talk to the CA about at once
+        self.ACME_MAX_CONCURRENT_DOMAINS = self.env_parser.int(
+            "ACME_MAX_CONCURRENT_DOMAINS", 8
+        )
+        # while the CA works on an order, we check it again after its
+        # Retry-After or our backoff, whichever is longer, up to the max delay
+        self.ACME_POLL_INITIAL_DELAY_SECONDS = self.env_parser.int(
+            "ACME_POLL_INITIAL_DELAY_SECONDS", 2
+        )
+        self.ACME_POLL_MAX_DELAY_SECONDS = self.env_parser.int(
+            "ACME_POLL_MAX_DELAY_SECONDS", 5 * 60
+        )
+        self.ACME_POLL_MAX_ATTEMPTS = self.env_parser.int("ACME_POLL_MAX_ATTEMPTS", 12)
+        # after swapping a listener's certificates, we check it until it's
+        # updated, backing off from IAM_PROPAGATION_TIME to the max delay
+        self.ALB_POLL_MAX_DELAY_SECONDS = self.env_parser.int(
+            "ALB_POLL_MAX_DELAY_SECONDS", 60
+        )
+        self.ALB_POLL_MAX_ATTEMPTS = self.env_parser.int("ALB_POLL_MAX_ATTEMPTS", 15)
+        # how long pooled ACME clients keep using a fetched directory
+        self.ACME_DIRECTORY_TTL_SECONDS = self.env_parser.int(
+            "ACME_DIRECTORY_TTL_SECONDS", 60 * 60
+        )
+        # challenge files are uploaded this many at a time. The S3 clients keep
+        # a connection for each, and retry each object up to S3_MAX_ATTEMPTS
+        # times before giving up on it
+        self.S3_MAX_CONCURRENT_UPLOADS = self.env_parser.int(
+            "S3_MAX_CONCURRENT_UPLOADS", 16
+        )
+        self.S3_MAX_ATTEMPTS = self.env_parser.int("S3_MAX_ATTEMPTS", 5)
+        # the sweeper deletes challenge files older than this
+        self.S3_CHALLENGE_MAX_AGE_HOURS = self.env_parser.int(
+            "S3_CHALLENGE_MAX_AGE_HOURS", 24
+        )
+        # after uploading, we check S3 for the files, starting this far apart
+        # and backing off to the max delay
+        self.S3_PROBE_INITIAL_DELAY_SECONDS = self.env_parser.float(
+            "S3_PROBE_INITIAL_DELAY_SECONDS", 0.25
+        )
+        self.S3_PROBE_MAX_DELAY_SECONDS = self.env_parser.float(
+            "S3_PROBE_MAX_DELAY_SECONDS", 2
+        )
+        # the IAM inventory is rebuilt this often, and dropped if it hasn't
+        # been rebuilt in the TTL. The interval is a crontab step, so it's
+        # most regular when it divides an hour
+        self.IAM_INVENTORY_REFRESH_MINUTES = self.env_parser.int(
+            "IAM_INVENTORY_REFRESH_MINUTES", 30, validate=validate.Range(min=1, max=60)
+        )
+        self.IAM_INVENTORY_TTL_SECONDS = self.env_parser.int(
+            "IAM_INVENTORY_TTL_SECONDS", 2 * 60 * 60
+        )
+        # the orphaned certificate collector only reports what it would delete
+        # unless dry run is turned off. It leaves certificates younger than
+        # the min age alone, in case their pipeline hasn't saved them yet, and
+        # spreads its deletes out to the given rate, up to a max per run
+        self.IAM_GC_DRY_RUN = self.env_parser.bool("IAM_GC_DRY_RUN", True)
+        self.IAM_GC_MIN_AGE_DAYS = self.env_parser.int("IAM_GC_MIN_AGE_DAYS", 7)
+        self.IAM_GC_DELETES_PER_MINUTE = self.env_parser.int(
+            "IAM_GC_DELETES_PER_MINUTE", 10, validate=validate.Range(min=1)
+        )
+        self.IAM_GC_MAX_DELETES_PER_RUN = self.env_parser.int(
+            "IAM_GC_MAX_DELETES_PER_RUN", 500
+        )
+        # how long to wait before asking the CA for a certificate's renewal
+        # info again, when it doesn't send a Retry-After
+        self.ACME_RENEWAL_INFO_RETRY_SECONDS = self.env_parser.int(
+            "ACME_RENEWAL_INFO_RETRY_SECONDS", 6 * 60 * 60
         )
         level = self.env_parser("LOG_LEVEL", None)
         if level is not None:
@@ -90,7 +224,9 @@ class AppConfig(Config):
         self.DOMAIN_DATABASE_ENCRYPTION_KEY = self.env_parser(
             "DOMAIN_DATABASE_ENCRYPTION_KEY"
         )
+        # the most we'll wait for challenge files to show up in S3
         self.S3_PROPAGATION_TIME = self.env_parser.int("S3_PROPAGATION_TIME", 10)
+        # how long to wait before checking a listener again the first time
         self.IAM_PROPAGATION_TIME = self.env_parser.int("IAM_PROPAGATION_TIME", 10)
         self.RUN_RENEWALS = self.env_parser.bool("RUN_RENEWALS", False)
         self.RUN_BACKPORTS = self.env_parser.bool("RUN_BACKPORTS", False)
@@ -138,9 +274,13 @@ class LocalConfig(Config):
         self.CDN_DATABASE_ENCRYPTION_KEY = "changeme"
         self.S3_PROPAGATION_TIME = 0
         self.IAM_PROPAGATION_TIME = 0
+        # the fake S3 checks requests in the order the tests expect them
+        self.S3_MAX_CONCURRENT_UPLOADS = 1
         self.RUN_RENEWALS = True
         self.RUN_BACKPORTS = True
         self.MAX_ROUTES_PER_USER = 3
+        self.RENEWAL_DISPATCH_PAUSE_SECONDS = 0
+        self.RENEWAL_DISPATCH_MAX_PAUSE_SECONDS = 0
 
         self.SMTP_HOST = "localhost"
         self.SMTP_PORT = 1025
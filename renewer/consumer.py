@@ -9,7 +9,7 @@ imports renewer.huey)
 import logging
 
 from renewer.huey import huey
-from renewer.tasks import migrations, renewals
+from renewer.tasks import iam_gc, keys, migrations, renewal_info, renewals
 from renewer.extensions import config
 
 logging.basicConfig(level=config.LOG_LEVEL)
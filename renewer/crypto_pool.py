@@ -0,0 +1,133 @@
+"""
+A shared process pool for CPU-bound crypto, so a burst of issuance doesn't
+starve the consumer's other worker threads of the GIL.
+
+Anything run here is pickled over to a child process, so it needs to be a
+module-level function taking and returning plain data (PEM strings and bytes,
+not key objects).
+"""
+
+import atexit
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import re
+import threading
+from typing import Optional, Set, Tuple, Union
+
+from OpenSSL import crypto
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+from renewer.extensions import config
+
+_executor: Optional[ProcessPoolExecutor] = None
+_lock = threading.Lock()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            # fork isn't safe with the consumer's threads and open connections
+            _executor = ProcessPoolExecutor(
+                max_workers=config.CRYPTO_PROCESS_POOL_SIZE,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _executor
+
+
+def _reset_executor(broken: ProcessPoolExecutor):
+    global _executor
+    with _lock:
+        if _executor is broken:
+            _executor = None
+    broken.shutdown(wait=False)
+
+
+def submit(fn, *args) -> Future:
+    """
+    Run fn(*args) in the process pool. Safe to call from any thread.
+    With CRYPTO_PROCESS_POOL_SIZE set to 0, runs it inline instead
+    """
+    if not config.CRYPTO_PROCESS_POOL_SIZE:
+        future: Future = Future()
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+    executor = _get_executor()
+    try:
+        return executor.submit(fn, *args)
+    except BrokenProcessPool:
+        # a child died, e.g. to the OOM killer. Start over with a new pool
+        _reset_executor(executor)
+        return _get_executor().submit(fn, *args)
+
+
+def run(fn, *args):
+    return submit(fn, *args).result()
+
+
+@atexit.register
+def shutdown():
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def generate_private_key_pem(key_type: str = "rsa") -> str:
+    private_key: Union[rsa.RSAPrivateKey, ec.EllipticCurvePrivateKey]
+    if key_type == "ecdsa":
+        private_key = ec.generate_private_key(ec.SECP256R1(), backend=default_backend())
+    else:
+        private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend()
+        )
+    # PKCS#8, which is what pyOpenSSL's dump_privatekey gave us before
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    ).decode("utf-8")
+
+
+def cert_from_fullchain(fullchain_pem: str) -> Tuple[str, str]:
+    """extract cert_pem from fullchain_pem
+
+    Reference https://github.com/certbot/certbot/blob/b42e24178aaa3f1ad1323acb6a3a9c63e547893f/certbot/certbot/crypto_util.py#L482-L518
+    """
+    cert_pem_regex = re.compile(
+        b"-----BEGIN CERTIFICATE-----\r?.+?\r?-----END CERTIFICATE-----\r?",
+        re.DOTALL,  # DOTALL (/s) because the base64text may include newlines
+    )
+
+    certs = cert_pem_regex.findall(fullchain_pem.encode())
+    if len(certs) < 2:
+        raise RuntimeError(
+            "failed to extract cert from fullchain: fewer than 2 certificates in chain"
+        )
+
+    certs_normalized = [
+        crypto.dump_certificate(
+            crypto.FILETYPE_PEM, crypto.load_certificate(crypto.FILETYPE_PEM, cert)
+        ).decode()
+        for cert in certs
+    ]
+
+    return certs_normalized[0], "".join(certs_normalized[1:])
+
+
+def csr_key_type_and_domains(csr_pem: str) -> Tuple[str, Set[str]]:
+    csr = x509.load_pem_x509_csr(csr_pem.encode())
+    if isinstance(csr.public_key(), ec.EllipticCurvePublicKey):
+        key_type = "ecdsa"
+    else:
+        key_type = "rsa"
+    sans = csr.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+    return key_type, set(sans.value.get_values_for_type(x509.DNSName))
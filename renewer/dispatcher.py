@@ -0,0 +1,83 @@
+import logging
+import random
+import threading
+import time
+from typing import Callable, List
+
+from renewer.extensions import config
+from renewer.json_log import json_log
+
+logger = logging.getLogger(__name__)
+
+
+class RenewalDispatcher:
+    """
+    Sits between the renewal scan and huey, so a big renewal day doesn't hit
+    Redis, the workers, and our upstream APIs all at once.
+
+    Pipelines get one slot each, RENEWAL_DISPATCH_RATE slots per minute, and
+    start at a random point within their slot. Slots stop at
+    RENEWAL_DISPATCH_WINDOW. Before each chunk, the dispatcher also waits for
+    the huey queue and schedule, and the broker's in-progress operations, to
+    drop below their limits.
+    """
+
+    def __init__(self, huey, sleep=time.sleep):
+        self.huey = huey
+        self.sleep = sleep
+        self.interval = 60 / config.RENEWAL_DISPATCH_RATE
+        self.slots = int(config.RENEWAL_DISPATCH_WINDOW / self.interval)
+        self.released = 0
+        # the broker databases are scanned in parallel, sharing one dispatcher
+        self.lock = threading.Lock()
+
+    def wait_for_capacity(
+        self, wanted: int, count_in_progress: Callable[[], int]
+    ) -> List[float]:
+        """
+        Block while huey or the broker are too busy, then claim slots for up to
+        `wanted` pipelines. `count_in_progress` counts the operations in
+        progress on the caller's broker only, so a slow database holds back
+        its own scan and not the other one. Returns the delay in seconds for
+        each claimed slot, which is empty if the window is full or we stayed
+        paused for too long.
+        """
+        paused_for = 0
+        while self.released < self.slots:
+            # renewal pipelines are queued with a delay, so most of them wait
+            # in huey's schedule rather than its queue
+            pending = self.huey.pending_count() + self.huey.scheduled_count()
+            in_progress = count_in_progress()
+            if (
+                pending < config.RENEWAL_MAX_PENDING_TASKS
+                and in_progress < config.RENEWAL_MAX_IN_PROGRESS_OPERATIONS
+            ):
+                return self.claim(wanted)
+            if paused_for >= config.RENEWAL_DISPATCH_MAX_PAUSE_SECONDS:
+                json_log(
+                    logger.warning,
+                    {
+                        "pending": pending,
+                        "in_progress": in_progress,
+                        "message": "giving up on dispatch until the next scan",
+                    },
+                )
+                return []
+            json_log(
+                logger.info,
+                {
+                    "pending": pending,
+                    "in_progress": in_progress,
+                    "message": "pausing renewal dispatch",
+                },
+            )
+            self.sleep(config.RENEWAL_DISPATCH_PAUSE_SECONDS)
+            paused_for += config.RENEWAL_DISPATCH_PAUSE_SECONDS
+        return []
+
+    def claim(self, wanted: int) -> List[float]:
+        with self.lock:
+            first = self.released
+            self.released = min(self.slots, self.released + wanted)
+            last = self.released
+        return [(slot + random.random()) * self.interval for slot in range(first, last)]
@@ -1,9 +1,12 @@
 import logging
 from huey import RedisHuey, signals
-from redis import ConnectionPool, SSLConnection
+from redis import ConnectionPool, Redis, SSLConnection
 
 from renewer.extensions import config
 from renewer import db
+from renewer.iam_inventory import IamInventory
+from renewer.key_pool import KeyPool
+from renewer.lease import RenewalLeases
 from renewer.models.common import RouteType, OperationState
 from renewer.models.cdn import CdnOperation
 from renewer.models.domain import DomainOperation
@@ -23,6 +26,10 @@ connection_pool = ConnectionPool(
     **redis_kwargs,
 )
 huey = RedisHuey(connection_pool=connection_pool)
+redis_client = Redis(connection_pool=connection_pool)
+leases = RenewalLeases(redis_client)
+key_pool = KeyPool(redis_client)
+iam_inventory = IamInventory(redis_client)
 
 # Normal task, no retries
 # when using a `nonretriable_task`, the first argument to the function will be
@@ -40,6 +47,19 @@ retriable_task = huey.context_task(
 )
 
 
+@huey.pre_execute()
+def extend_renewal_lease(task):
+    """
+    renewal pipeline tasks take the operation id and route type as their
+    first arguments. Each one extends its route's lease as it starts, so the
+    lease lasts as long as the pipeline keeps running, however long its
+    retries and polling take
+    """
+    args, kwargs = task.data
+    if len(args) >= 2 and isinstance(args[1], RouteType):
+        leases.extend(args[1], args[0])
+
+
 @huey.signal(signals.SIGNAL_ERROR)
 def mark_operation_failed(signal, task, exc=None):
     args, kwargs = task.data
@@ -62,7 +82,19 @@ def mark_operation_failed(signal, task, exc=None):
             # assume this task doesn't follow our pattern of operation_id as the first param
             # in which case this task is not a part of a provisioning/upgrade/deprovisioning pipeline
             return
-        operation.state = OperationState.FAILED.value
-        session.add(operation)
-        session.commit()
-        send_failed_operation_alert(operation)
+        if operation.state == OperationState.SUCCEEDED.value:
+            # only cleanup runs after an operation completes, and its
+            # failures don't undo the renewal
+            return
+        fail_operation(session, operation, route_type)
+
+
+def fail_operation(session, operation, route_type: RouteType):
+    operation.state = OperationState.FAILED.value
+    # we may have recorded a renew_after for a certificate we never got to
+    # deploy. Clear it, so the next scan checks the route's certificates
+    operation.route.renew_after = None
+    session.add(operation)
+    session.commit()
+    leases.release(route_type, operation.route_key, operation.id)
+    send_failed_operation_alert(operation)
@@ -0,0 +1,171 @@
+import datetime
+import json
+import logging
+import uuid
+from typing import Dict, Optional
+
+from renewer.extensions import config
+from renewer.json_log import json_log
+from renewer.models.common import RouteType
+
+logger = logging.getLogger(__name__)
+
+# the metadata fields IAM gives us as datetimes
+DATETIME_FIELDS = ("UploadDate", "Expiration")
+
+# how long one refresh may hold the refresh lock, and how long another waits
+# for it. Listing a partition takes well under this
+REFRESH_LOCK_SECONDS = 15 * 60
+
+# replay the changes made while a refresh was listing IAM onto the new
+# inventory, then swap it in, all at once so no change slips in between.
+# Removed certificates are journaled with an empty value
+SWAP_SCRIPT = """
+local changes = redis.call("hgetall", KEYS[3])
+for i = 1, #changes, 2 do
+    if changes[i + 1] == "" then
+        redis.call("hdel", KEYS[2], changes[i])
+    else
+        redis.call("hset", KEYS[2], changes[i], changes[i + 1])
+    end
+end
+redis.call("del", KEYS[3])
+if redis.call("exists", KEYS[2]) == 0 then
+    redis.call("del", KEYS[1])
+    return 0
+end
+redis.call("rename", KEYS[2], KEYS[1])
+redis.call("expire", KEYS[1], ARGV[1])
+return redis.call("hlen", KEYS[1])
+"""
+
+
+class IamInventory:
+    """
+    Our server certificates in each IAM partition, as a Redis hash of
+    certificate name to ServerCertificateMetadata.
+
+    The hash is rebuilt from one paginated list_server_certificates pass
+    under the route type's IAM prefix, and kept up to date between passes
+    as we upload and delete certificates. It expires after
+    IAM_INVENTORY_TTL_SECONDS, so if refreshes stop we go back to asking
+    IAM instead of trusting old data. A name that isn't in the inventory
+    may just be newer than it, so lookups that miss fall back to
+    get_server_certificate.
+
+    Listing IAM can take a while, so adds and removes are also journaled,
+    and a refresh replays the ones made since it started onto what it
+    listed before swapping it in. Refreshes of a partition take turns, as
+    they share the journal.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.swap_script = redis.register_script(SWAP_SCRIPT)
+
+    @staticmethod
+    def key(route_type: RouteType) -> str:
+        return f"renewer:iam-inventory:{route_type.value}"
+
+    def refresh(self, route_type: RouteType, iam, prefix: str) -> int:
+        key = self.key(route_type)
+        with self.redis.lock(
+            f"{key}:refresh-lock",
+            timeout=REFRESH_LOCK_SECONDS,
+            blocking_timeout=REFRESH_LOCK_SECONDS,
+        ):
+            return self._refresh(key, iam, prefix)
+
+    def _refresh(self, key: str, iam, prefix: str) -> int:
+        changes = f"{key}:changes"
+        # anything changed before this is already in what we're about to list
+        self.redis.delete(changes)
+        certificates = {}
+        paginator = iam.get_paginator("list_server_certificates")
+        for page in paginator.paginate(PathPrefix=prefix):
+            for metadata in page["ServerCertificateMetadataList"]:
+                name = metadata["ServerCertificateName"]
+                certificates[name] = dump_metadata(metadata)
+        # build the new hash next to the old one and swap it in, so lookups
+        # never see a half-built inventory. The building key is our own, in
+        # case a refresh outlives its lock
+        building = f"{key}:building:{uuid.uuid4().hex}"
+        if certificates:
+            self.redis.hset(building, mapping=certificates)
+            self.redis.expire(building, REFRESH_LOCK_SECONDS)
+        return self.swap_script(
+            keys=[key, building, changes], args=[config.IAM_INVENTORY_TTL_SECONDS]
+        )
+
+    def get(self, route_type: RouteType, name: str) -> Optional[dict]:
+        metadata = self.redis.hget(self.key(route_type), name)
+        if metadata is None:
+            return None
+        return load_metadata(metadata)
+
+    def all(self, route_type: RouteType) -> Dict[str, dict]:
+        return {
+            name.decode("utf-8"): load_metadata(metadata)
+            for name, metadata in self.redis.hgetall(self.key(route_type)).items()
+        }
+
+    def get_by_arn(self, route_type: RouteType, arn: str) -> Optional[dict]:
+        metadata = self.get(route_type, arn.split("/")[-1])
+        if metadata is None or metadata["Arn"] != arn:
+            return None
+        return metadata
+
+    def add(self, route_type: RouteType, metadata: dict):
+        key = self.key(route_type)
+        name = metadata["ServerCertificateName"]
+        self.journal(route_type, name, dump_metadata(metadata))
+        # only touch an inventory that exists, so we don't start a partial one
+        # that looks complete
+        if self.redis.exists(key):
+            self.redis.hset(key, name, dump_metadata(metadata))
+
+    def remove(self, route_type: RouteType, name: str):
+        self.journal(route_type, name, "")
+        self.redis.hdel(self.key(route_type), name)
+
+    def journal(self, route_type: RouteType, name: str, metadata: str):
+        """remember a change for a refresh that may be listing IAM right now"""
+        changes = f"{self.key(route_type)}:changes"
+        pipeline = self.redis.pipeline()
+        pipeline.hset(changes, name, metadata)
+        pipeline.expire(changes, config.IAM_INVENTORY_TTL_SECONDS)
+        pipeline.execute()
+
+    def server_certificate_metadata(self, route_type: RouteType, iam, name: str):
+        """look up a certificate's metadata, asking IAM only if we have to"""
+        metadata = self.get(route_type, name)
+        if metadata is not None:
+            return metadata
+        json_log(
+            logger.info,
+            {
+                "type": route_type,
+                "name": name,
+                "message": "certificate not in IAM inventory, asking IAM",
+            },
+        )
+        response = iam.get_server_certificate(ServerCertificateName=name)
+        metadata = response["ServerCertificate"]["ServerCertificateMetadata"]
+        self.add(route_type, metadata)
+        return metadata
+
+
+def dump_metadata(metadata: dict) -> str:
+    metadata = dict(metadata)
+    for field in DATETIME_FIELDS:
+        if isinstance(metadata.get(field), datetime.datetime):
+            metadata[field] = metadata[field].isoformat()
+    return json.dumps(metadata)
+
+
+def load_metadata(metadata) -> dict:
+    metadata = json.loads(metadata)
+    for field in DATETIME_FIELDS:
+        if metadata.get(field) is not None:
+            metadata[field] = datetime.datetime.fromisoformat(metadata[field])
+    return metadata
@@ -0,0 +1,101 @@
+import logging
+from typing import Dict
+
+import sqlalchemy as sa
+
+from renewer import crypto_pool
+from renewer.extensions import config
+from renewer.json_log import json_log
+from renewer.models.common import RouteType
+from renewer.models.cdn import CdnCertificate
+from renewer.models.domain import DomainCertificate
+
+logger = logging.getLogger(__name__)
+
+
+def certificate_key_type(route_type: RouteType) -> str:
+    if route_type is RouteType.ALB:
+        return config.ALB_CERTIFICATE_KEY_TYPE
+    return config.CDN_CERTIFICATE_KEY_TYPE
+
+
+class KeyPool:
+    """
+    A bounded pool of pre-generated private keys in Redis, one list per route
+    type, so pipelines don't have to generate keys inline.
+
+    Keys are encrypted at rest the same way, and with the same key, as the
+    private_key_pem column of that route type's certificates. When the pool is
+    empty, take() falls back to generating a key inline.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.column_types: Dict[RouteType, sa.types.TypeEngine] = {
+            RouteType.ALB: sa.inspect(DomainCertificate).columns.private_key_pem.type,
+            RouteType.CDN: sa.inspect(CdnCertificate).columns.private_key_pem.type,
+        }
+
+    @staticmethod
+    def key(route_type: RouteType, key_type: str) -> str:
+        return f"renewer:key-pool:{route_type.value}:{key_type}"
+
+    @staticmethod
+    def stats_key(route_type: RouteType, key_type: str) -> str:
+        return f"renewer:key-pool-stats:{route_type.value}:{key_type}"
+
+    def size(self, route_type: RouteType, key_type: str) -> int:
+        return self.redis.llen(self.key(route_type, key_type))
+
+    def take(self, route_type: RouteType, key_type: str) -> str:
+        encrypted = self.redis.lpop(self.key(route_type, key_type))
+        stats_key = self.stats_key(route_type, key_type)
+        if encrypted is None:
+            self.redis.hincrby(stats_key, "missed", 1)
+            return crypto_pool.run(crypto_pool.generate_private_key_pem, key_type)
+        self.redis.hincrby(stats_key, "taken", 1)
+        column_type = self.column_types[route_type]
+        return column_type.process_result_value(encrypted.decode("utf-8"), None)
+
+    def refill(self, route_type: RouteType, key_type: str, limit: int) -> int:
+        """
+        generate up to `limit` keys, stopping once the pool holds
+        KEY_POOL_SIZE keys. Returns how many keys were added
+        """
+        wanted = min(limit, config.KEY_POOL_SIZE - self.size(route_type, key_type))
+        if wanted <= 0:
+            return 0
+        column_type = self.column_types[route_type]
+        futures = [
+            crypto_pool.submit(crypto_pool.generate_private_key_pem, key_type)
+            for _ in range(wanted)
+        ]
+        encrypted = [
+            column_type.process_bind_param(future.result(), None) for future in futures
+        ]
+        pipeline = self.redis.pipeline()
+        pipeline.rpush(self.key(route_type, key_type), *encrypted)
+        # another producer may have refilled the pool while we were busy
+        pipeline.ltrim(self.key(route_type, key_type), 0, config.KEY_POOL_SIZE - 1)
+        pipeline.execute()
+        return wanted
+
+    def report(self, route_type: RouteType, key_type: str, generated: int):
+        """log the pool's size and what happened to it since the last report"""
+        pipeline = self.redis.pipeline()
+        pipeline.hgetall(self.stats_key(route_type, key_type))
+        pipeline.delete(self.stats_key(route_type, key_type))
+        stats, _ = pipeline.execute()
+        json_log(
+            logger.info,
+            {
+                "type": route_type,
+                "key_type": key_type,
+                "size": self.size(route_type, key_type),
+                "generated": generated,
+                "refill_rate": config.KEY_POOL_REFILL_PER_MINUTE,
+                "taken": int(stats.get(b"taken", 0)),
+                "missed": int(stats.get(b"missed", 0)),
+                "message": "key pool metrics",
+            },
+        )
@@ -0,0 +1,108 @@
+import logging
+
+from renewer.extensions import config
+from renewer.json_log import json_log
+
+logger = logging.getLogger(__name__)
+
+# delete the key only if it still holds our value, so a pipeline finishing
+# late can't drop a lease that has since been given to another pipeline
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# push back a lease's expiry, only if it's still held by the operation
+EXTEND_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    redis.call("expire", KEYS[1], ARGV[2])
+    redis.call("expire", KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+UNASSIGNED = "pending"
+
+
+class RenewalLeases:
+    """
+    Per-route locks in Redis, held for the life of a renewal pipeline, so a
+    route never has two renewals running at once.
+
+    A lease is claimed before the route's operation is created, then handed to
+    the operation, and released when the operation succeeds or fails. Every
+    task of the pipeline extends the lease when it starts, so it only expires
+    RENEWAL_LEASE_SECONDS after the pipeline stops running, in case it dies
+    without releasing it.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.release_script = redis.register_script(RELEASE_SCRIPT)
+        self.extend_script = redis.register_script(EXTEND_SCRIPT)
+
+    @staticmethod
+    def key(route_type, route_id) -> str:
+        return f"renewer:renewal-lease:{route_type.value}:{route_id}"
+
+    @staticmethod
+    def operation_key(route_type, operation_id) -> str:
+        """points from an operation to the lease it holds"""
+        return f"renewer:renewal-lease-operation:{route_type.value}:{operation_id}"
+
+    def claim(self, route_type, route_id) -> bool:
+        claimed = self.redis.set(
+            self.key(route_type, route_id),
+            UNASSIGNED,
+            nx=True,
+            ex=config.RENEWAL_LEASE_SECONDS,
+        )
+        if not claimed:
+            json_log(
+                logger.info,
+                {
+                    "route_id": route_id,
+                    "type": route_type,
+                    "message": "renewal already in progress, skipping",
+                },
+            )
+        return bool(claimed)
+
+    def assign(self, route_type, route_id, operation_id):
+        key = self.key(route_type, route_id)
+        pipeline = self.redis.pipeline()
+        pipeline.set(key, str(operation_id), xx=True, keepttl=True)
+        pipeline.set(
+            self.operation_key(route_type, operation_id),
+            key,
+            ex=config.RENEWAL_LEASE_SECONDS,
+        )
+        pipeline.execute()
+
+    def extend(self, route_type, operation_id):
+        """keep an operation's lease for another RENEWAL_LEASE_SECONDS"""
+        operation_key = self.operation_key(route_type, operation_id)
+        key = self.redis.get(operation_key)
+        if key is None:
+            return
+        self.extend_script(
+            keys=[key.decode(), operation_key],
+            args=[str(operation_id), config.RENEWAL_LEASE_SECONDS],
+        )
+
+    def held_by(self, route_type, route_id, operation_id) -> bool:
+        held = self.redis.get(self.key(route_type, route_id))
+        return held is not None and held.decode() == str(operation_id)
+
+    def release(self, route_type, route_id, operation_id):
+        self.release_script(
+            keys=[self.key(route_type, route_id)], args=[str(operation_id)]
+        )
+        self.redis.delete(self.operation_key(route_type, operation_id))
+
+    def release_unassigned(self, route_type, route_id):
+        """give up a lease we claimed but never handed to an operation"""
+        self.release_script(keys=[self.key(route_type, route_id)], args=[UNASSIGNED])
@@ -93,7 +93,10 @@ class CdnRoute(CdnModel, RouteModel):
     operations: List["CdnOperation"] = orm.relationship(
         "CdnOperation", backref="route", lazy="dynamic"
     )
-    acme_user_id = sa.Column(sa.Integer, sa.ForeignKey("acme_user_v2.id"))
+    acme_user_id = sa.Column(sa.Integer, sa.ForeignKey("acme_user_v2.id"), index=True)
+    # renew_after is when the current certificate becomes due for renewal.
+    # It's maintained by the renewer, so scans don't need to look at certificates
+    renew_after = sa.Column(postgresql.TIMESTAMP(timezone=True), index=True)
     route_type = RouteType.CDN
 
     def domain_external_list(self):
@@ -123,7 +126,15 @@ class CdnCertificate(CdnModel, CertificateModel):
     private_key_pem: str = sa.Column(
         StringEncryptedType(sa.Text, db_encryption_key, AesGcmEngine, "pkcs5")
     )
+    # when private_key_pem was generated. Renewals that reuse the key carry
+    # this over, so we know when it's time for a new one
+    private_key_created_at = sa.Column(postgresql.TIMESTAMP(timezone=True))
     csr_pem = sa.Column(sa.Text)
+    # the renewal window the CA suggested for this certificate through ACME
+    # Renewal Information (ARI), and when we may ask it again
+    renewal_window_start = sa.Column(postgresql.TIMESTAMP(timezone=True))
+    renewal_window_end = sa.Column(postgresql.TIMESTAMP(timezone=True))
+    renewal_info_retry_after = sa.Column(postgresql.TIMESTAMP(timezone=True))
     challenges: List["CdnChallenge"] = orm.relationship(
         "CdnChallenge", backref="certificate", lazy="dynamic"
     )
@@ -137,6 +148,7 @@ class CdnCertificate(CdnModel, CertificateModel):
 
 class CdnOperation(CdnModel, OperationModel):
     __tablename__ = "operations"
+    __table_args__ = (sa.Index("idx_operations_route_id_state", "route_id", "state"),)
 
     id = sa.Column(sa.Integer, sa.Sequence("operations_id_seq"), primary_key=True)
     route_id: int = sa.Column(sa.ForeignKey(CdnRoute.id), nullable=False)
@@ -158,6 +170,9 @@ class CdnOperation(CdnModel, OperationModel):
         server_default=Action.RENEW.value,
         nullable=False,
     )
+    created_at = sa.Column(
+        postgresql.TIMESTAMP(timezone=True), server_default=sa.func.now()
+    )
 
 
 class CdnAcmeUserV2(CdnModel, AcmeUserV2Model):
@@ -189,4 +204,5 @@ class CdnChallenge(CdnModel, ChallengeModel):
     validation_contents = sa.Column(sa.Text, nullable=False)
     body_json = sa.Column(sa.Text)
     answered = sa.Column(sa.Boolean, default=False)
+    uploaded = sa.Column(sa.Boolean, default=False)
     certificate: CdnCertificate
@@ -1,7 +1,11 @@
 import datetime
 from enum import Enum
+import random
 from typing import Union, Type, List
 
+import sqlalchemy as sa
+from sqlalchemy import orm
+
 from renewer.extensions import config
 
 
@@ -16,6 +20,25 @@ class OperationState(Enum):
     FAILED = "failed"
 
 
+def keyset_chunks(query, key, chunk_size: int):
+    """
+    Yield the values of `key` from a single-column query in lists of at most
+    chunk_size. Each chunk is its own query, paging on the key rather than
+    holding a cursor or using OFFSET, so nothing is kept between chunks
+    """
+    last = None
+    while True:
+        chunk_query = query
+        if last is not None:
+            chunk_query = chunk_query.filter(key > last)
+        chunk = [value for (value,) in chunk_query.order_by(key).limit(chunk_size)]
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1]
+
+
 class RouteModel:
     @property
     def needs_renewal(self):
@@ -27,29 +50,352 @@ class RouteModel:
         routes = query.all()
         return routes
 
+    @classmethod
+    def certificate_join(cls):
+        """
+        returns the certificate model, and the route and certificate columns the
+        certificates relationship joins on. CdnRoute and DomainRoute key their
+        certificates differently, so we read this off the mapper
+        """
+        relationship = sa.inspect(cls).relationships["certificates"]
+        ((route_key, certificate_key),) = relationship.local_remote_pairs
+        return relationship.mapper.class_, route_key, certificate_key
+
+    def update_renew_after(self, certificate):
+        """move renew_after up to match a certificate newer than the one we know of"""
+        renew_after = certificate.renew_after
+        if self.renew_after is None or renew_after > self.renew_after:
+            self.renew_after = renew_after
+
+    def follow_renewal_info(self, certificate):
+        """
+        set renew_after from a certificate's renewal window. Unlike
+        update_renew_after this can move it earlier, when the CA asks us to
+        renew sooner than planned
+        """
+        self.renew_after = certificate.renew_after
+
+    def find_reusable_key(self, session):
+        """
+        find this route's newest issued certificate with a private key younger
+        than CERTIFICATE_MAX_KEY_AGE_DAYS. Returns its (id, csr_pem,
+        private_key_created_at), or None. We only load those columns, so the
+        key itself is never decrypted
+        """
+        Certificate, _, certificate_key = self.certificate_join()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cutoff = now - datetime.timedelta(days=config.CERTIFICATE_MAX_KEY_AGE_DAYS)
+        return (
+            session.query(
+                Certificate.id, Certificate.csr_pem, Certificate.private_key_created_at
+            )
+            .filter(certificate_key == sa.inspect(self).identity[0])
+            .filter(Certificate.leaf_pem.isnot(None))
+            .filter(Certificate.csr_pem.isnot(None))
+            .filter(Certificate.private_key_created_at >= cutoff)
+            .order_by(Certificate.expires.desc())
+            .first()
+        )
+
+    @classmethod
+    def renewal_candidates_query(cls, session):
+        """
+        query for the keys of active routes that need renewal.
+        This is a range query on renew_after. Routes where we don't know
+        renew_after fall back to the SQL version of needs_renewal: a route needs
+        renewal unless it has a certificate that expires after the threshold
+        """
+        Certificate, route_key, certificate_key = cls.certificate_join()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        threshold = now + datetime.timedelta(days=config.RENEW_BEFORE_DAYS)
+        current_certificate = (
+            sa.exists()
+            .where(certificate_key == route_key)
+            .where(Certificate.expires >= threshold)
+        )
+        return (
+            session.query(route_key)
+            .filter(cls.state == "provisioned")
+            .filter(
+                sa.or_(
+                    cls.renew_after <= now,
+                    sa.and_(cls.renew_after.is_(None), ~current_certificate),
+                )
+            )
+            .filter(~cls.renewal_in_progress_clause())
+        )
+
+    @classmethod
+    def renewal_in_progress_clause(cls):
+        """
+        EXISTS clause for a route having an operation still in progress.
+        Operations whose pipeline died are marked failed by
+        fail_abandoned_operations, not ignored here, as a pipeline can run
+        for days
+        """
+        relationship = sa.inspect(cls).relationships["operations"]
+        ((route_key, operation_route_key),) = relationship.local_remote_pairs
+        Operation = relationship.mapper.class_
+        return (
+            sa.exists()
+            .where(operation_route_key == route_key)
+            .where(Operation.state == OperationState.IN_PROGRESS.value)
+        )
+
+    @classmethod
+    def has_renewal_candidates(cls, session) -> bool:
+        query = cls.renewal_candidates_query(session)
+        return session.query(query.exists()).scalar()
+
+    @classmethod
+    def iter_renewal_candidate_ids(cls, session, chunk_size: int):
+        _, route_key, _ = cls.certificate_join()
+        query = cls.renewal_candidates_query(session)
+        return keyset_chunks(query, route_key, chunk_size)
+
+    @classmethod
+    def renewal_info_due_query(cls, session):
+        """
+        query for the ids of the certificates we should ask the CA for renewal
+        info about: the newest issued, unexpired certificate of each active
+        route, once the CA's last Retry-After has passed
+        """
+        Certificate, route_key, certificate_key = cls.certificate_join()
+        Newer = orm.aliased(Certificate)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        newer_certificate = (
+            sa.exists()
+            .where(getattr(Newer, certificate_key.key) == certificate_key)
+            .where(Newer.expires > Certificate.expires)
+        )
+        return (
+            session.query(Certificate.id)
+            .join(cls, certificate_key == route_key)
+            .filter(cls.state == "provisioned")
+            .filter(Certificate.leaf_pem.isnot(None))
+            .filter(Certificate.expires > now)
+            .filter(
+                sa.or_(
+                    Certificate.renewal_info_retry_after.is_(None),
+                    Certificate.renewal_info_retry_after <= now,
+                )
+            )
+            .filter(~newer_certificate)
+        )
+
+    @classmethod
+    def iter_renewal_info_due_ids(cls, session, chunk_size: int):
+        Certificate, _, _ = cls.certificate_join()
+        query = cls.renewal_info_due_query(session)
+        return keyset_chunks(query, Certificate.id, chunk_size)
+
+    @classmethod
+    def in_use_certificates_query(cls, session):
+        """
+        query for the certificates we still need in IAM: the newest
+        certificate of each route that isn't deprovisioned, and any
+        certificate a renewal in progress is working on. Older certificates
+        that are still being served are found by asking AWS, not the database
+        """
+        Certificate, route_key, certificate_key = cls.certificate_join()
+        Newer = orm.aliased(Certificate)
+        relationship = sa.inspect(cls).relationships["operations"]
+        Operation = relationship.mapper.class_
+        live_route = (
+            sa.exists()
+            .where(route_key == certificate_key)
+            .where(cls.state != "deprovisioned")
+        )
+        newer_certificate = (
+            sa.exists()
+            .where(getattr(Newer, certificate_key.key) == certificate_key)
+            .where(Newer.expires > Certificate.expires)
+        )
+        in_flight = (
+            sa.exists()
+            .where(Operation.certificate_id == Certificate.id)
+            .where(Operation.state == OperationState.IN_PROGRESS.value)
+        )
+        return session.query(Certificate).filter(
+            sa.or_(sa.and_(live_route, ~newer_certificate), in_flight)
+        )
+
+    @classmethod
+    def certificate_in_use(cls, session, identifiers) -> bool:
+        """
+        whether a certificate in in_use_certificates_query has any of the
+        given IAM names, ARNs or ids
+        """
+        Certificate, _, _ = cls.certificate_join()
+        identifiers = list(identifiers)
+        query = cls.in_use_certificates_query(session).filter(
+            sa.or_(
+                Certificate.iam_server_certificate_name.in_(identifiers),
+                Certificate.iam_server_certificate_arn.in_(identifiers),
+                Certificate.iam_server_certificate_id.in_(identifiers),
+            )
+        )
+        return session.query(query.exists()).scalar()
+
+    @classmethod
+    def create_renewal_operations(cls, session, ids) -> List:
+        """
+        create a renewal operation for each of the routes in ids with a single
+        INSERT ... RETURNING, and commit them.
+        Returns (route id, operation id) pairs
+        """
+        if not ids:
+            return []
+        relationship = sa.inspect(cls).relationships["operations"]
+        ((_, operation_route_key),) = relationship.local_remote_pairs
+        Operation = relationship.mapper.class_
+        statement = (
+            sa.insert(Operation)
+            .values([{operation_route_key.key: id_} for id_ in ids])
+            .returning(operation_route_key, Operation.id)
+        )
+        rows = session.execute(statement).all()
+        session.commit()
+        return rows
+
 
 class CertificateModel:
+    # the columns copy_private_key_from uses, which each subclass defines
+    id: sa.Column
+    private_key_pem: sa.Column
+
     @property
     def needs_renewal(self):
         now = datetime.datetime.now(datetime.timezone.utc)
         return self.expires < now + datetime.timedelta(days=config.RENEW_BEFORE_DAYS)
 
+    @property
+    def renew_after(self):
+        """
+        when to renew this certificate. If the CA suggested a renewal window we
+        pick a point in it, otherwise we fall back to RENEW_BEFORE_DAYS before
+        expiry. The point is random, so certificates issued together don't
+        renew together, but seeded by the certificate so it's stable between
+        scans
+        """
+        if self.renewal_window_start is None or self.renewal_window_end is None:
+            return self.expires - datetime.timedelta(days=config.RENEW_BEFORE_DAYS)
+        window = self.renewal_window_end - self.renewal_window_start
+        return self.renewal_window_start + window * random.Random(self.id).random()
+
+    def record_renewal_info(self, renewal_info, retry_after):
+        """store the window from an ARI response, and when we may ask again"""
+        if renewal_info is not None:
+            window = renewal_info.suggested_window
+            self.renewal_window_start = window.start
+            self.renewal_window_end = window.end
+        self.renewal_info_retry_after = retry_after
+
+    def copy_private_key_from(self, session, certificate_id: int):
+        """
+        copy another certificate's private key with a single UPDATE, moving
+        the ciphertext as it is instead of decrypting and re-encrypting it
+        """
+        cls = type(self)
+        session.flush()
+        private_key_pem = (
+            sa.select(cls.private_key_pem)
+            .where(cls.id == certificate_id)
+            .scalar_subquery()
+        )
+        session.execute(
+            sa.update(cls)
+            .where(cls.id == self.id)
+            .values(private_key_pem=private_key_pem)
+            .execution_options(synchronize_session=False)
+        )
+        session.expire(self, ["private_key_pem"])
+
 
 class OperationModel:
-    pass
+    # the columns the class methods here use, which each subclass defines
+    state: sa.Column
+    created_at: sa.Column
+
+    @property
+    def route_key(self):
+        return sa.inspect(self.route).identity[0]
+
+    @classmethod
+    def count_in_progress(cls, session) -> int:
+        return (
+            session.query(cls)
+            .filter(cls.state == OperationState.IN_PROGRESS.value)
+            .count()
+        )
+
+    @classmethod
+    def stale_in_progress(cls, session) -> List:
+        """
+        operations in progress that started longer than a renewal lease ago.
+        Their pipeline may still be running, so check its lease before giving
+        up on one
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cutoff = now - datetime.timedelta(seconds=config.RENEWAL_LEASE_SECONDS)
+        return (
+            session.query(cls)
+            .filter(cls.state == OperationState.IN_PROGRESS.value)
+            .filter(sa.or_(cls.created_at.is_(None), cls.created_at < cutoff))
+            .all()
+        )
 
 
 class AcmeUserV2Model:
     @classmethod
     def get_user(cls, session):
-        users: List = session.query(cls).all()
-        users = sorted(users, key=lambda x: len(list(x.routes)))
-        if not len(users):
-            return None
-        lowest = users[0]
-        if len(lowest.routes) >= config.MAX_ROUTES_PER_USER:
-            return None
-        return lowest
+        """
+        find the account with the fewest routes that still has room for one
+        more, and lock it until the caller commits. Workers running this at the
+        same time skip each other's locked accounts, so two of them can't both
+        take an account's last slot.
+        Returns None only if no account has room, not when every account with
+        room is locked: then we wait for one instead of registering a new one
+        """
+        relationship = sa.inspect(cls).relationships["routes"]
+        ((user_key, route_user_key),) = relationship.local_remote_pairs
+        route_count = (
+            sa.select(sa.func.count())
+            .select_from(route_user_key.table)
+            .where(route_user_key == user_key)
+            .scalar_subquery()
+        )
+        candidates = (
+            session.query(cls)
+            .filter(route_count < config.MAX_ROUTES_PER_USER)
+            .order_by(route_count, cls.id)
+        )
+        full = []
+        while True:
+            query = candidates.filter(cls.id.notin_(full)) if full else candidates
+            # lock each account we try in a savepoint, so we can let go of it
+            # again if it turns out to be full. Otherwise we'd hold it while
+            # waiting for another worker, which may be waiting for it
+            savepoint = session.begin_nested()
+            user = query.with_for_update(skip_locked=True).first()
+            if user is None:
+                user = query.with_for_update().first()
+            if user is None:
+                savepoint.rollback()
+                return None
+            # the count we filtered on may be from before another worker
+            # committed a route to this account, and locking the row doesn't
+            # refresh it, so count again now that the account is ours
+            count = session.scalar(
+                sa.select(sa.func.count())
+                .select_from(route_user_key.table)
+                .where(route_user_key == user.id)
+            )
+            if count < config.MAX_ROUTES_PER_USER:
+                savepoint.commit()
+                return user
+            full.append(user.id)
+            savepoint.rollback()
 
 
 class ChallengeModel:
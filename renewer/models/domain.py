@@ -11,7 +11,6 @@ from sqlalchemy_utils.types.encrypted.encrypted_type import (
 )
 
 from renewer.action import Action
-from renewer.aws import alb, iam_govcloud
 from renewer.extensions import config
 from renewer.models.common import (
     RouteType,
@@ -70,35 +69,16 @@ class DomainRoute(DomainModel, RouteModel):
     operations: List["DomainOperation"] = orm.relationship(
         "DomainOperation", backref="route", lazy="dynamic"
     )
-    acme_user_id = sa.Column(sa.Integer, sa.ForeignKey("acme_user_v2.id"))
+    acme_user_id = sa.Column(sa.Integer, sa.ForeignKey("acme_user_v2.id"), index=True)
+    # renew_after is when the current certificate becomes due for renewal.
+    # It's maintained by the renewer, so scans don't need to look at certificates
+    renew_after = sa.Column(postgresql.TIMESTAMP(timezone=True), index=True)
     route_type = RouteType.ALB
 
     def domain_external_list(self):
         """to match CdnRoute"""
         return self.domains
 
-    def backport_manual_certs(self):
-        """
-        We were for some time manually rotating certs without updating the database
-        This backports certs that exist in IAM/on ELBs into the database, so we can
-        use the same logic for all rotations
-        """
-        # get the certs for the alb
-        paginator = alb.get_paginator("describe_listener_certificates")
-        cert_pages = paginator.paginate(ListenerArn=self.alb_proxy.listener_arn)
-        for cert_page in cert_pages:
-            for cert in cert_page["Certificates"]:
-                if self.instance_id in cert["CertificateArn"]:
-                    arn = cert["CertificateArn"]
-
-                    if any(
-                        c.iam_server_certificate_arn == arn for c in self.certificates
-                    ):
-                        # we already know about this one
-                        continue
-
-                    return DomainCertificate.create_cert_for_arn(arn, self)
-
     def create_renewal_operation(self):
         operation = DomainOperation()
         operation.route = self
@@ -123,7 +103,15 @@ class DomainCertificate(DomainModel, CertificateModel):
     private_key_pem: str = sa.Column(
         StringEncryptedType(sa.Text, db_encryption_key, AesGcmEngine, "pkcs5")
     )
+    # when private_key_pem was generated. Renewals that reuse the key carry
+    # this over, so we know when it's time for a new one
+    private_key_created_at = sa.Column(postgresql.TIMESTAMP(timezone=True))
     csr_pem = sa.Column(sa.Text)
+    # the renewal window the CA suggested for this certificate through ACME
+    # Renewal Information (ARI), and when we may ask it again
+    renewal_window_start = sa.Column(postgresql.TIMESTAMP(timezone=True))
+    renewal_window_end = sa.Column(postgresql.TIMESTAMP(timezone=True))
+    renewal_info_retry_after = sa.Column(postgresql.TIMESTAMP(timezone=True))
     challenges: List["DomainChallenge"] = orm.relationship(
         "DomainChallenge", backref="certificate", lazy="dynamic"
     )
@@ -135,19 +123,12 @@ class DomainCertificate(DomainModel, CertificateModel):
     iam_server_certificate_arn = sa.Column(sa.Text)
 
     @classmethod
-    def create_cert_for_arn(cls, arn, route):
-        name = arn.split("/")[-1]
-        data = iam_govcloud.get_server_certificate(ServerCertificateName=name)
-        data = data["ServerCertificate"]
-        expires = data["ServerCertificateMetadata"]["Expiration"]
-
+    def from_iam_metadata(cls, arn, metadata):
         cert = DomainCertificate()
-        cert.route = route
         cert.created_at = datetime.datetime.now()
         cert.iam_server_certificate_arn = arn
-        cert.expires = expires
-        cert.iam_server_certificate_name = name
-
+        cert.expires = metadata["Expiration"]
+        cert.iam_server_certificate_name = arn.split("/")[-1]
         return cert
 
 
@@ -165,6 +146,9 @@ class DomainUserData(DomainModel):
 
 class DomainOperation(DomainModel, OperationModel):
     __tablename__ = "operations"
+    __table_args__ = (
+        sa.Index("idx_operations_route_guid_state", "route_guid", "state"),
+    )
 
     id = sa.Column(sa.Integer, sa.Sequence("operations_id_seq"), primary_key=True)
     route_guid: str = sa.Column(sa.ForeignKey(DomainRoute.instance_id), nullable=False)
@@ -187,6 +171,9 @@ class DomainOperation(DomainModel, OperationModel):
         server_default=Action.RENEW.value,
         nullable=False,
     )
+    created_at = sa.Column(
+        postgresql.TIMESTAMP(timezone=True), server_default=sa.func.now()
+    )
 
 
 class DomainAcmeUserV2(DomainModel, AcmeUserV2Model):
@@ -218,4 +205,5 @@ class DomainChallenge(DomainModel, ChallengeModel):
     validation_contents = sa.Column(sa.Text, nullable=False)
     body_json = sa.Column(sa.Text)
     answered = sa.Column(sa.Boolean, default=False)
+    uploaded = sa.Column(sa.Boolean, default=False)
     certificate: DomainCertificate
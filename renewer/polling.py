@@ -0,0 +1,56 @@
+import logging
+
+from huey.exceptions import RetryTask
+
+from renewer import huey
+from renewer.extensions import config
+from renewer.json_log import json_log
+from renewer.models.common import RouteType
+
+logger = logging.getLogger(__name__)
+
+
+def poll_key(operation_id: int, instance_type: RouteType, step: str) -> str:
+    return f"renewer:poll:{instance_type.value}:{operation_id}:{step}"
+
+
+def poll_again(
+    operation_id: int,
+    instance_type: RouteType,
+    step: str,
+    *,
+    initial_delay: float,
+    max_delay: float,
+    max_attempts: int,
+    timeout: Exception,
+    retry_after: float = 0,
+):
+    """
+    Reschedule a polling task instead of sleeping in it, so the worker is free
+    while someone else does the work. We wait at least retry_after, backing
+    off exponentially from initial_delay up to max_delay, and raise timeout
+    after max_attempts, which leaves the task to its regular retries
+    """
+    key = poll_key(operation_id, instance_type, step)
+    attempt = huey.redis_client.incr(key)
+    huey.redis_client.expire(key, config.RENEWAL_LEASE_SECONDS)
+    if attempt > max_attempts:
+        huey.redis_client.delete(key)
+        raise timeout
+    backoff = initial_delay * 2 ** (attempt - 1)
+    delay = min(max(backoff, retry_after), max_delay)
+    json_log(
+        logger.info,
+        {
+            "operation_id": operation_id,
+            "type": instance_type,
+            "attempt": attempt,
+            "delay": delay,
+            "message": f"not ready, checking again for {step}",
+        },
+    )
+    raise RetryTask(delay=delay)
+
+
+def done_polling(operation_id: int, instance_type: RouteType, step: str):
+    huey.redis_client.delete(poll_key(operation_id, instance_type, step))
@@ -1,5 +1,4 @@
 import logging
-import time
 
 from renewer import huey
 from renewer.aws import alb
@@ -7,6 +6,7 @@ from renewer.json_log import json_log
 from renewer.models.domain import DomainOperation
 from renewer.extensions import config
 from renewer.models.common import RouteType
+from renewer.polling import done_polling, poll_again
 
 logger = logging.getLogger(__name__)
 
@@ -79,7 +79,55 @@ def remove_old_certificate(session, operation_id: int, route_type: RouteType):
     session.commit()
 
 
-@huey.nonretriable_sessionless_task
-def wait_for_cert_update(operation_id: int, route_type: RouteType):
+@huey.retriable_task
+def wait_for_cert_update(session, operation_id: int, route_type: RouteType):
+    """
+    check the listener until it serves the new certificate and not the one
+    remove_old_certificate took off, so that one is safe to delete from IAM.
+    Between checks we reschedule ourselves with backoff instead of holding a
+    worker
+    """
     raise_for_type(route_type)
-    time.sleep(config.IAM_PROPAGATION_TIME)
+    operation = session.query(DomainOperation).get(operation_id)
+    new_certificate = operation.certificate
+    route = operation.route
+    listener_arn = route.alb_proxy.listener_arn
+    new_arn = new_certificate.iam_server_certificate_arn
+    # remove_old_certificate removed the route's newest certificate before
+    # the new one was attached to the route, so find that one again
+    old_certificate = next(
+        (c for c in route.certificates if c.id != new_certificate.id), None
+    )
+    old_arn = old_certificate and old_certificate.iam_server_certificate_arn
+    if old_arn == new_arn:
+        # remove_old_certificate had nothing to take off
+        old_arn = None
+
+    paginator = alb.get_paginator("describe_listener_certificates")
+    listener_arns = set()
+    for page in paginator.paginate(ListenerArn=listener_arn):
+        for certificate in page["Certificates"]:
+            listener_arns.add(certificate["CertificateArn"])
+
+    if new_arn in listener_arns and old_arn not in listener_arns:
+        done_polling(operation_id, route_type, "listener")
+        return
+
+    json_log(
+        logger.info,
+        {
+            "instance_id": route.instance_id,
+            "message": f"listener {listener_arn} not updated yet",
+        },
+    )
+    poll_again(
+        operation_id,
+        route_type,
+        "listener",
+        initial_delay=max(config.IAM_PROPAGATION_TIME, 1),
+        max_delay=config.ALB_POLL_MAX_DELAY_SECONDS,
+        max_attempts=config.ALB_POLL_MAX_ATTEMPTS,
+        timeout=RuntimeError(
+            f"listener {listener_arn} didn't pick up certificate {new_arn}"
+        ),
+    )
@@ -3,6 +3,7 @@ from typing import Union
 import logging
 
 from botocore.exceptions import ClientError
+from huey import crontab
 
 from renewer import huey
 from renewer.extensions import config
@@ -15,6 +16,34 @@ from renewer.models.domain import DomainOperation, DomainCertificate, DomainRout
 logger = logging.getLogger(__name__)
 
 
+@huey.huey.periodic_task(
+    crontab(
+        month="*",
+        day="*",
+        hour="*",
+        minute=f"*/{config.IAM_INVENTORY_REFRESH_MINUTES}",
+    )
+)
+def refresh_iam_inventory():
+    if not config.RUN_RENEWALS:
+        logger.info("skipping IAM inventory refresh because of configuration")
+        return
+    partitions = [
+        (RouteType.ALB, iam_govcloud, config.GOVCLOUD_IAM_PREFIX),
+        (RouteType.CDN, iam_commercial, config.COMMERCIAL_IAM_PREFIX),
+    ]
+    for route_type, iam, prefix in partitions:
+        count = huey.iam_inventory.refresh(route_type, iam, prefix)
+        json_log(
+            logger.info,
+            {
+                "type": route_type,
+                "certificates": count,
+                "message": "refreshed IAM inventory",
+            },
+        )
+
+
 @huey.retriable_task
 def upload_certificate(session, operation_id: int, instance_type: RouteType):
     Operation: OperationModel
@@ -62,12 +91,13 @@ def upload_certificate(session, operation_id: int, instance_type: RouteType):
         if e.response["Error"]["Code"] == "EntityAlreadyExistsException":
             # this handles an edge case, where we uploaded the certificate but
             # failed to persist the metadata to the database.
-            cert_response = iam.get_server_certificate(
-                ServerCertificateName=certificate.iam_server_certificate_name
+            metadata = huey.iam_inventory.server_certificate_metadata(
+                instance_type, iam, certificate.iam_server_certificate_name
             )
-            metadata = cert_response["ServerCertificate"]["ServerCertificateMetadata"]
         else:
             raise e
+    else:
+        huey.iam_inventory.add(instance_type, metadata)
 
     cert_id = metadata["ServerCertificateId"]
     cert_arn = metadata["Arn"]
@@ -123,4 +153,7 @@ def delete_old_certificate(session, operation_id: int, instance_type: RouteType)
             ServerCertificateName=old_certificate.iam_server_certificate_name
         )
     except iam.exceptions.NoSuchEntityException:
-        return
+        pass
+    huey.iam_inventory.remove(
+        instance_type, old_certificate.iam_server_certificate_name
+    )
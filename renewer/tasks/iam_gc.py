@@ -0,0 +1,200 @@
+from datetime import datetime, timedelta, timezone
+import logging
+from typing import Set
+
+from huey import crontab
+
+from renewer import huey
+from renewer.aws import alb, cloudfront, iam_commercial, iam_govcloud
+from renewer.db import SessionHandler
+from renewer.extensions import config
+from renewer.json_log import json_log
+from renewer.models.cdn import CdnRoute
+from renewer.models.common import RouteType
+from renewer.models.domain import DomainAlbProxy, DomainRoute
+
+logger = logging.getLogger(__name__)
+
+
+def iam_for(route_type: RouteType):
+    """returns the IAM client and certificate prefix for a route type"""
+    if route_type is RouteType.ALB:
+        return iam_govcloud, config.GOVCLOUD_IAM_PREFIX
+    return iam_commercial, config.COMMERCIAL_IAM_PREFIX
+
+
+def route_for(route_type: RouteType):
+    return DomainRoute if route_type is RouteType.ALB else CdnRoute
+
+
+def certificate_identifiers(metadata) -> Set[str]:
+    """the values the database and AWS might refer to a certificate by"""
+    return {
+        metadata["ServerCertificateName"],
+        metadata["Arn"],
+        metadata["ServerCertificateId"],
+    }
+
+
+@huey.huey.periodic_task(crontab(month="*", day="*", hour="8", minute="0"))
+def collect_orphaned_certificates():
+    """
+    find server certificates under our IAM prefixes that nothing uses: no
+    certificate row names them, and no CloudFront distribution or ALB
+    listener serves them. Failed pipelines, manual rotations and the old
+    brokers left these behind.
+    In dry run mode we only report them. Otherwise we schedule their
+    deletes IAM_GC_DELETES_PER_MINUTE apart, so we stay inside the IAM API
+    budget we share with the brokers
+    """
+    if not config.RUN_RENEWALS:
+        return
+    for route_type in RouteType:
+        orphans = find_orphaned_certificates(route_type)
+        to_delete = orphans[: config.IAM_GC_MAX_DELETES_PER_RUN]
+        json_log(
+            logger.info,
+            {
+                "type": route_type,
+                "orphans": len(orphans),
+                "deleting": 0 if config.IAM_GC_DRY_RUN else len(to_delete),
+                "dry_run": config.IAM_GC_DRY_RUN,
+                "names": to_delete,
+                "message": "found orphaned IAM certificates",
+            },
+        )
+        if config.IAM_GC_DRY_RUN:
+            continue
+        spacing = 60 / config.IAM_GC_DELETES_PER_MINUTE
+        for i, name in enumerate(to_delete):
+            delete_orphaned_certificate.schedule(
+                args=(route_type, name), delay=i * spacing
+            )
+
+
+def find_orphaned_certificates(route_type: RouteType):
+    """
+    returns the names of the route type's unused IAM certificates, oldest
+    first. Certificates younger than IAM_GC_MIN_AGE_DAYS never count, in
+    case a pipeline uploaded them but hasn't saved them yet
+    """
+    iam, prefix = iam_for(route_type)
+    huey.iam_inventory.refresh(route_type, iam, prefix)
+    inventory = huey.iam_inventory.all(route_type)
+    cutoff = datetime.now(timezone.utc) - timedelta(days=config.IAM_GC_MIN_AGE_DAYS)
+    in_use = referenced_certificates(route_type) | served_certificates(route_type)
+    orphans = [
+        metadata
+        for metadata in inventory.values()
+        if metadata["UploadDate"] < cutoff
+        and not in_use & certificate_identifiers(metadata)
+    ]
+    orphans.sort(key=lambda metadata: metadata["UploadDate"])
+    return [metadata["ServerCertificateName"] for metadata in orphans]
+
+
+def referenced_certificates(route_type: RouteType) -> Set[str]:
+    """
+    the names, ARNs and ids of the IAM certificates the database still needs.
+    Rows for superseded certificates and deprovisioned routes stay around
+    after we're done with their certificates, so they don't count
+    """
+    Route = route_for(route_type)
+    Certificate, _, _ = Route.certificate_join()
+    referenced: Set[str] = set()
+    with SessionHandler() as session:
+        query = (
+            Route.in_use_certificates_query(session)
+            .with_entities(
+                Certificate.iam_server_certificate_name,
+                Certificate.iam_server_certificate_arn,
+                Certificate.iam_server_certificate_id,
+            )
+            .yield_per(1000)
+        )
+        for row in query:
+            referenced.update(value for value in row if value is not None)
+    return referenced
+
+
+def served_certificates(route_type: RouteType) -> Set[str]:
+    """the ARNs or ids of the IAM certificates our ALBs or CloudFront serve"""
+    served = set()
+    if route_type is RouteType.ALB:
+        with SessionHandler() as session:
+            listener_arns = [
+                arn
+                for (arn,) in session.query(DomainAlbProxy.listener_arn).distinct()
+                if arn is not None
+            ]
+        paginator = alb.get_paginator("describe_listener_certificates")
+        for listener_arn in listener_arns:
+            for page in paginator.paginate(ListenerArn=listener_arn):
+                for certificate in page["Certificates"]:
+                    served.add(certificate["CertificateArn"])
+    else:
+        paginator = cloudfront.get_paginator("list_distributions")
+        for page in paginator.paginate():
+            for distribution in page["DistributionList"].get("Items", []):
+                certificate_id = distribution["ViewerCertificate"].get(
+                    "IAMCertificateId"
+                )
+                if certificate_id is not None:
+                    served.add(certificate_id)
+    return served
+
+
+def still_orphaned(route_type: RouteType, metadata) -> bool:
+    """
+    check a certificate again right before deleting it, since the scan that
+    found it may be most of an hour old by now. IAM refuses to delete a
+    certificate CloudFront is using, but nothing stops us deleting one an
+    ALB listener has just started serving, so for ALBs we ask the listeners
+    """
+    identifiers = certificate_identifiers(metadata)
+    with SessionHandler() as session:
+        if route_for(route_type).certificate_in_use(session, identifiers):
+            return False
+    if route_type is RouteType.ALB:
+        return not served_certificates(route_type) & identifiers
+    return True
+
+
+@huey.nonretriable_sessionless_task
+def delete_orphaned_certificate(route_type: RouteType, name: str):
+    iam, _ = iam_for(route_type)
+    try:
+        metadata = huey.iam_inventory.server_certificate_metadata(route_type, iam, name)
+    except iam.exceptions.NoSuchEntityException:
+        huey.iam_inventory.remove(route_type, name)
+        return
+    if not still_orphaned(route_type, metadata):
+        json_log(
+            logger.warning,
+            {
+                "type": route_type,
+                "name": name,
+                "message": "orphaned certificate is in use now, not deleting",
+            },
+        )
+        return
+    try:
+        iam.delete_server_certificate(ServerCertificateName=name)
+    except iam.exceptions.NoSuchEntityException:
+        pass
+    except iam.exceptions.DeleteConflictException:
+        # CloudFront started using it since we looked
+        json_log(
+            logger.warning,
+            {
+                "type": route_type,
+                "name": name,
+                "message": "orphaned certificate is in use, not deleting",
+            },
+        )
+        return
+    huey.iam_inventory.remove(route_type, name)
+    json_log(
+        logger.info,
+        {"type": route_type, "name": name, "message": "deleted orphaned certificate"},
+    )
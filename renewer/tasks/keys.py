@@ -0,0 +1,22 @@
+import logging
+
+from huey import crontab
+
+from renewer.extensions import config
+from renewer.key_pool import certificate_key_type
+from renewer.models.common import RouteType
+from renewer import huey
+
+logger = logging.getLogger(__name__)
+
+
+@huey.huey.periodic_task(crontab(month="*", day="*", hour="*", minute="*"))
+def refill_key_pool():
+    if not config.RUN_RENEWALS or not config.KEY_POOL_SIZE:
+        return
+    for route_type in RouteType:
+        key_type = certificate_key_type(route_type)
+        generated = huey.key_pool.refill(
+            route_type, key_type, config.KEY_POOL_REFILL_PER_MINUTE
+        )
+        huey.key_pool.report(route_type, key_type, generated)
@@ -1,15 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 import json
 import logging
-import re
-from typing import Type, Union, Tuple
+from typing import Type, Union
 
-import josepy
 from OpenSSL import crypto
-from acme import challenges, client, crypto_util, messages, errors
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from acme import challenges, crypto_util, messages, errors
 
 from renewer.models.cdn import (
     CdnOperation,
@@ -26,9 +22,11 @@ from renewer.models.domain import (
     DomainChallenge,
 )
 from renewer.extensions import config
-from renewer.acme_client import AcmeClient
+from renewer.acme_client import AcmeClient, acme_clients, new_network
 from renewer.json_log import json_log
-from renewer import huey
+from renewer.key_pool import certificate_key_type
+from renewer import crypto_pool, huey
+from renewer.polling import done_polling, poll_again
 from renewer.models.common import (
     RouteType,
     OperationModel,
@@ -51,17 +49,20 @@ class ChallengeNotFound(RuntimeError):
         super().__init__(f"Cannot find any challenges for {domain} in {obj}")
 
 
-def http_challenge(order, domain):
-    """Extract authorization resource from within order resource."""
-
-    # authorization.body.challenges is a set of ChallengeBody
-    # objects.
-    challenges_for_domain = [
-        authorization.body.challenges
+def authorization_for(order, domain) -> messages.AuthorizationResource:
+    """Extract a domain's authorization resource from within order resource."""
+    return [
+        authorization
         for authorization in order.authorizations
         if authorization.body.identifier.value == domain
     ][0]
 
+
+def http_challenge(order, domain):
+    # authorization.body.challenges is a set of ChallengeBody
+    # objects.
+    challenges_for_domain = authorization_for(order, domain).body.challenges
+
     if not challenges_for_domain:
         raise ChallengeNotFound(domain, order.authorizations)
 
@@ -100,21 +101,13 @@ def create_user(session, operation_id: int, route_type: RouteType):
 
     if acme_user is None:
         acme_user = AcmeUserV2()
-        key = josepy.JWKRSA(
-            key=rsa.generate_private_key(
-                public_exponent=65537, key_size=2048, backend=default_backend()
-            )
-        )
-        private_key_pem_in_binary = key.key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.TraditionalOpenSSL,
-            encryption_algorithm=serialization.NoEncryption(),
+        # we register accounts rarely, so their keys don't come from the key
+        # pool, which is kept for certificate keys
+        acme_user.private_key_pem = crypto_pool.run(
+            crypto_pool.generate_private_key_pem, config.ACME_ACCOUNT_KEY_TYPE
         )
-        acme_user.private_key_pem = private_key_pem_in_binary.decode("utf-8")
-
-        net = client.ClientNetwork(key, user_agent="cloud.gov legacy domain renewer")
-        directory = messages.Directory.from_json(net.get(config.ACME_DIRECTORY).json())
-        client_acme = AcmeClient(directory, net=net)
+        net = new_network(acme_user.private_key_pem)
+        client_acme = AcmeClient(acme_clients.get_directory(net), net=net)
 
         acme_user.email = config.LETS_ENCRYPT_REGISTRATION_EMAIL
         registration = client_acme.new_account(
@@ -162,21 +155,51 @@ def create_private_key_and_csr(session, operation_id: int, instance_type: RouteT
     certificate = operation.certificate
     route = operation.route
 
-    # Create private key.
-    private_key = crypto.PKey()
-    private_key.generate_key(crypto.TYPE_RSA, 2048)
+    key_type = certificate_key_type(instance_type)
+    domains = route.domain_external_list()
+    reusable = None
+    if config.CERTIFICATE_REUSE_KEY:
+        reusable = route.find_reusable_key(session)
+    if reusable is not None:
+        reused_key_type, csr_domains = crypto_pool.csr_key_type_and_domains(
+            reusable.csr_pem
+        )
+        if reused_key_type != key_type:
+            reusable = None
 
-    # Get the PEM
-    private_key_pem_in_binary = crypto.dump_privatekey(crypto.FILETYPE_PEM, private_key)
+    if reusable is not None:
+        json_log(
+            logger.info,
+            {
+                "instance_id": route.instance_id,
+                "type": instance_type,
+                "certificate_id": reusable.id,
+                "message": "reusing private key",
+            },
+        )
+        certificate.private_key_created_at = reusable.private_key_created_at
+        certificate.copy_private_key_from(session, reusable.id)
+        if csr_domains == set(domains):
+            # the old CSR has the same key and domains, so it's still good
+            certificate.csr_pem = reusable.csr_pem
+        else:
+            csr_pem_in_binary = crypto_pool.run(
+                crypto_util.make_csr, certificate.private_key_pem.encode(), domains
+            )
+            certificate.csr_pem = csr_pem_in_binary.decode("utf-8")
+    else:
+        # Take a private key from the pool, or create one if the pool is empty
+        private_key_pem_in_binary = huey.key_pool.take(instance_type, key_type).encode()
 
-    # Get the CSR for the domains
-    csr_pem_in_binary = crypto_util.make_csr(
-        private_key_pem_in_binary, route.domain_external_list()
-    )
+        # Get the CSR for the domains
+        csr_pem_in_binary = crypto_pool.run(
+            crypto_util.make_csr, private_key_pem_in_binary, domains
+        )
 
-    # Store them as text for later
-    certificate.private_key_pem = private_key_pem_in_binary.decode("utf-8")
-    certificate.csr_pem = csr_pem_in_binary.decode("utf-8")
+        # Store them as text for later
+        certificate.private_key_pem = private_key_pem_in_binary.decode("utf-8")
+        certificate.private_key_created_at = datetime.now(timezone.utc)
+        certificate.csr_pem = csr_pem_in_binary.decode("utf-8")
 
     session.add(certificate)
     session.commit()
@@ -210,40 +233,44 @@ def initiate_challenges(session, operation_id: int, instance_type: RouteType):
     if certificate.order_json is not None:
         return
 
-    account_key = serialization.load_pem_private_key(
-        acme_user.private_key_pem.encode(), password=None, backend=default_backend()
-    )
-    wrapped_account_key = josepy.JWKRSA(key=account_key)
-
-    registration = json.loads(acme_user.registration_json)
-    net = client.ClientNetwork(
-        wrapped_account_key,
-        user_agent="cloud.gov legacy domain renewer",
-        account=registration,
-    )
-    directory = messages.Directory.from_json(net.get(config.ACME_DIRECTORY).json())
-    client_acme = AcmeClient(directory, net=net)
-
-    order = client_acme.new_order(certificate.csr_pem.encode())
-    order_json = json.dumps(order.to_json())
-    certificate.order_json = json.dumps(order.to_json())
-
-    for domain in route.domain_external_list():
-        challenge_body = http_challenge(order, domain)
-        (
-            challenge_response,
-            challenge_validation_contents,
-        ) = challenge_body.response_and_validation(wrapped_account_key)
-
-        challenge = Challenge()
-        challenge.body_json = challenge_body.json_dumps()
-
-        challenge.domain = domain
-        challenge.certificate = certificate
-        challenge.validation_path = challenge_body.path
-        challenge.validation_contents = challenge_validation_contents
-        session.add(challenge)
+    with acme_clients.client_for(acme_user) as client_acme:
+        order = client_acme.new_order(certificate.csr_pem.encode())
+        order_json = json.dumps(order.to_json())
+        certificate.order_json = json.dumps(order.to_json())
+
+        pre_authorized = []
+        for domain in route.domain_external_list():
+            authorization = authorization_for(order, domain)
+            challenge_body = http_challenge(order, domain)
+            (
+                challenge_response,
+                challenge_validation_contents,
+            ) = challenge_body.response_and_validation(client_acme.net.key)
+
+            challenge = Challenge()
+            challenge.body_json = challenge_body.json_dumps()
+
+            challenge.domain = domain
+            challenge.certificate = certificate
+            challenge.validation_path = challenge_body.path
+            challenge.validation_contents = challenge_validation_contents
+            # the CA still holds a valid authorization for this domain from a
+            # recent order, so there's nothing to upload or answer
+            if authorization.body.status == messages.STATUS_VALID:
+                challenge.answered = True
+                pre_authorized.append(domain)
+            session.add(challenge)
 
+    if pre_authorized:
+        json_log(
+            logger.info,
+            {
+                "instance_id": route.instance_id,
+                "type": instance_type,
+                "domains": pre_authorized,
+                "message": "reusing valid authorizations",
+            },
+        )
     session.commit()
 
 
@@ -277,20 +304,7 @@ def answer_challenges(session, operation_id: int, instance_type: RouteType):
     if not unanswered:
         return
 
-    account_key = serialization.load_pem_private_key(
-        acme_user.private_key_pem.encode(), password=None, backend=default_backend()
-    )
-    wrapped_account_key = josepy.JWKRSA(key=account_key)
-
-    registration = json.loads(acme_user.registration_json)
-    net = client.ClientNetwork(
-        wrapped_account_key,
-        user_agent="cloud.gov legacy domain renewer",
-        account=registration,
-    )
-    directory = messages.Directory.from_json(net.get(config.ACME_DIRECTORY).json())
-    client_acme = AcmeClient(directory, net=net)
-
+    to_answer = []
     for challenge in unanswered:
         if json.loads(challenge.body_json)["status"] == "valid":
             # this covers an edge case where we try to get the sane certificate
@@ -299,67 +313,132 @@ def answer_challenges(session, operation_id: int, instance_type: RouteType):
             # but doing so makes testing worlds harder
             challenge.answered = True
             session.add(challenge)
-            session.commit()
             continue
+        to_answer.append(challenge)
+
+    def answer(challenge):
         challenge_body = messages.ChallengeBody.from_json(
             json.loads(challenge.body_json)
         )
-        challenge_response = challenge_body.response(wrapped_account_key)
-        # Let the CA server know that we are ready for the challenge.
-        response = client_acme.answer_challenge(challenge_body, challenge_response)
-        if response.body.error is not None:
-            # log the error for now. We haven't reproduced this locally, so we can't act on it yet
-            # but it would be interesting in the real world
-            json_log(
-                logger.error,
-                {
-                    "instance_id": route.instance_id,
-                    "type": route.route_type,
-                    "error": response.body.error,
-                    "message": "challenge errored",
-                },
-            )
-        challenge.answered = True
-        session.add(challenge)
+        # each thread checks out its own client, since clients can't be shared
+        with acme_clients.client_for(acme_user) as client_acme:
+            challenge_response = challenge_body.response(client_acme.net.key)
+            # Let the CA server know that we are ready for the challenge.
+            return client_acme.answer_challenge(challenge_body, challenge_response)
+
+    # answer every domain at once, so a route with many domains takes about as
+    # long as its slowest one. The threads only talk to the CA: acme_user and
+    # the challenges were loaded above, and all the database work stays here
+    failures = []
+    if to_answer:
+        workers = min(config.ACME_MAX_CONCURRENT_DOMAINS, len(to_answer))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(answer, challenge): challenge for challenge in to_answer
+            }
+            for future, challenge in futures.items():
+                try:
+                    response = future.result()
+                except Exception as e:
+                    failures.append(e)
+                    continue
+                if response.body.error is not None:
+                    # log the error for now. We haven't reproduced this locally, so we can't act on it yet
+                    # but it would be interesting in the real world
+                    json_log(
+                        logger.error,
+                        {
+                            "instance_id": route.instance_id,
+                            "type": route.route_type,
+                            "error": response.body.error,
+                            "message": "challenge errored",
+                        },
+                    )
+                challenge.answered = True
+                session.add(challenge)
+    # keep track of the challenges we did answer, so a retry skips them
     session.commit()
+    if failures:
+        raise failures[0]
 
 
-@huey.retriable_task
-def retrieve_certificate(session, operation_id: int, instance_type: RouteType):
-    def cert_from_fullchain(fullchain_pem: str) -> Tuple[str, str]:
-        """extract cert_pem from fullchain_pem
-
-        Reference https://github.com/certbot/certbot/blob/b42e24178aaa3f1ad1323acb6a3a9c63e547893f/certbot/certbot/crypto_util.py#L482-L518
-        """
-        cert_pem_regex = re.compile(
-            b"-----BEGIN CERTIFICATE-----\r?.+?\r?-----END CERTIFICATE-----\r?",
-            re.DOTALL,  # DOTALL (/s) because the base64text may include newlines
-        )
+def load_order(certificate) -> messages.OrderResource:
+    order_json = json.loads(certificate.order_json)
+    # The csr_pem in the JSON is a binary string, but finalize_order() expects
+    # utf-8?  So we set it here from our saved copy.
+    order_json["csr_pem"] = certificate.csr_pem
+    return messages.OrderResource.from_json(order_json)
+
+
+def poll_order_again(
+    operation_id: int, instance_type: RouteType, step: str, retry_after
+):
+    """
+    check the order again later, while the CA works on it. We wait at least
+    as long as the CA's Retry-After, and give up after ACME_POLL_MAX_ATTEMPTS
+    """
+    poll_again(
+        operation_id,
+        instance_type,
+        step,
+        initial_delay=config.ACME_POLL_INITIAL_DELAY_SECONDS,
+        max_delay=config.ACME_POLL_MAX_DELAY_SECONDS,
+        max_attempts=config.ACME_POLL_MAX_ATTEMPTS,
+        timeout=errors.TimeoutError(),
+        retry_after=retry_after,
+    )
 
-        certs = cert_pem_regex.findall(fullchain_pem.encode())
-        if len(certs) < 2:
-            raise RuntimeError(
-                "failed to extract cert from fullchain: fewer than 2 certificates in chain"
-            )
 
-        certs_normalized = [
-            crypto.dump_certificate(
-                crypto.FILETYPE_PEM, crypto.load_certificate(crypto.FILETYPE_PEM, cert)
-            ).decode()
-            for cert in certs
-        ]
+def log_invalid_order(route, client_acme, order):
+    failed = client_acme.failed_authorizations(order)
+    json_log(
+        logger.error,
+        {
+            "instance_id": route.instance_id,
+            "domains": route.domain_external_list(),
+            "message": f"failed to retrieve certificate: {order.body.error}, {failed}",
+        },
+    )
+    if failed:
+        raise errors.ValidationError(failed)
+    if order.body.error is not None:
+        raise errors.IssuanceError(order.body.error)
+    raise errors.Error("order is invalid")
+
+
+def fetch_renewal_info(client_acme, route, certificate):
+    """
+    ask the CA for the certificate's suggested renewal window and store it.
+    ARI is advice, so if the CA doesn't answer we log it, keep whatever window
+    we had (or the RENEW_BEFORE_DAYS fallback), and try again later
+    """
+    try:
+        renewal_info, retry_after = client_acme.renewal_info(certificate.leaf_pem)
+    except Exception as e:
+        json_log(
+            logger.warning,
+            {
+                "instance_id": route.instance_id,
+                "certificate_id": certificate.id,
+                "message": "failed to fetch renewal info",
+                "error": str(e),
+            },
+        )
+        renewal_info = None
+        retry_after = datetime.now(timezone.utc) + timedelta(
+            seconds=config.ACME_RENEWAL_INFO_RETRY_SECONDS
+        )
+    certificate.record_renewal_info(renewal_info, retry_after)
 
-        return certs_normalized[0], "".join(certs_normalized[1:])
 
+@huey.retriable_task
+def finalize_order(session, operation_id: int, instance_type: RouteType):
     Operation: OperationModel
-    Challenge: ChallengeModel
 
     if instance_type is RouteType.ALB:
         Operation = DomainOperation
-        Challenge = DomainChallenge
     elif instance_type is RouteType.CDN:
         Operation = CdnOperation
-        Challenge = CdnChallenge
 
     operation = session.query(Operation).get(operation_id)
     route = operation.route
@@ -368,90 +447,93 @@ def retrieve_certificate(session, operation_id: int, instance_type: RouteType):
         {
             "instance_id": route.instance_id,
             "type": instance_type,
-            "message": "retrieving certificate",
+            "message": "finalizing order",
         },
     )
-    acme_user = route.acme_user
     certificate = operation.certificate
 
     if certificate.leaf_pem is not None:
         return
 
-    account_key = serialization.load_pem_private_key(
-        acme_user.private_key_pem.encode(), password=None, backend=default_backend()
-    )
-    wrapped_account_key = josepy.JWKRSA(key=account_key)
+    with acme_clients.client_for(route.acme_user) as client_acme:
+        order, retry_after = client_acme.check_order(load_order(certificate))
+        status = order.body.status
+        if status == messages.STATUS_INVALID:
+            log_invalid_order(route, client_acme, order)
+        if status == messages.STATUS_READY:
+            order = client_acme.begin_finalization(order)
+
+    if status == messages.STATUS_PENDING:
+        # the CA is still validating our challenges
+        poll_order_again(operation_id, instance_type, "finalize", retry_after)
+    done_polling(operation_id, instance_type, "finalize")
+
+    certificate.order_json = json.dumps(order.to_json())
+    session.add(certificate)
+    session.commit()
+
+
+@huey.retriable_task
+def retrieve_certificate(session, operation_id: int, instance_type: RouteType):
+    Operation: OperationModel
+
+    if instance_type is RouteType.ALB:
+        Operation = DomainOperation
+    elif instance_type is RouteType.CDN:
+        Operation = CdnOperation
 
-    registration = json.loads(acme_user.registration_json)
-    net = client.ClientNetwork(
-        wrapped_account_key,
-        user_agent="cloud.gov external domain broker",
-        account=registration,
+    operation = session.query(Operation).get(operation_id)
+    route = operation.route
+    json_log(
+        logger.info,
+        {
+            "instance_id": route.instance_id,
+            "type": instance_type,
+            "message": "retrieving certificate",
+        },
     )
-    directory = messages.Directory.from_json(net.get(config.ACME_DIRECTORY).json())
-    client_acme = AcmeClient(directory, net=net)
+    certificate = operation.certificate
 
-    order_json = json.loads(certificate.order_json)
-    # The csr_pem in the JSON is a binary string, but finalize_order() expects
-    # utf-8?  So we set it here from our saved copy.
-    order_json["csr_pem"] = certificate.csr_pem
-    order = messages.OrderResource.from_json(order_json)
+    if certificate.leaf_pem is not None:
+        return
 
-    deadline = datetime.now() + timedelta(seconds=config.ACME_POLL_TIMEOUT_IN_SECONDS)
-    try:
-        finalized_order = client_acme.poll_and_finalize(orderr=order, deadline=deadline)
-    except messages.Error as e:
-        # this means we're trying to fulfill an order that's already fulfilled
-        if """Order's status ("valid")""" in e.detail:
-            # Check if we got a certificate already. Do we have a cert, and does its expiration look good?
-            next_month = datetime.now() + timedelta(days=31)
-            next_month = next_month.replace(tzinfo=timezone.utc)
-            if certificate.expires is not None and certificate.expires > next_month:
-                return
-            else:
-                finalized_order = client_acme.get_cert_for_finalized_order(
-                    order, deadline
-                )
-        else:
-            json_log(
-                logger.error,
-                {
-                    "instance_id": route.instance_id,
-                    "domains": route.domain_external_list(),
-                    "message": f"failed to retrieve certificate: {e.code}, {e.description}, {e.error}",
-                },
-            )
-            raise e
-    except errors.ValidationError as e:
-        json_log(
-            logger.error,
-            {
-                "instance_id": route.instance_id,
-                "domains": route.domain_external_list(),
-                "message": f"failed to retrieve certificate: {e.failed_authzrs}",
-            },
-        )
-        raise e
-        # if we fail validation, nuke the cert record and its challenges.
-        # this way, when we retry from the beginning, we won't try to reuse them
-        # the bad new is that we'll still retry this task a bunch of times before the pipeline fails
-        operation.certificate = None
-        session.add(operation)
+    with acme_clients.client_for(route.acme_user) as client_acme:
+        order, retry_after = client_acme.check_order(load_order(certificate))
+        status = order.body.status
+        if status == messages.STATUS_INVALID:
+            log_invalid_order(route, client_acme, order)
+        if status == messages.STATUS_READY:
+            # the order went back to ready, so our finalization didn't take.
+            # Submit it again and check back later
+            order = client_acme.begin_finalization(order)
+        issued = status == messages.STATUS_VALID and order.body.certificate is not None
+        if issued:
+            order = client_acme.download_certificate(order)
+
+    if not issued:
+        certificate.order_json = json.dumps(order.to_json())
+        session.add(certificate)
         session.commit()
-        raise e
+        poll_order_again(operation_id, instance_type, "retrieve", retry_after)
+    done_polling(operation_id, instance_type, "retrieve")
 
-    certificate.leaf_pem, certificate.fullchain_pem = cert_from_fullchain(
-        finalized_order.fullchain_pem
+    certificate.leaf_pem, certificate.fullchain_pem = crypto_pool.run(
+        crypto_pool.cert_from_fullchain, order.fullchain_pem
     )
     x509 = crypto.load_certificate(crypto.FILETYPE_PEM, certificate.leaf_pem.encode())
     not_after_bytes = x509.get_notAfter()
     if not_after_bytes is not None:
         # None check should be an extreme edge case, but it makes mypy happy :shrug:
         not_after = not_after_bytes.decode("utf-8")
-        certificate.expires = datetime.strptime(not_after, "%Y%m%d%H%M%Sz")
+        certificate.expires = datetime.strptime(not_after, "%Y%m%d%H%M%Sz").replace(
+            tzinfo=timezone.utc
+        )
     else:
         raise RuntimeError("failed to get not_after")
-    certificate.order_json = json.dumps(finalized_order.to_json())
+    certificate.order_json = json.dumps(order.to_json())
+    with acme_clients.client_for(route.acme_user) as client_acme:
+        fetch_renewal_info(client_acme, route, certificate)
+    route.update_renew_after(certificate)
     session.add(route)
     session.add(certificate)
     session.commit()
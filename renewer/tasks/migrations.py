@@ -1,34 +1,125 @@
+import hashlib
 import logging
 
 from huey import crontab
 
+from renewer.aws import alb, iam_govcloud
 from renewer.db import SessionHandler
 from renewer.extensions import config
 from renewer.json_log import json_log
-from renewer.models.domain import DomainRoute
+from renewer.models.common import RouteType
+from renewer.models.domain import DomainAlbProxy, DomainCertificate, DomainRoute
 from renewer import huey
 
 logger = logging.getLogger(__name__)
 
+# we look at unchanged listeners again after this long anyway, in case
+# their certificate rows were changed outside the renewer
+BACKPORT_HASH_TTL_SECONDS = 7 * 24 * 60 * 60
+
 
 @huey.huey.periodic_task(crontab(month="*", day="*", hour="6", minute="0"))
 def backport_all_manual_certs():
     if not config.RUN_BACKPORTS:
         logger.info("skipping backports because of configuration")
         return
+    # many routes share a proxy, so we work through listeners rather than
+    # routes, and list each one once
     with SessionHandler() as session:
-        for instance in DomainRoute.find_active_instances(session):
-            backport_cert(instance.instance_id)
+        listener_arns = [
+            arn
+            for (arn,) in session.query(DomainAlbProxy.listener_arn)
+            .join(DomainRoute, DomainRoute.alb_proxy_arn == DomainAlbProxy.alb_arn)
+            .filter(DomainRoute.state == "provisioned")
+            .filter(DomainAlbProxy.listener_arn.isnot(None))
+            .distinct()
+        ]
+    for listener_arn in listener_arns:
+        backport_listener_certs(listener_arn)
+
+
+def listener_hash_key(listener_arn: str) -> str:
+    return f"renewer:backport-listener:{listener_arn}"
 
 
 @huey.nonretriable_task
-def backport_cert(session, instance_id):
-    json_log(logger.info, {"instance_id": instance_id, "message": "backporting cert"})
-    instance = session.query(DomainRoute).get(instance_id)
-    cert = instance.backport_manual_certs()
-    if cert is not None:
-        session.add(cert)
-        session.commit()
-        json_log(
-            logger.info, {"instance_id": instance_id, "message": "backported cert"}
-        )
+def backport_listener_certs(session, listener_arn: str):
+    """
+    backport the certificates on a listener into the database for all of its
+    routes at once. A certificate belongs to the route whose instance id is
+    in its ARN, and we only take the newest certificate we don't know of for
+    each route. We remember a hash of the listener's certificates, and skip
+    listeners whose certificates haven't changed since we last backported
+    them without asking the database about them. Routes come and go along
+    with their certificates, so they needn't be hashed
+    """
+    certificate_arns = set()
+    paginator = alb.get_paginator("describe_listener_certificates")
+    for page in paginator.paginate(ListenerArn=listener_arn):
+        for certificate in page["Certificates"]:
+            certificate_arns.add(certificate["CertificateArn"])
+    digest = hashlib.sha256("\n".join(sorted(certificate_arns)).encode()).hexdigest()
+    hash_key = listener_hash_key(listener_arn)
+    if huey.redis_client.get(hash_key) == digest.encode():
+        return
+
+    listener_routes = (
+        session.query(DomainRoute)
+        .join(DomainAlbProxy, DomainRoute.alb_proxy_arn == DomainAlbProxy.alb_arn)
+        .filter(DomainAlbProxy.listener_arn == listener_arn)
+        .filter(DomainRoute.state != "deprovisioned")
+        .all()
+    )
+    routes = [route for route in listener_routes if route.state == "provisioned"]
+    # a certificate for a route that isn't provisioned yet can't be backported
+    # now, so we'll need to look at this listener again even if it's unchanged
+    waiting = any(
+        route.instance_id in arn
+        for route in listener_routes
+        if route.state != "provisioned"
+        for arn in certificate_arns
+    )
+    arns_by_route = {
+        route.instance_id: [arn for arn in certificate_arns if route.instance_id in arn]
+        for route in routes
+    }
+    known_arns = {
+        arn
+        for (arn,) in session.query(DomainCertificate.iam_server_certificate_arn)
+        .filter(DomainCertificate.route_guid.in_(list(arns_by_route)))
+        .filter(DomainCertificate.iam_server_certificate_arn.isnot(None))
+    }
+
+    backported = []
+    for route in routes:
+        unknown = [
+            DomainCertificate.from_iam_metadata(
+                arn,
+                huey.iam_inventory.server_certificate_metadata(
+                    RouteType.ALB, iam_govcloud, arn.split("/")[-1]
+                ),
+            )
+            for arn in arns_by_route[route.instance_id]
+            if arn not in known_arns
+        ]
+        if not unknown:
+            continue
+        # older certificates left on the listener were replaced by hand too,
+        # and would only look like more certificates to renew
+        cert = max(unknown, key=lambda c: c.expires)
+        cert.route_guid = route.instance_id
+        route.update_renew_after(cert)
+        backported.append(cert)
+    if backported:
+        session.bulk_save_objects(backported)
+    session.commit()
+    if not waiting:
+        huey.redis_client.set(hash_key, digest, ex=BACKPORT_HASH_TTL_SECONDS)
+    json_log(
+        logger.info,
+        {
+            "listener_arn": listener_arn,
+            "certificates": len(backported),
+            "message": "backported listener certs",
+        },
+    )
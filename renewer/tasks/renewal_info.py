@@ -0,0 +1,58 @@
+import logging
+
+from huey import crontab
+
+from renewer.acme_client import acme_clients
+from renewer.db import SessionHandler
+from renewer.extensions import config
+from renewer.json_log import json_log
+from renewer.models.cdn import CdnRoute
+from renewer.models.domain import DomainRoute
+from renewer.tasks.letsencrypt import fetch_renewal_info
+from renewer import huey
+
+logger = logging.getLogger(__name__)
+
+
+@huey.huey.periodic_task(crontab(month="*", day="*", hour="*", minute="30"))
+def refresh_all_renewal_info():
+    """
+    keep the CA's suggested renewal windows current. A CA can move a window
+    earlier, e.g. ahead of revoking certificates, so routes follow the
+    window even when that means renewing sooner than planned
+    """
+    if not config.RUN_RENEWALS:
+        return
+    for Route in (CdnRoute, DomainRoute):
+        refresh_renewal_info_for(Route)
+
+
+def refresh_renewal_info_for(Route):
+    Certificate, _, _ = Route.certificate_join()
+    with SessionHandler() as session:
+        refreshed = 0
+        for certificate_ids in Route.iter_renewal_info_due_ids(
+            session, config.SCAN_CHUNK_SIZE
+        ):
+            certificates = session.query(Certificate).filter(
+                Certificate.id.in_(certificate_ids)
+            )
+            for certificate in certificates:
+                route = certificate.route
+                if route.acme_user is None:
+                    continue
+                with acme_clients.client_for(route.acme_user) as client_acme:
+                    fetch_renewal_info(client_acme, route, certificate)
+                route.follow_renewal_info(certificate)
+                session.add(certificate)
+                session.add(route)
+                refreshed += 1
+            session.commit()
+        json_log(
+            logger.info,
+            {
+                "type": Route.route_type,
+                "certificates": refreshed,
+                "message": "refreshed renewal info",
+            },
+        )
@@ -1,13 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 import logging
+from typing import Optional
 
 from huey import crontab
 
-from renewer.models.cdn import CdnRoute
+from renewer.models.cdn import CdnOperation, CdnRoute
 from renewer.db import SessionHandler
+from renewer.dispatcher import RenewalDispatcher
 from renewer.extensions import config
 from renewer.json_log import json_log
-from renewer.models.domain import DomainRoute
-from renewer.huey import huey
+from renewer.models.common import RouteType
+from renewer.models.domain import DomainOperation, DomainRoute
+from renewer.huey import fail_operation, huey, leases
 from renewer.tasks import alb, cdn, iam, letsencrypt, s3, update_operations
 
 logger = logging.getLogger(__name__)
@@ -18,76 +23,158 @@ def renew_all_certs():
     if not config.RUN_RENEWALS:
         logger.info("skipping renewals because of configuration")
         return
-    routes = []
+    dispatcher = RenewalDispatcher(huey)
+    # the brokers have separate databases, so scan them side by side,
+    # each on its own thread with its own session
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = {
+            executor.submit(renew_certs_for, Route, dispatcher): Route
+            for Route in (CdnRoute, DomainRoute)
+        }
+        for future in as_completed(futures):
+            e = future.exception()
+            if e is not None:
+                logger.exception(
+                    msg=f"failed to queue renewals for {futures[future].route_type}",
+                    exc_info=e,
+                )
+
+
+@huey.periodic_task(crontab(month="*", day="*", hour="*", minute="45"))
+def fail_abandoned_operations():
+    """
+    mark failed the renewals whose pipeline died without saying so. Every
+    pipeline task extends the route's lease, so an old operation that no
+    longer holds its lease hasn't run a task in RENEWAL_LEASE_SECONDS.
+    Until then, the route isn't scanned for renewal again
+    """
+    for Route in (CdnRoute, DomainRoute):
+        Operation = {CdnRoute: CdnOperation, DomainRoute: DomainOperation}[Route]
+        with SessionHandler() as session:
+            for operation in Operation.stale_in_progress(session):
+                if leases.held_by(Route.route_type, operation.route_key, operation.id):
+                    continue
+                json_log(
+                    logger.warning,
+                    {
+                        "operation_id": operation.id,
+                        "type": Route.route_type,
+                        "message": "renewal stopped running, marking it failed",
+                    },
+                )
+                fail_operation(session, operation, Route.route_type)
+
+
+def count_in_progress(Route) -> int:
+    Operation = {CdnRoute: CdnOperation, DomainRoute: DomainOperation}[Route]
+    # only ever touch the broker being scanned, so one slow or unreachable
+    # database doesn't stall the other broker's scan
     with SessionHandler() as session:
-        for Route in (CdnRoute, DomainRoute):
-            routes.extend(Route.find_active_instances(session))
-        for route in routes:
-            if route.needs_renewal:
-                queue_all_tasks(route, session)
-
-
-def queue_all_tasks(route, session):
-    json_log(
-        logger.info,
-        {
-            "instance_id": route.instance_id,
-            "type": route.route_type,
-            "message": "queuing renewal",
-        },
-    )
-    if isinstance(route, DomainRoute):
+        return Operation.count_in_progress(session)
+
+
+def renew_certs_for(Route, dispatcher: RenewalDispatcher):
+    with SessionHandler() as session:
+        if not Route.has_renewal_candidates(session):
+            json_log(
+                logger.info,
+                {"type": Route.route_type, "message": "no routes need renewal"},
+            )
+            return
+        for route_ids in Route.iter_renewal_candidate_ids(
+            session, config.SCAN_CHUNK_SIZE
+        ):
+            # each chunk is its own query, so give the connection back while
+            # the dispatcher may be paused
+            session.close()
+            delays = dispatcher.wait_for_capacity(
+                len(route_ids), partial(count_in_progress, Route)
+            )
+            queue_all_tasks(Route, route_ids[: len(delays)], session, delays)
+            if len(delays) < len(route_ids):
+                json_log(
+                    logger.info,
+                    {
+                        "type": Route.route_type,
+                        "message": "leaving remaining renewals for the next scan",
+                    },
+                )
+                return
+
+
+def queue_all_tasks(Route, route_ids, session, delays):
+    if Route is DomainRoute:
         get_renewal_pipeline = get_domain_renewal_pipeline
-    elif isinstance(route, CdnRoute):
+    elif Route is CdnRoute:
         get_renewal_pipeline = get_cdn_renewal_pipeline
     else:
-        raise NotImplementedError(
-            f"Expected one of DomainRoute, CdnRoute, got {type(route)}"
+        raise NotImplementedError(f"Expected one of DomainRoute, CdnRoute, got {Route}")
+    # the scan skips routes with an operation in progress, but a pipeline
+    # could have started since, so take each route's lease before queuing it
+    delays = {
+        route_id: delay
+        for route_id, delay in zip(route_ids, delays)
+        if leases.claim(Route.route_type, route_id)
+    }
+    try:
+        rows = Route.create_renewal_operations(session, list(delays))
+    except Exception:
+        # without operations nothing would release these until they expire,
+        # and the routes would miss renewal scans until then
+        for route_id in delays:
+            leases.release_unassigned(Route.route_type, route_id)
+        raise
+    for route_id, operation_id in rows:
+        leases.assign(Route.route_type, route_id, operation_id)
+        delay = delays[route_id]
+        json_log(
+            logger.info,
+            {
+                "route_id": route_id,
+                "type": Route.route_type,
+                "operation_id": operation_id,
+                "message": "queuing renewal",
+            },
         )
-    pipeline = get_renewal_pipeline(route, session)
-    huey.enqueue(pipeline)
+        huey.enqueue(get_renewal_pipeline(operation_id, delay=delay))
 
 
-def get_domain_renewal_pipeline(alb_route: DomainRoute, session):
-    operation = alb_route.create_renewal_operation()
-    session.add(operation)
-    session.commit()
+def get_domain_renewal_pipeline(operation_id: int, delay: Optional[float] = None):
+    route_type = RouteType.ALB
     pipeline = (
-        letsencrypt.create_user.s(operation.id, alb_route.route_type)
-        .then(
-            letsencrypt.create_private_key_and_csr, operation.id, alb_route.route_type
-        )
-        .then(letsencrypt.initiate_challenges, operation.id, alb_route.route_type)
-        .then(s3.upload_challenge_files, operation.id, alb_route.route_type)
-        .then(letsencrypt.answer_challenges, operation.id, alb_route.route_type)
-        .then(letsencrypt.retrieve_certificate, operation.id, alb_route.route_type)
-        .then(iam.upload_certificate, operation.id, alb_route.route_type)
-        .then(alb.associate_certificate, operation.id, alb_route.route_type)
-        .then(alb.remove_old_certificate, operation.id, alb_route.route_type)
-        .then(alb.wait_for_cert_update, operation.id, alb_route.route_type)
-        .then(iam.delete_old_certificate, operation.id, alb_route.route_type)
-        .then(update_operations.mark_complete, operation.id, alb_route.route_type)
+        letsencrypt.create_user.s(operation_id, route_type, delay=delay)
+        .then(letsencrypt.create_private_key_and_csr, operation_id, route_type)
+        .then(letsencrypt.initiate_challenges, operation_id, route_type)
+        .then(s3.upload_challenge_files, operation_id, route_type)
+        .then(letsencrypt.answer_challenges, operation_id, route_type)
+        .then(letsencrypt.finalize_order, operation_id, route_type)
+        .then(letsencrypt.retrieve_certificate, operation_id, route_type)
+        .then(iam.upload_certificate, operation_id, route_type)
+        .then(alb.associate_certificate, operation_id, route_type)
+        .then(alb.remove_old_certificate, operation_id, route_type)
+        .then(alb.wait_for_cert_update, operation_id, route_type)
+        .then(iam.delete_old_certificate, operation_id, route_type)
+        .then(update_operations.mark_complete, operation_id, route_type)
+        .then(s3.delete_challenge_files, operation_id, route_type)
     )
     return pipeline
 
 
-def get_cdn_renewal_pipeline(cdn_route: CdnRoute, session):
-    operation = cdn_route.create_renewal_operation()
-    session.add(operation)
-    session.commit()
+def get_cdn_renewal_pipeline(operation_id: int, delay: Optional[float] = None):
+    route_type = RouteType.CDN
     pipeline = (
-        letsencrypt.create_user.s(operation.id, cdn_route.route_type)
-        .then(
-            letsencrypt.create_private_key_and_csr, operation.id, cdn_route.route_type
-        )
-        .then(letsencrypt.initiate_challenges, operation.id, cdn_route.route_type)
-        .then(s3.upload_challenge_files, operation.id, cdn_route.route_type)
-        .then(letsencrypt.answer_challenges, operation.id, cdn_route.route_type)
-        .then(letsencrypt.retrieve_certificate, operation.id, cdn_route.route_type)
-        .then(iam.upload_certificate, operation.id, cdn_route.route_type)
-        .then(cdn.associate_certificate, operation.id, cdn_route.route_type)
-        .then(cdn.wait_for_distribution, operation.id, cdn_route.route_type)
-        .then(iam.delete_old_certificate, operation.id, cdn_route.route_type)
-        .then(update_operations.mark_complete, operation.id, cdn_route.route_type)
+        letsencrypt.create_user.s(operation_id, route_type, delay=delay)
+        .then(letsencrypt.create_private_key_and_csr, operation_id, route_type)
+        .then(letsencrypt.initiate_challenges, operation_id, route_type)
+        .then(s3.upload_challenge_files, operation_id, route_type)
+        .then(letsencrypt.answer_challenges, operation_id, route_type)
+        .then(letsencrypt.finalize_order, operation_id, route_type)
+        .then(letsencrypt.retrieve_certificate, operation_id, route_type)
+        .then(iam.upload_certificate, operation_id, route_type)
+        .then(cdn.associate_certificate, operation_id, route_type)
+        .then(cdn.wait_for_distribution, operation_id, route_type)
+        .then(iam.delete_old_certificate, operation_id, route_type)
+        .then(update_operations.mark_complete, operation_id, route_type)
+        .then(s3.delete_challenge_files, operation_id, route_type)
     )
     return pipeline
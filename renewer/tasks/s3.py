@@ -1,43 +1,304 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import logging
 import time
-from typing import Type, Union
+from typing import List, Optional, Type, Union
+
+from botocore.exceptions import BotoCoreError, ClientError
+from huey import crontab
 
 from renewer.aws import s3_commercial, s3_govcloud
 from renewer.models.cdn import CdnOperation, CdnChallenge, CdnCertificate
 from renewer.models.domain import DomainOperation, DomainChallenge, DomainCertificate
 from renewer.extensions import config
-from renewer.huey import retriable_task
+from renewer.json_log import json_log
+from renewer.huey import huey, nonretriable_task, retriable_task
 from renewer.models.common import RouteType
 
+logger = logging.getLogger(__name__)
 
 TOperation = Type[Union[DomainOperation, CdnOperation]]
 TCertificate = Type[Union[DomainCertificate, CdnCertificate]]
 TChallenge = Type[Union[DomainChallenge, CdnChallenge]]
 
+CHALLENGE_PREFIX = ".well-known/acme-challenge/"
+# the most keys S3 takes in one delete_objects request
+DELETE_BATCH_SIZE = 1000
+
+
+def s3_for(route_type: RouteType):
+    """returns the S3 client and challenge bucket for a route type"""
+    if route_type is RouteType.ALB:
+        return s3_govcloud, config.GOVCLOUD_BUCKET
+    elif route_type is RouteType.CDN:
+        return s3_commercial, config.COMMERCIAL_BUCKET
+    raise ValueError(f"unknown route type {route_type}")
+
 
 @retriable_task
 def upload_challenge_files(session, operation_id, route_type):
     Operation: TOperation
     if route_type is RouteType.ALB:
         Operation = DomainOperation
-        s3 = s3_govcloud
-        bucket = config.GOVCLOUD_BUCKET
     elif route_type is RouteType.CDN:
         Operation = CdnOperation
-        s3 = s3_commercial
-        bucket = config.COMMERCIAL_BUCKET
+    s3, bucket = s3_for(route_type)
     operation = session.query(Operation).get(operation_id)
     certificate = operation.certificate
-    for challenge in certificate.challenges:
-        if not challenge.answered:
-            path = challenge.validation_path
-            if path[0] == "/":
-                # including the leading slash breaks these objects by causing a double-slash in the url
-                path = path[1:]
-            s3.put_object(
-                Bucket=bucket,
-                Body=challenge.validation_contents.encode(),
-                Key=path,
-                ServerSideEncryption="AES256",
+    # answered challenges are either done or were pre-authorized by the CA
+    unanswered = [c for c in certificate.challenges if not c.answered]
+    if not unanswered:
+        return
+
+    def upload(challenge):
+        s3.put_object(
+            Bucket=bucket,
+            Body=challenge.validation_contents.encode(),
+            Key=challenge_key(challenge),
+            ServerSideEncryption="AES256",
+        )
+
+    # the client retries each object on its own, so a flaky upload doesn't
+    # cost us the others. We only fail the task once every upload is done
+    # and one of them ran out of attempts
+    failures = []
+    workers = min(config.S3_MAX_CONCURRENT_UPLOADS, len(unanswered))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(upload, challenge): challenge for challenge in unanswered
+        }
+        for future, challenge in futures.items():
+            e = future.exception()
+            if e is not None:
+                json_log(
+                    logger.error,
+                    {
+                        "instance_id": operation.route.instance_id,
+                        "type": route_type,
+                        "domain": challenge.domain,
+                        "error": str(e),
+                        "message": "failed to upload challenge file",
+                    },
+                )
+                failures.append(e)
+            else:
+                challenge.uploaded = True
+    # remember what's in the bucket, so we only clean up what we put there
+    session.commit()
+    if failures:
+        raise failures[0]
+    # make sure the files will be in S3 when the CA asks for them
+    keys = [challenge_key(challenge) for challenge in unanswered]
+    if not wait_for_challenge_files(s3, bucket, keys):
+        json_log(
+            logger.warning,
+            {
+                "instance_id": operation.route.instance_id,
+                "type": route_type,
+                "message": "challenge files not visible yet, continuing anyway",
+            },
+        )
+
+
+def challenge_key(challenge) -> str:
+    path = challenge.validation_path
+    if path[0] == "/":
+        # including the leading slash breaks these objects by causing a double-slash in the url
+        path = path[1:]
+    return path
+
+
+def wait_for_challenge_files(s3, bucket, keys) -> bool:
+    """
+    check the challenge files with HEAD requests, backing off between
+    rounds, until S3 serves all of them. S3_PROPAGATION_TIME is the most we
+    wait. Returns whether every file showed up in time
+    """
+    if config.S3_PROPAGATION_TIME <= 0:
+        return True
+    deadline = time.monotonic() + config.S3_PROPAGATION_TIME
+    delay = config.S3_PROBE_INITIAL_DELAY_SECONDS
+    waiting = list(keys)
+    while True:
+        # a file we can't see yet might still show up, so keep asking about
+        # those too, until the deadline
+        waiting = [key for key in waiting if object_exists(s3, bucket, key) is not True]
+        if not waiting:
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, config.S3_PROBE_MAX_DELAY_SECONDS)
+
+
+def object_exists(s3, bucket, key) -> Optional[bool]:
+    """
+    whether S3 serves the object, or None if it won't tell us: without
+    s3:ListBucket, S3 answers a missing object with a 403 rather than a 404
+    """
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        code = e.response["Error"]["Code"]
+        if code in ("404", "NoSuchKey", "NotFound"):
+            return False
+        if code in ("403", "AccessDenied", "Forbidden"):
+            json_log(
+                logger.warning,
+                {
+                    "bucket": bucket,
+                    "key": key,
+                    "message": "not allowed to check for challenge file",
+                },
+            )
+            return None
+        raise
+    return True
+
+
+@nonretriable_task
+def delete_challenge_files(session, operation_id, route_type):
+    """
+    once the certificate is issued, the CA won't look at our challenge
+    files again, so remove them from the bucket. This runs after the
+    operation is complete and only tidies up, so if S3 won't let us, we
+    leave the files to sweep_all_challenge_files rather than fail
+    """
+    Operation: TOperation
+    if route_type is RouteType.ALB:
+        Operation = DomainOperation
+    elif route_type is RouteType.CDN:
+        Operation = CdnOperation
+    s3, bucket = s3_for(route_type)
+    operation = session.query(Operation).get(operation_id)
+    # pre-authorized domains never had a file uploaded
+    challenges = operation.certificate.challenges.filter_by(uploaded=True).all()
+    # the object bodies are the validation contents, so we know their size
+    # without asking S3
+    sizes = {
+        challenge_key(challenge): len(challenge.validation_contents.encode())
+        for challenge in challenges
+    }
+    try:
+        deleted = delete_keys(s3, bucket, list(sizes))
+    except (BotoCoreError, ClientError) as e:
+        json_log(
+            logger.warning,
+            {
+                "instance_id": operation.route.instance_id,
+                "type": route_type,
+                "error": str(e),
+                "message": "failed to delete challenge files, leaving them",
+            },
+        )
+        return
+    json_log(
+        logger.info,
+        {
+            "instance_id": operation.route.instance_id,
+            "type": route_type,
+            "objects": len(deleted),
+            "bytes": sum(sizes[key] for key in deleted),
+            "message": "deleted challenge files",
+        },
+    )
+
+
+@huey.periodic_task(crontab(month="*", day="*", hour="3", minute="0"))
+def sweep_all_challenge_files():
+    """
+    delete challenge files older than S3_CHALLENGE_MAX_AGE_HOURS. This
+    catches files from pipelines that failed before cleaning up, and
+    everything written before we cleaned up at all.
+
+    Listing the bucket needs s3:ListBucket, which the renewer's credentials
+    may not have. Without it we log the error and leave the files, and
+    still sweep the other buckets
+    """
+    if not config.RUN_RENEWALS:
+        return
+    for route_type in RouteType:
+        s3, bucket = s3_for(route_type)
+        try:
+            objects, size = sweep_challenge_files(s3, bucket)
+        except ClientError as e:
+            json_log(
+                logger.error,
+                {
+                    "type": route_type,
+                    "bucket": bucket,
+                    "error": e.response["Error"].get("Code"),
+                    "message": "failed to sweep challenge files",
+                },
+            )
+            continue
+        json_log(
+            logger.info,
+            {
+                "type": route_type,
+                "objects": objects,
+                "bytes": size,
+                "message": "swept challenge files",
+            },
+        )
+
+
+def sweep_challenge_files(s3, bucket):
+    """
+    list the challenge prefix, deleting old files a batch at a time as we
+    go. Returns how many objects and bytes were deleted
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(
+        hours=config.S3_CHALLENGE_MAX_AGE_HOURS
+    )
+    objects = 0
+    size = 0
+    batch: dict = {}
+
+    def flush():
+        nonlocal objects, size
+        deleted = delete_keys(s3, bucket, list(batch))
+        objects += len(deleted)
+        size += sum(batch[key] for key in deleted)
+        batch.clear()
+
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=CHALLENGE_PREFIX):
+        for obj in page.get("Contents", []):
+            if obj["LastModified"] < cutoff:
+                batch[obj["Key"]] = obj["Size"]
+                if len(batch) == DELETE_BATCH_SIZE:
+                    flush()
+    if batch:
+        flush()
+    return objects, size
+
+
+def delete_keys(s3, bucket, keys) -> List[str]:
+    """
+    delete keys with delete_objects, DELETE_BATCH_SIZE at a time. Keys S3
+    refuses to delete are logged and left for the sweeper. Returns the keys
+    that were deleted
+    """
+    deleted: List[str] = []
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[start : start + DELETE_BATCH_SIZE]
+        response = s3.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+        )
+        # in quiet mode, S3 only tells us about the keys it didn't delete
+        errors = {error["Key"]: error for error in response.get("Errors", [])}
+        for key, error in errors.items():
+            json_log(
+                logger.warning,
+                {
+                    "bucket": bucket,
+                    "key": key,
+                    "error": error.get("Code"),
+                    "message": "failed to delete challenge file",
+                },
             )
-    # sleep to make sure the file will be in S3 when we want it
-    time.sleep(config.S3_PROPAGATION_TIME)
+        deleted.extend(key for key in batch if key not in errors)
+    return deleted
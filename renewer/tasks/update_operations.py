@@ -1,4 +1,4 @@
-from renewer.huey import retriable_task
+from renewer.huey import leases, retriable_task
 from renewer.models.common import RouteType, OperationState
 from renewer.models.cdn import CdnOperation
 from renewer.models.domain import DomainOperation
@@ -14,3 +14,4 @@ def mark_complete(session, operation_id, route_type: RouteType):
     operation.state = OperationState.SUCCEEDED.value
     session.add(operation)
     session.commit()
+    leases.release(route_type, operation.route_key, operation.id)
@@ -53,7 +53,7 @@ def test_backport_all_certs(clean_db, alb, iam_govcloud, immediate_huey):
     assert cert.iam_server_certificate_name == "cf-domains-renew-me-2021-03-12_12-34-12"
 
 
-def test_no_error_when_no_backport(clean_db, alb, iam_govcloud, immediate_huey):
+def test_backport_skips_known_certs(clean_db, alb, iam_govcloud, immediate_huey):
     # make a route
     proxy = DomainAlbProxy()
     proxy.alb_arn = "arn:aws:alb:123"
@@ -80,6 +80,133 @@ def test_no_error_when_no_backport(clean_db, alb, iam_govcloud, immediate_huey):
     )
     clean_db.expunge_all()
 
-    # function we're actually testing
-    # the test here is just that it doesn't blow up
-    migrations.backport_cert("renew-me")
+    # we already know the only cert on the listener, so there's nothing to
+    # look up in IAM
+    migrations.backport_all_manual_certs()
+
+    assert clean_db.query(DomainCertificate).count() == 1
+
+
+def test_backport_lists_each_listener_once(clean_db, alb, iam_govcloud, immediate_huey):
+    proxy = DomainAlbProxy()
+    proxy.alb_arn = "arn:aws:alb:123"
+    proxy.alb_dns_name = "example.com"
+    proxy.listener_arn = "arn:aws:listener:123"
+    clean_db.add(proxy)
+    for instance_id in ["first-route", "second-route"]:
+        route = DomainRoute()
+        route.state = "provisioned"
+        route.instance_id = instance_id
+        route.alb_proxy_arn = "arn:aws:alb:123"
+        clean_db.add(route)
+    clean_db.commit()
+
+    arns = [
+        f"arn:aws:iam:1234:server-certificate/domains/local/cf-domains-{instance_id}-2021-03-12_12-34-12"
+        for instance_id in ["first-route", "second-route"]
+    ]
+    alb.expect_listener_certificates("arn:aws:listener:123", arns)
+    for arn in arns:
+        iam_govcloud.expect_get_server_certificate(
+            arn.split("/")[-1],
+            datetime.strptime("2021-03-12T12:34:12Z", "%Y-%m-%dT%H:%M:%SZ"),
+        )
+
+    migrations.backport_all_manual_certs()
+
+    clean_db.expunge_all()
+    for instance_id, arn in zip(["first-route", "second-route"], arns):
+        route = clean_db.query(DomainRoute).filter_by(instance_id=instance_id).one()
+        assert [c.iam_server_certificate_arn for c in route.certificates] == [arn]
+
+    # nothing changed on the listener, so we don't look at the database this
+    # time, and don't notice a backported row went missing
+    clean_db.query(DomainCertificate).filter_by(route_guid="first-route").delete()
+    clean_db.commit()
+    alb.expect_listener_certificates("arn:aws:listener:123", arns)
+
+    migrations.backport_all_manual_certs()
+
+    clean_db.expunge_all()
+    assert [
+        c.iam_server_certificate_arn for c in clean_db.query(DomainCertificate)
+    ] == [arns[1]]
+
+
+def test_backport_takes_the_newest_unknown_cert_per_route(
+    clean_db, alb, iam_govcloud, immediate_huey
+):
+    proxy = DomainAlbProxy()
+    proxy.alb_arn = "arn:aws:alb:123"
+    proxy.alb_dns_name = "example.com"
+    proxy.listener_arn = "arn:aws:listener:123"
+    route = DomainRoute()
+    route.state = "provisioned"
+    route.instance_id = "renew-me"
+    route.alb_proxy_arn = "arn:aws:alb:123"
+    clean_db.add(proxy)
+    clean_db.add(route)
+    clean_db.commit()
+
+    dates = ["2021-01-12_12-34-12", "2021-03-12_12-34-12"]
+    arns = [
+        f"arn:aws:iam:1234:server-certificate/domains/local/cf-domains-renew-me-{date}"
+        for date in dates
+    ]
+    alb.expect_listener_certificates("arn:aws:listener:123", arns)
+    for arn, date in zip(arns, dates):
+        iam_govcloud.expect_get_server_certificate(
+            arn.split("/")[-1], datetime.strptime(date, "%Y-%m-%d_%H-%M-%S")
+        )
+
+    migrations.backport_all_manual_certs()
+
+    clean_db.expunge_all()
+    route = clean_db.query(DomainRoute).filter_by(instance_id="renew-me").one()
+    assert [c.iam_server_certificate_arn for c in route.certificates] == [arns[1]]
+
+
+def test_backport_looks_again_at_listeners_with_routes_still_provisioning(
+    clean_db, alb, iam_govcloud, immediate_huey
+):
+    proxy = DomainAlbProxy()
+    proxy.alb_arn = "arn:aws:alb:123"
+    proxy.alb_dns_name = "example.com"
+    proxy.listener_arn = "arn:aws:listener:123"
+    clean_db.add(proxy)
+    for instance_id, state in [("ready", "provisioned"), ("not-yet", "provisioning")]:
+        route = DomainRoute()
+        route.state = state
+        route.instance_id = instance_id
+        route.alb_proxy_arn = "arn:aws:alb:123"
+        clean_db.add(route)
+    clean_db.commit()
+
+    arns = [
+        f"arn:aws:iam:1234:server-certificate/domains/local/cf-domains-{instance_id}-2021-03-12_12-34-12"
+        for instance_id in ["ready", "not-yet"]
+    ]
+    alb.expect_listener_certificates("arn:aws:listener:123", arns)
+    iam_govcloud.expect_get_server_certificate(
+        arns[0].split("/")[-1],
+        datetime.strptime("2021-03-12T12:34:12Z", "%Y-%m-%dT%H:%M:%SZ"),
+    )
+
+    migrations.backport_all_manual_certs()
+
+    # the second route finishes provisioning, and the listener is unchanged
+    route = clean_db.query(DomainRoute).filter_by(instance_id="not-yet").one()
+    route.state = "provisioned"
+    clean_db.commit()
+    alb.expect_listener_certificates("arn:aws:listener:123", arns)
+    iam_govcloud.expect_get_server_certificate(
+        arns[1].split("/")[-1],
+        datetime.strptime("2021-03-12T12:34:12Z", "%Y-%m-%dT%H:%M:%SZ"),
+    )
+
+    migrations.backport_all_manual_certs()
+
+    clean_db.expunge_all()
+    assert sorted(
+        c.iam_server_certificate_arn for c in clean_db.query(DomainCertificate)
+    ) == sorted(arns)
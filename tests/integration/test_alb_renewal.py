@@ -1,9 +1,16 @@
 from datetime import date, datetime, timedelta
 import json
+import threading
 import uuid
 
+from cryptography import x509
+from cryptography.hazmat.primitives.asymmetric import ec
 import pytest
 
+from renewer.acme_client import AcmeClient
+from renewer.extensions import config
+from renewer.huey import huey, leases, redis_client
+from renewer.models.common import RouteType
 from renewer.models.domain import (
     DomainAlbProxy,
     DomainOperation,
@@ -19,6 +26,7 @@ from renewer.tasks import update_operations
 
 from tests.lib.fake_iam import FakeIAM
 from tests.lib.alb_fixtures import make_cert, make_route
+from tests.lib.tasks import run_until_done
 
 
 def make_route_for_user(user, state: str = "provisioned"):
@@ -171,6 +179,85 @@ def test_answer_challenges(clean_db, alb_route: DomainRoute, immediate_huey):
     assert all([c.answered for c in certificate.challenges])
 
 
+def start_challenges(clean_db, route: DomainRoute) -> int:
+    operation = route.create_renewal_operation()
+    clean_db.add(route)
+    clean_db.add(operation)
+    clean_db.commit()
+    operation_id = operation.id
+    letsencrypt.create_user(operation_id, route.route_type)
+    letsencrypt.create_private_key_and_csr(operation_id, route.route_type)
+    letsencrypt.initiate_challenges(operation_id, route.route_type)
+    return operation_id
+
+
+def test_answers_every_domain_at_once(clean_db, proxy, immediate_huey, monkeypatch):
+    domains = ["a.example.com", "b.example.com", "c.example.com"]
+    route = make_route(clean_db, proxy, "many-domains", domains)
+    operation_id = start_challenges(clean_db, route)
+    monkeypatch.setattr(config, "ACME_MAX_CONCURRENT_DOMAINS", len(domains))
+
+    # each answer waits for all of the others, so this only gets through if
+    # every domain is answered at the same time
+    barrier = threading.Barrier(len(domains), timeout=10)
+    answer_challenge = AcmeClient.answer_challenge
+
+    def answer_together(self, challb, response):
+        barrier.wait()
+        return answer_challenge(self, challb, response)
+
+    monkeypatch.setattr(AcmeClient, "answer_challenge", answer_together)
+
+    letsencrypt.answer_challenges(operation_id, route.route_type)
+    clean_db.expunge_all()
+
+    operation = clean_db.query(DomainOperation).get(operation_id)
+    challenges = operation.certificate.challenges.all()
+    assert sorted(c.domain for c in challenges) == domains
+    assert all(c.answered for c in challenges)
+
+
+def test_one_failing_domain_does_not_stop_the_others(
+    clean_db, proxy, immediate_huey, monkeypatch
+):
+    domains = ["a.example.com", "b.example.com", "c.example.com"]
+    route = make_route(clean_db, proxy, "one-bad-domain", domains)
+    operation_id = start_challenges(clean_db, route)
+    operation = clean_db.query(DomainOperation).get(operation_id)
+    challenges = operation.certificate.challenges.all()
+    urls = {c.domain: json.loads(c.body_json)["url"] for c in challenges}
+    failing = {
+        urls[domain]: RuntimeError(f"{domain} failed")
+        for domain in ["b.example.com", "c.example.com"]
+    }
+    # failures are raised in the order the challenges were answered in
+    first_failure = next(
+        failing[urls[c.domain]] for c in challenges if urls[c.domain] in failing
+    )
+    answer_challenge = AcmeClient.answer_challenge
+
+    def answer_or_fail(self, challb, response):
+        if challb.uri in failing:
+            raise failing[challb.uri]
+        return answer_challenge(self, challb, response)
+
+    monkeypatch.setattr(AcmeClient, "answer_challenge", answer_or_fail)
+
+    with pytest.raises(RuntimeError) as e:
+        letsencrypt.answer_challenges(operation_id, route.route_type)
+    assert e.value is first_failure
+    clean_db.expunge_all()
+
+    # the domain that went through is remembered, so the retry skips it
+    operation = clean_db.query(DomainOperation).get(operation_id)
+    answered = {c.domain: c.answered for c in operation.certificate.challenges}
+    assert answered == {
+        "a.example.com": True,
+        "b.example.com": False,
+        "c.example.com": False,
+    }
+
+
 def test_retrieve_certificate(clean_db, alb_route: DomainRoute, immediate_huey):
     instance_id = alb_route.instance_id
     operation = alb_route.create_renewal_operation()
@@ -184,7 +271,8 @@ def test_retrieve_certificate(clean_db, alb_route: DomainRoute, immediate_huey):
     letsencrypt.initiate_challenges(operation_id, alb_route.route_type)
     letsencrypt.answer_challenges(operation_id, alb_route.route_type)
 
-    letsencrypt.retrieve_certificate(operation_id, alb_route.route_type)
+    run_until_done(letsencrypt.finalize_order, operation_id, alb_route.route_type)
+    run_until_done(letsencrypt.retrieve_certificate, operation_id, alb_route.route_type)
     clean_db.expunge_all()
 
     operation = clean_db.query(DomainOperation).get(operation_id)
@@ -195,6 +283,30 @@ def test_retrieve_certificate(clean_db, alb_route: DomainRoute, immediate_huey):
     assert json.loads(certificate.order_json)["body"]["status"] == "valid"
 
 
+def test_retrieve_ecdsa_certificate(
+    clean_db, alb_route: DomainRoute, immediate_huey, monkeypatch
+):
+    monkeypatch.setattr(config, "ALB_CERTIFICATE_KEY_TYPE", "ecdsa")
+    operation = alb_route.create_renewal_operation()
+    clean_db.add(alb_route)
+    clean_db.add(operation)
+    clean_db.commit()
+    operation_id = operation.id
+    letsencrypt.create_user(operation_id, alb_route.route_type)
+    letsencrypt.create_private_key_and_csr(operation_id, alb_route.route_type)
+    letsencrypt.initiate_challenges(operation_id, alb_route.route_type)
+    letsencrypt.answer_challenges(operation_id, alb_route.route_type)
+
+    run_until_done(letsencrypt.finalize_order, operation_id, alb_route.route_type)
+    run_until_done(letsencrypt.retrieve_certificate, operation_id, alb_route.route_type)
+    clean_db.expunge_all()
+
+    certificate = clean_db.query(DomainOperation).get(operation_id).certificate
+    leaf = x509.load_pem_x509_certificate(certificate.leaf_pem.encode())
+    assert isinstance(leaf.public_key(), ec.EllipticCurvePublicKey)
+    assert isinstance(leaf.public_key().curve, ec.SECP256R1)
+
+
 def test_upload_cert_to_iam(
     clean_db, alb_route: DomainRoute, immediate_huey, iam_govcloud
 ):
@@ -392,6 +504,70 @@ def test_remove_old_cert_without_arn(
     clean_db.expunge_all()
 
 
+def test_waits_for_listener_to_swap_certificates(
+    clean_db, alb_route: DomainRoute, immediate_huey, alb
+):
+    operation = alb_route.create_renewal_operation()
+    now = datetime.now()
+    today = date.today()
+    new_certificate = make_cert(
+        clean_db, alb_route, now + timedelta(days=90), today, False
+    )
+    old_certificate = make_cert(
+        clean_db, alb_route, now + timedelta(days=30), today - timedelta(days=60)
+    )
+    new_certificate.route = alb_route
+    old_certificate.route = alb_route
+    operation.certificate = new_certificate
+    clean_db.add_all([operation, new_certificate, old_certificate, alb_route])
+    clean_db.commit()
+    new_arn = new_certificate.iam_server_certificate_arn
+    old_arn = old_certificate.iam_server_certificate_arn
+
+    # the new certificate shows up before the old one goes away
+    alb.expect_listener_certificates("arn:aws:listener:1234", [old_arn])
+    alb.expect_listener_certificates("arn:aws:listener:1234", [old_arn, new_arn])
+    alb.expect_listener_certificates("arn:aws:listener:1234", [new_arn])
+
+    run_until_done(alb_tasks.wait_for_cert_update, operation.id, alb_route.route_type)
+
+
+def test_waits_only_for_the_removed_certificate(
+    clean_db, alb_route: DomainRoute, immediate_huey, alb
+):
+    operation = alb_route.create_renewal_operation()
+    now = datetime.now()
+    today = date.today()
+    new_certificate = make_cert(
+        clean_db, alb_route, now + timedelta(days=90), today, False
+    )
+    old_certificate = make_cert(
+        clean_db, alb_route, now + timedelta(days=30), today - timedelta(days=60)
+    )
+    older_certificate = make_cert(
+        clean_db, alb_route, now + timedelta(days=10), today - timedelta(days=80)
+    )
+    for certificate in [new_certificate, old_certificate, older_certificate]:
+        certificate.route = alb_route
+    operation.certificate = new_certificate
+    clean_db.add_all(
+        [operation, new_certificate, old_certificate, older_certificate, alb_route]
+    )
+    clean_db.commit()
+
+    # remove_old_certificate only took off the newest old certificate, so an
+    # older one still on the listener isn't ours to wait for
+    alb.expect_listener_certificates(
+        "arn:aws:listener:1234",
+        [
+            older_certificate.iam_server_certificate_arn,
+            new_certificate.iam_server_certificate_arn,
+        ],
+    )
+
+    alb_tasks.wait_for_cert_update.call_local(operation.id, alb_route.route_type)
+
+
 def test_delete_old_certificate_without_name(
     clean_db, alb_route: DomainRoute, iam_govcloud: FakeIAM, immediate_huey
 ):
@@ -511,3 +687,136 @@ def test_queues_all_renewals(clean_db, clean_huey, proxy, tasks):
     assert len(doesnt_need_renewal.operations.all()) == 0
     assert len(inactive.operations.all()) == 0
     assert task.args[0] == ops[0].id
+
+
+def test_does_not_queue_renewal_for_route_with_operation_in_progress(
+    clean_db, clean_huey, proxy
+):
+    now = datetime.now()
+    today = date.today()
+    route = make_route(clean_db, proxy, "in-progress", ["example.com"])
+    cert = make_cert(
+        clean_db, route, now + timedelta(days=30), today - timedelta(days=60)
+    )
+    operation = route.create_renewal_operation()
+    clean_db.add_all([route, cert, operation])
+    clean_db.commit()
+
+    renewals.renew_all_certs()
+
+    route = clean_db.query(DomainRoute).get(route.instance_id)
+    assert len(route.operations.all()) == 1
+    assert clean_huey.pending_count() == 0
+
+
+def test_does_not_queue_renewal_for_route_with_lease_held(clean_db, clean_huey, proxy):
+    now = datetime.now()
+    today = date.today()
+    route = make_route(clean_db, proxy, "leased", ["example.com"])
+    cert = make_cert(
+        clean_db, route, now + timedelta(days=30), today - timedelta(days=60)
+    )
+    clean_db.add_all([route, cert])
+    clean_db.commit()
+    assert leases.claim(route.route_type, route.instance_id)
+
+    renewals.renew_all_certs()
+
+    route = clean_db.query(DomainRoute).get(route.instance_id)
+    assert len(route.operations.all()) == 0
+    assert clean_huey.pending_count() == 0
+
+
+def test_failing_to_create_operations_releases_leases(
+    clean_db, clean_huey, proxy, monkeypatch
+):
+    route = make_route(clean_db, proxy, "unlucky", ["example.com"])
+    clean_db.add(route)
+    clean_db.commit()
+
+    def fail(session, ids):
+        raise RuntimeError("database went away")
+
+    monkeypatch.setattr(DomainRoute, "create_renewal_operations", fail)
+
+    with pytest.raises(RuntimeError):
+        renewals.queue_all_tasks(DomainRoute, [route.instance_id], clean_db, [0])
+
+    assert leases.claim(route.route_type, route.instance_id)
+    assert clean_huey.pending_count() == 0
+
+
+def test_marking_operation_complete_releases_lease(
+    clean_db, alb_route: DomainRoute, immediate_huey
+):
+    operation = alb_route.create_renewal_operation()
+    clean_db.add(operation)
+    clean_db.commit()
+    leases.claim(alb_route.route_type, alb_route.instance_id)
+    leases.assign(alb_route.route_type, alb_route.instance_id, operation.id)
+
+    update_operations.mark_complete(operation.id, alb_route.route_type)
+
+    assert leases.claim(alb_route.route_type, alb_route.instance_id)
+
+
+def test_pipeline_tasks_extend_their_lease(
+    clean_db, alb_route: DomainRoute, immediate_huey
+):
+    operation = alb_route.create_renewal_operation()
+    clean_db.add(operation)
+    clean_db.commit()
+    leases.claim(alb_route.route_type, alb_route.instance_id)
+    leases.assign(alb_route.route_type, alb_route.instance_id, operation.id)
+    key = leases.key(alb_route.route_type, alb_route.instance_id)
+    redis_client.expire(key, 5)
+
+    @huey.task(name="pipeline_task_extending_lease")
+    def pipeline_task(operation_id, route_type):
+        pass
+
+    pipeline_task(operation.id, alb_route.route_type)
+
+    assert redis_client.ttl(key) > 5
+
+
+def test_old_operation_in_progress_still_blocks_renewal(clean_db, clean_huey, proxy):
+    now = datetime.now()
+    today = date.today()
+    route = make_route(clean_db, proxy, "slow", ["example.com"])
+    cert = make_cert(
+        clean_db, route, now + timedelta(days=30), today - timedelta(days=60)
+    )
+    operation = route.create_renewal_operation()
+    operation.created_at = now - timedelta(days=3)
+    clean_db.add_all([route, cert, operation])
+    clean_db.commit()
+
+    renewals.renew_all_certs()
+
+    route = clean_db.query(DomainRoute).get(route.instance_id)
+    assert len(route.operations.all()) == 1
+    assert clean_huey.pending_count() == 0
+
+
+def test_fails_only_operations_that_lost_their_lease(clean_db, clean_huey, proxy):
+    started = datetime.now() - timedelta(days=3)
+    operations = {}
+    for instance_id in ["still-running", "died"]:
+        route = make_route(clean_db, proxy, instance_id, ["example.com"])
+        operation = route.create_renewal_operation()
+        operation.created_at = started
+        clean_db.add_all([route, operation])
+        clean_db.commit()
+        operations[instance_id] = operation.id
+    leases.claim(RouteType.ALB, "still-running")
+    leases.assign(RouteType.ALB, "still-running", operations["still-running"])
+
+    renewals.fail_abandoned_operations.call_local()
+
+    clean_db.expunge_all()
+    states = {
+        instance_id: clean_db.query(DomainOperation).get(operation_id).state
+        for instance_id, operation_id in operations.items()
+    }
+    assert states == {"still-running": "in progress", "died": "failed"}
@@ -1,8 +1,16 @@
-from datetime import date, datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 import json
+import logging
+import threading
 
+from acme import crypto_util, messages
+from botocore.exceptions import ClientError
+from cryptography import x509
+from cryptography.hazmat.primitives.asymmetric import ec
 import pytest
 
+from renewer import crypto_pool, huey
+from renewer.extensions import config
 from renewer.models.cdn import (
     CdnOperation,
     CdnRoute,
@@ -10,10 +18,12 @@ from renewer.models.cdn import (
     CdnCertificate,
     CdnChallenge,
 )
+from renewer.models.common import OperationState
 from renewer.tasks import cdn, iam, letsencrypt, s3, renewals, update_operations
 
 from tests.lib.fake_iam import FakeIAM
 from tests.lib.cdn_fixtures import make_route, make_cert
+from tests.lib.tasks import run_until_done
 
 
 def test_create_acme_user_when_none_exists(
@@ -24,12 +34,16 @@ def test_create_acme_user_when_none_exists(
     clean_db.add(cdn_route)
     clean_db.add(operation)
     clean_db.commit()
+    huey.key_pool.refill(cdn_route.route_type, config.ACME_ACCOUNT_KEY_TYPE, 1)
     letsencrypt.create_user(operation.id, cdn_route.route_type)
     clean_db.expunge_all()
 
     cdn_route = clean_db.query(CdnRoute).get(instance_id)
 
     assert cdn_route.acme_user_id is not None
+    # certificate keys are left for certificates
+    pooled = huey.key_pool.size(cdn_route.route_type, config.ACME_ACCOUNT_KEY_TYPE)
+    assert pooled == 1
 
 
 def test_create_private_key(clean_db, cdn_route: CdnRoute, immediate_huey):
@@ -51,6 +65,91 @@ def test_create_private_key(clean_db, cdn_route: CdnRoute, immediate_huey):
     assert "BEGIN CERTIFICATE REQUEST" in certificate.csr_pem
 
 
+def make_cert_with_key(session, route, private_key_created_at, domains):
+    private_key_pem = crypto_pool.generate_private_key_pem()
+    certificate = make_cert(
+        session, route, datetime.now() + timedelta(days=20), date.today()
+    )
+    certificate.private_key_pem = private_key_pem
+    certificate.private_key_created_at = private_key_created_at
+    certificate.csr_pem = crypto_util.make_csr(
+        private_key_pem.encode(), domains
+    ).decode("utf-8")
+    certificate.leaf_pem = "not checked here"
+    session.add(certificate)
+    session.commit()
+    return certificate
+
+
+def test_create_private_key_reuses_current_key(
+    clean_db, cdn_route: CdnRoute, immediate_huey, monkeypatch
+):
+    monkeypatch.setattr(config, "CERTIFICATE_REUSE_KEY", True)
+    key_created_at = datetime.now(timezone.utc) - timedelta(days=60)
+    old_certificate = make_cert_with_key(
+        clean_db, cdn_route, key_created_at, ["example.com", "www.example.com"]
+    )
+    operation = cdn_route.create_renewal_operation()
+    clean_db.add(operation)
+    clean_db.commit()
+    operation_id = operation.id
+
+    letsencrypt.create_private_key_and_csr(operation_id, cdn_route.route_type)
+    clean_db.expunge_all()
+
+    old_certificate = clean_db.query(CdnCertificate).get(old_certificate.id)
+    certificate = clean_db.query(CdnOperation).get(operation_id).certificate
+    assert certificate.id != old_certificate.id
+    assert certificate.private_key_pem == old_certificate.private_key_pem
+    assert certificate.csr_pem == old_certificate.csr_pem
+    assert certificate.private_key_created_at == key_created_at
+
+
+def test_create_private_key_makes_new_csr_when_domains_change(
+    clean_db, cdn_route: CdnRoute, immediate_huey, monkeypatch
+):
+    monkeypatch.setattr(config, "CERTIFICATE_REUSE_KEY", True)
+    key_created_at = datetime.now(timezone.utc) - timedelta(days=60)
+    old_certificate = make_cert_with_key(
+        clean_db, cdn_route, key_created_at, ["example.com"]
+    )
+    operation = cdn_route.create_renewal_operation()
+    clean_db.add(operation)
+    clean_db.commit()
+    operation_id = operation.id
+
+    letsencrypt.create_private_key_and_csr(operation_id, cdn_route.route_type)
+    clean_db.expunge_all()
+
+    old_certificate = clean_db.query(CdnCertificate).get(old_certificate.id)
+    certificate = clean_db.query(CdnOperation).get(operation_id).certificate
+    assert certificate.private_key_pem == old_certificate.private_key_pem
+    assert certificate.csr_pem != old_certificate.csr_pem
+
+
+def test_create_private_key_replaces_old_key(
+    clean_db, cdn_route: CdnRoute, immediate_huey, monkeypatch
+):
+    monkeypatch.setattr(config, "CERTIFICATE_REUSE_KEY", True)
+    monkeypatch.setattr(config, "CERTIFICATE_MAX_KEY_AGE_DAYS", 30)
+    key_created_at = datetime.now(timezone.utc) - timedelta(days=60)
+    old_certificate = make_cert_with_key(
+        clean_db, cdn_route, key_created_at, ["example.com", "www.example.com"]
+    )
+    operation = cdn_route.create_renewal_operation()
+    clean_db.add(operation)
+    clean_db.commit()
+    operation_id = operation.id
+
+    letsencrypt.create_private_key_and_csr(operation_id, cdn_route.route_type)
+    clean_db.expunge_all()
+
+    old_certificate = clean_db.query(CdnCertificate).get(old_certificate.id)
+    certificate = clean_db.query(CdnOperation).get(operation_id).certificate
+    assert certificate.private_key_pem != old_certificate.private_key_pem
+    assert certificate.private_key_created_at > key_created_at
+
+
 def test_gets_new_challenges(clean_db, cdn_route: CdnRoute, immediate_huey):
 
     instance_id = cdn_route.instance_id
@@ -72,6 +171,38 @@ def test_gets_new_challenges(clean_db, cdn_route: CdnRoute, immediate_huey):
         assert challenge.validation_path.startswith("/.well-known")
 
 
+def test_gets_challenges_marks_pre_authorized_domains_answered(
+    clean_db, cdn_route: CdnRoute, immediate_huey, monkeypatch
+):
+    operation = cdn_route.create_renewal_operation()
+    clean_db.add(cdn_route)
+    clean_db.add(operation)
+    clean_db.commit()
+    operation_id = operation.id
+    letsencrypt.create_user(operation.id, cdn_route.route_type)
+    letsencrypt.create_private_key_and_csr(operation.id, cdn_route.route_type)
+
+    # pebble doesn't reliably reuse authorizations, so have the CA tell us it
+    # still holds a valid one for www.example.com
+    authorization_for = letsencrypt.authorization_for
+
+    def valid_for_www(order, domain):
+        authorization = authorization_for(order, domain)
+        if domain != "www.example.com":
+            return authorization
+        body = authorization.body.update(status=messages.STATUS_VALID)
+        return authorization.update(body=body)
+
+    monkeypatch.setattr(letsencrypt, "authorization_for", valid_for_www)
+
+    letsencrypt.initiate_challenges(operation.id, cdn_route.route_type)
+    clean_db.expunge_all()
+
+    operation = clean_db.query(CdnOperation).get(operation_id)
+    answered = {c.domain: c.answered for c in operation.certificate.challenges}
+    assert answered == {"example.com": False, "www.example.com": True}
+
+
 def test_uploads_challenge_files(
     clean_db, cdn_route: CdnRoute, immediate_huey, s3_commercial
 ):
@@ -110,6 +241,285 @@ def test_uploads_challenge_files(
     s3.upload_challenge_files(operation.id, cdn_route.route_type)
 
 
+def test_upload_failure_does_not_stop_other_uploads(
+    clean_db, cdn_route: CdnRoute, immediate_huey, s3_commercial
+):
+    operation = cdn_route.create_renewal_operation()
+    certificate = CdnCertificate()
+    operation.certificate = certificate
+    for domain in ["www.example.gov", "example.gov"]:
+        challenge = CdnChallenge()
+        challenge.certificate = certificate
+        challenge.domain = domain
+        challenge.validation_path = f"/.well-known/acme-challenge/{domain}"
+        challenge.validation_contents = domain
+        clean_db.add(challenge)
+    clean_db.add_all([cdn_route, operation, certificate])
+    clean_db.commit()
+
+    s3_commercial.expect_put_object_error(
+        "fake-commercial-bucket",
+        ".well-known/acme-challenge/www.example.gov",
+        b"www.example.gov",
+        "AccessDenied",
+    )
+    s3_commercial.expect_put_object(
+        "fake-commercial-bucket",
+        ".well-known/acme-challenge/example.gov",
+        b"example.gov",
+    )
+
+    with pytest.raises(ClientError) as e:
+        s3.upload_challenge_files.call_local(operation.id, cdn_route.route_type)
+    assert e.value.response["Error"]["Code"] == "AccessDenied"
+
+
+def test_uploads_challenge_files_concurrently(
+    clean_db, cdn_route: CdnRoute, immediate_huey, s3_commercial, monkeypatch
+):
+    monkeypatch.setattr(config, "S3_MAX_CONCURRENT_UPLOADS", 2)
+    operation = cdn_route.create_renewal_operation()
+    certificate = CdnCertificate()
+    operation.certificate = certificate
+    for domain in ["www.example.gov", "example.gov"]:
+        challenge = CdnChallenge()
+        challenge.certificate = certificate
+        challenge.domain = domain
+        challenge.validation_path = f"/.well-known/acme-challenge/{domain}"
+        challenge.validation_contents = domain
+        clean_db.add(challenge)
+    clean_db.add_all([cdn_route, operation, certificate])
+    clean_db.commit()
+
+    # the uploads reach the stubber in either order, so we check what was
+    # uploaded ourselves
+    for _ in range(2):
+        s3_commercial.expect_put_object(
+            "fake-commercial-bucket", s3_commercial.ANY, s3_commercial.ANY
+        )
+    uploaded = {}
+    # each upload waits for the other, so this only gets through if they
+    # run at the same time
+    barrier = threading.Barrier(2, timeout=10)
+    put_object = s3.s3_commercial.put_object
+
+    def put_together(**kwargs):
+        barrier.wait()
+        uploaded[kwargs["Key"]] = kwargs["Body"]
+        return put_object(**kwargs)
+
+    monkeypatch.setattr(s3.s3_commercial, "put_object", put_together)
+
+    s3.upload_challenge_files(operation.id, cdn_route.route_type)
+
+    assert uploaded == {
+        ".well-known/acme-challenge/www.example.gov": b"www.example.gov",
+        ".well-known/acme-challenge/example.gov": b"example.gov",
+    }
+
+
+def test_waits_for_challenge_files_to_be_visible(
+    clean_db, cdn_route: CdnRoute, immediate_huey, s3_commercial, monkeypatch
+):
+    monkeypatch.setattr(config, "S3_PROPAGATION_TIME", 600)
+    monkeypatch.setattr(config, "S3_PROBE_INITIAL_DELAY_SECONDS", 0)
+    operation = cdn_route.create_renewal_operation()
+    certificate = CdnCertificate()
+    operation.certificate = certificate
+    challenge = CdnChallenge()
+    challenge.certificate = certificate
+    challenge.domain = "example.gov"
+    challenge.validation_path = "/.well-known/acme-challenge/apexchallengegoeshere"
+    challenge.validation_contents = "thisistheapexchallenge"
+    clean_db.add_all([cdn_route, operation, certificate, challenge])
+    clean_db.commit()
+
+    key = ".well-known/acme-challenge/apexchallengegoeshere"
+    s3_commercial.expect_put_object(
+        "fake-commercial-bucket", key, b"thisistheapexchallenge"
+    )
+    s3_commercial.expect_head_object_missing("fake-commercial-bucket", key)
+    s3_commercial.expect_head_object("fake-commercial-bucket", key)
+
+    s3.upload_challenge_files(operation.id, cdn_route.route_type)
+
+
+def test_keeps_waiting_when_s3_will_not_say_if_a_file_exists(
+    s3_commercial, monkeypatch
+):
+    monkeypatch.setattr(config, "S3_PROPAGATION_TIME", 600)
+    monkeypatch.setattr(config, "S3_PROBE_INITIAL_DELAY_SECONDS", 0)
+    key = ".well-known/acme-challenge/apexchallengegoeshere"
+    s3_commercial.expect_head_object_forbidden("fake-commercial-bucket", key)
+    s3_commercial.expect_head_object("fake-commercial-bucket", key)
+
+    assert s3.wait_for_challenge_files(
+        s3.s3_commercial, "fake-commercial-bucket", [key]
+    )
+
+
+def test_gives_up_waiting_when_s3_never_says_if_a_file_exists(
+    s3_commercial, monkeypatch
+):
+    monkeypatch.setattr(config, "S3_PROPAGATION_TIME", 1)
+    monkeypatch.setattr(config, "S3_PROBE_INITIAL_DELAY_SECONDS", 2)
+    key = ".well-known/acme-challenge/apexchallengegoeshere"
+    # one probe, a wait until the deadline, and one last probe
+    s3_commercial.expect_head_object_forbidden("fake-commercial-bucket", key)
+    s3_commercial.expect_head_object_forbidden("fake-commercial-bucket", key)
+
+    assert not s3.wait_for_challenge_files(
+        s3.s3_commercial, "fake-commercial-bucket", [key]
+    )
+
+
+def test_skips_upload_when_all_domains_are_pre_authorized(
+    clean_db, cdn_route: CdnRoute, immediate_huey, s3_commercial, monkeypatch
+):
+    s3_calls = []
+
+    def record(method):
+        return lambda **kwargs: s3_calls.append((method, kwargs["Key"]))
+
+    monkeypatch.setattr(s3.s3_commercial, "put_object", record("put_object"))
+    monkeypatch.setattr(s3.s3_commercial, "head_object", record("head_object"))
+    operation = cdn_route.create_renewal_operation()
+    certificate = CdnCertificate()
+    operation.certificate = certificate
+    challenge = CdnChallenge()
+    challenge.certificate = certificate
+    challenge.domain = "example.gov"
+    challenge.validation_path = "/.well-known/acme-challenge/apexchallengegoeshere"
+    challenge.validation_contents = "thisistheapexchallenge"
+    challenge.answered = True
+    clean_db.add_all([cdn_route, operation, certificate, challenge])
+    clean_db.commit()
+
+    s3.upload_challenge_files(operation.id, cdn_route.route_type)
+
+    assert s3_calls == []
+
+
+def add_answered_challenges(clean_db, cdn_route: CdnRoute, uploaded):
+    """uploaded maps each domain to whether we uploaded its challenge file"""
+    operation = cdn_route.create_renewal_operation()
+    certificate = CdnCertificate()
+    operation.certificate = certificate
+    for domain, was_uploaded in uploaded.items():
+        challenge = CdnChallenge()
+        challenge.certificate = certificate
+        challenge.domain = domain
+        challenge.validation_path = f"/.well-known/acme-challenge/{domain}"
+        challenge.validation_contents = domain
+        challenge.answered = True
+        challenge.uploaded = was_uploaded
+        clean_db.add(challenge)
+    clean_db.add_all([cdn_route, operation, certificate])
+    clean_db.commit()
+    return operation
+
+
+def test_uploads_mark_challenges_uploaded(
+    clean_db, cdn_route: CdnRoute, immediate_huey, s3_commercial
+):
+    operation = cdn_route.create_renewal_operation()
+    certificate = CdnCertificate()
+    operation.certificate = certificate
+    challenge = CdnChallenge()
+    challenge.certificate = certificate
+    challenge.domain = "example.gov"
+    challenge.validation_path = "/.well-known/acme-challenge/example.gov"
+    challenge.validation_contents = "example.gov"
+    clean_db.add_all([cdn_route, operation, certificate, challenge])
+    clean_db.commit()
+
+    s3_commercial.expect_put_object(
+        "fake-commercial-bucket",
+        ".well-known/acme-challenge/example.gov",
+        b"example.gov",
+    )
+
+    s3.upload_challenge_files(operation.id, cdn_route.route_type)
+
+    clean_db.expunge_all()
+    assert clean_db.query(CdnChallenge).one().uploaded
+
+
+def test_deletes_only_uploaded_challenge_files(
+    clean_db, cdn_route: CdnRoute, immediate_huey, s3_commercial, caplog
+):
+    # example.gov was pre-authorized, so there's no file for it
+    operation = add_answered_challenges(
+        clean_db, cdn_route, {"www.example.gov": True, "example.gov": False}
+    )
+
+    s3_commercial.expect_delete_objects(
+        "fake-commercial-bucket", [".well-known/acme-challenge/www.example.gov"]
+    )
+
+    with caplog.at_level(logging.INFO, logger="renewer.tasks.s3"):
+        s3.delete_challenge_files(operation.id, cdn_route.route_type)
+
+    deleted = [r for r in caplog.records if "deleted challenge files" in r.msg]
+    assert '"objects": 1' in deleted[0].msg
+    assert f'"bytes": {len("www.example.gov")}' in deleted[0].msg
+
+
+def test_failing_to_delete_challenge_files_does_not_fail_the_operation(
+    clean_db, cdn_route: CdnRoute, immediate_huey, s3_commercial
+):
+    operation = add_answered_challenges(clean_db, cdn_route, {"example.gov": True})
+    operation.state = OperationState.SUCCEEDED.value
+    clean_db.commit()
+
+    s3_commercial.expect_delete_objects_error(
+        "fake-commercial-bucket",
+        [".well-known/acme-challenge/example.gov"],
+        "AccessDenied",
+    )
+
+    s3.delete_challenge_files(operation.id, cdn_route.route_type)
+
+    clean_db.expunge_all()
+    operation = clean_db.query(CdnOperation).get(operation.id)
+    assert operation.state == OperationState.SUCCEEDED.value
+
+
+def test_sweeps_old_challenge_files(s3_commercial):
+    now = datetime.now(timezone.utc)
+    s3_commercial.expect_list_objects(
+        "fake-commercial-bucket",
+        ".well-known/acme-challenge/",
+        [
+            (".well-known/acme-challenge/old", now - timedelta(days=2), 10),
+            (".well-known/acme-challenge/stuck", now - timedelta(days=2), 20),
+            (".well-known/acme-challenge/new", now - timedelta(minutes=5), 30),
+        ],
+    )
+    s3_commercial.expect_delete_objects(
+        "fake-commercial-bucket",
+        [".well-known/acme-challenge/old", ".well-known/acme-challenge/stuck"],
+        failed_keys=[".well-known/acme-challenge/stuck"],
+    )
+
+    objects, size = s3.sweep_challenge_files(s3.s3_commercial, config.COMMERCIAL_BUCKET)
+
+    assert (objects, size) == (1, 10)
+
+
+def test_a_bucket_we_cannot_list_does_not_stop_the_sweep(s3_commercial, s3_govcloud):
+    s3_commercial.expect_list_objects_error(
+        "fake-commercial-bucket", ".well-known/acme-challenge/", "AccessDenied"
+    )
+    s3_govcloud.expect_list_objects(
+        "fake-govcloud-bucket", ".well-known/acme-challenge/", []
+    )
+
+    s3.sweep_all_challenge_files.call_local()
+
+    s3_govcloud.assert_no_pending_responses()
+
+
 def test_answer_challenges(clean_db, cdn_route: CdnRoute, immediate_huey):
     # this tests that we call answer challenges correctly.
     # We have pebble set to not validate challenges, though, because
@@ -151,7 +561,8 @@ def test_retrieve_certificate(clean_db, cdn_route: CdnRoute, immediate_huey):
     letsencrypt.initiate_challenges(operation_id, cdn_route.route_type)
     letsencrypt.answer_challenges(operation_id, cdn_route.route_type)
 
-    letsencrypt.retrieve_certificate(operation_id, cdn_route.route_type)
+    run_until_done(letsencrypt.finalize_order, operation_id, cdn_route.route_type)
+    run_until_done(letsencrypt.retrieve_certificate, operation_id, cdn_route.route_type)
     clean_db.expunge_all()
 
     operation = clean_db.query(CdnOperation).get(operation_id)
@@ -160,6 +571,35 @@ def test_retrieve_certificate(clean_db, cdn_route: CdnRoute, immediate_huey):
     assert certificate.leaf_pem.count("BEGIN CERTIFICATE") == 1
     assert certificate.expires is not None
     assert json.loads(certificate.order_json)["body"]["status"] == "valid"
+    # pebble offers ACME Renewal Information, so we should have its window
+    assert certificate.renewal_window_start is not None
+    assert certificate.renewal_window_end > certificate.renewal_window_start
+    assert certificate.renewal_info_retry_after is not None
+    assert operation.route.renew_after == certificate.renew_after
+
+
+def test_retrieve_ecdsa_certificate(
+    clean_db, cdn_route: CdnRoute, immediate_huey, monkeypatch
+):
+    monkeypatch.setattr(config, "CDN_CERTIFICATE_KEY_TYPE", "ecdsa")
+    operation = cdn_route.create_renewal_operation()
+    clean_db.add(cdn_route)
+    clean_db.add(operation)
+    clean_db.commit()
+    operation_id = operation.id
+    letsencrypt.create_user(operation_id, cdn_route.route_type)
+    letsencrypt.create_private_key_and_csr(operation_id, cdn_route.route_type)
+    letsencrypt.initiate_challenges(operation_id, cdn_route.route_type)
+    letsencrypt.answer_challenges(operation_id, cdn_route.route_type)
+
+    run_until_done(letsencrypt.finalize_order, operation_id, cdn_route.route_type)
+    run_until_done(letsencrypt.retrieve_certificate, operation_id, cdn_route.route_type)
+    clean_db.expunge_all()
+
+    certificate = clean_db.query(CdnOperation).get(operation_id).certificate
+    leaf = x509.load_pem_x509_certificate(certificate.leaf_pem.encode())
+    assert isinstance(leaf.public_key(), ec.EllipticCurvePublicKey)
+    assert isinstance(leaf.public_key().curve, ec.SECP256R1)
 
 
 def test_upload_cert_to_iam(
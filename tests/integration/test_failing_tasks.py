@@ -67,3 +67,27 @@ def test_retry_tasks_marked_failed_only_after_last_retry(
     operation_with_retries = clean_db.query(Operation).get("6789")
     assert operation_with_retries.state == "failed"
     assert not retry_marked_failed
+
+
+@pytest.mark.parametrize(
+    "Operation,Route", [(CdnOperation, CdnRoute), (DomainOperation, DomainRoute)]
+)
+def test_cleanup_failing_does_not_fail_a_completed_operation(
+    tasks, clean_db, immediate_huey, Operation, Route
+):
+    @huey.task(name=f"failing_cleanup_task{Operation}")
+    def failing_cleanup_task(operation_id, route_type):
+        raise Exception()
+
+    route = Route(instance_id="asdf", state="provisioned")
+    completed_operation = Operation(
+        id="5432", state="succeeded", action="Renew", route=route
+    )
+    clean_db.add(completed_operation)
+    clean_db.add(route)
+    clean_db.commit()
+    with fallible_huey():
+        immediate_huey.enqueue(failing_cleanup_task.s("5432", route.route_type))
+    clean_db.expunge_all()
+    completed_operation = clean_db.query(Operation).get("5432")
+    assert completed_operation.state == "succeeded"
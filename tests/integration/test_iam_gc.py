@@ -0,0 +1,202 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from renewer.aws import iam_commercial as real_iam_c
+from renewer.aws import iam_govcloud as real_iam_g
+from renewer.extensions import config
+from renewer.huey import iam_inventory
+from renewer.models.common import RouteType
+from renewer.models.domain import DomainCertificate, DomainRoute
+from renewer.tasks import iam_gc
+
+from tests.lib.alb_fixtures import make_route
+from tests.lib.fake_alb import FakeALB
+from tests.lib.fake_cloudfront import FakeCloudFront
+from tests.lib.fake_iam import FakeIAM
+
+
+def test_finds_and_deletes_orphaned_certificates(
+    clean_db, clean_huey, alb_route: DomainRoute, alb: FakeALB, iam_govcloud: FakeIAM
+):
+    prefix = config.GOVCLOUD_IAM_PREFIX
+    certificate = DomainCertificate()
+    certificate.route = alb_route
+    certificate.iam_server_certificate_name = "in-database"
+    clean_db.add(certificate)
+    clean_db.commit()
+
+    old = datetime.now(timezone.utc) - timedelta(days=30)
+    iam_govcloud.expect_list_server_certificates(
+        prefix, ["orphan", "in-database", "on-listener"], upload_date=old
+    )
+    alb.expect_listener_certificates(
+        "arn:aws:listener:1234",
+        [f"arn:aws:iam::000000000000:server-certificate{prefix}on-listener"],
+    )
+
+    assert iam_gc.find_orphaned_certificates(RouteType.ALB) == ["orphan"]
+
+    # the listener is checked again right before the delete
+    alb.expect_listener_certificates("arn:aws:listener:1234", [])
+    iam_govcloud.expects_delete_server_certificate("orphan")
+    iam_gc.delete_orphaned_certificate.call_local(RouteType.ALB, "orphan")
+
+    assert iam_inventory.get(RouteType.ALB, "orphan") is None
+    assert iam_inventory.get(RouteType.ALB, "on-listener") is not None
+
+
+def test_leaves_new_certificates_alone(
+    clean_db, clean_huey, alb_route: DomainRoute, alb: FakeALB, iam_govcloud: FakeIAM
+):
+    iam_govcloud.expect_list_server_certificates(
+        config.GOVCLOUD_IAM_PREFIX, ["just-uploaded"]
+    )
+    alb.expect_listener_certificates("arn:aws:listener:1234", [])
+
+    assert iam_gc.find_orphaned_certificates(RouteType.ALB) == []
+
+
+def certificate_named(name, route, expires):
+    certificate = DomainCertificate()
+    certificate.route = route
+    certificate.iam_server_certificate_name = name
+    certificate.expires = expires
+    return certificate
+
+
+def test_only_current_and_in_flight_certificates_are_referenced(
+    clean_db, proxy, alb_route: DomainRoute
+):
+    now = datetime.now(timezone.utc)
+    current = certificate_named("current", alb_route, now + timedelta(days=60))
+    superseded = certificate_named("superseded", alb_route, now + timedelta(days=5))
+    gone = make_route(clean_db, proxy, "gone", ["gone.example.com"], "deprovisioned")
+    deprovisioned = certificate_named("deprovisioned", gone, now + timedelta(days=60))
+    # a renewal in progress hasn't attached its certificate to the route yet
+    in_flight = certificate_named("in-flight", None, None)
+    operation = alb_route.create_renewal_operation()
+    operation.certificate = in_flight
+    clean_db.add_all([current, superseded, deprovisioned, in_flight, operation])
+    clean_db.commit()
+
+    assert iam_gc.referenced_certificates(RouteType.ALB) == {"current", "in-flight"}
+
+
+def test_finds_certificates_served_by_cloudfront(
+    clean_db, clean_huey, cloudfront: FakeCloudFront, iam_commercial: FakeIAM
+):
+    old = datetime.now(timezone.utc) - timedelta(days=30)
+    iam_commercial.expect_list_server_certificates(
+        config.COMMERCIAL_IAM_PREFIX, ["orphan", "on-distribution"], upload_date=old
+    )
+    # CloudFront refers to certificates by their id
+    cloudfront.expect_list_distributions({"distribution": "ASCAON-DISTRIBUTION"})
+
+    assert iam_gc.find_orphaned_certificates(RouteType.CDN) == ["orphan"]
+
+
+def test_served_certificates_for_cloudfront_are_certificate_ids(
+    cloudfront: FakeCloudFront,
+):
+    cloudfront.expect_list_distributions(
+        {"first": "ASCAFIRSTXXXXXXXX", "second": "ASCASECONDXXXXXXX"}
+    )
+
+    assert iam_gc.served_certificates(RouteType.CDN) == {
+        "ASCAFIRSTXXXXXXXX",
+        "ASCASECONDXXXXXXX",
+    }
+
+
+def test_does_not_delete_a_certificate_cloudfront_started_using(
+    clean_db, clean_huey, iam_commercial: FakeIAM
+):
+    old = datetime.now(timezone.utc) - timedelta(days=30)
+    iam_commercial.expect_list_server_certificates(
+        config.COMMERCIAL_IAM_PREFIX, ["in-cloudfront"], upload_date=old
+    )
+    iam_inventory.refresh(RouteType.CDN, real_iam_c, config.COMMERCIAL_IAM_PREFIX)
+    iam_commercial.expects_delete_server_certificate_returning_delete_conflict(
+        "in-cloudfront"
+    )
+
+    iam_gc.delete_orphaned_certificate.call_local(RouteType.CDN, "in-cloudfront")
+
+    assert iam_inventory.get(RouteType.CDN, "in-cloudfront") is not None
+
+
+def test_does_not_delete_a_certificate_a_listener_started_serving(
+    clean_db, clean_huey, alb_route: DomainRoute, alb: FakeALB, iam_govcloud: FakeIAM
+):
+    prefix = config.GOVCLOUD_IAM_PREFIX
+    old = datetime.now(timezone.utc) - timedelta(days=30)
+    iam_govcloud.expect_list_server_certificates(prefix, ["late"], upload_date=old)
+    iam_inventory.refresh(RouteType.ALB, real_iam_g, prefix)
+    alb.expect_listener_certificates(
+        "arn:aws:listener:1234",
+        [f"arn:aws:iam::000000000000:server-certificate{prefix}late"],
+    )
+
+    # no delete is expected, so the stubber fails the test if we try
+    iam_gc.delete_orphaned_certificate.call_local(RouteType.ALB, "late")
+
+    assert iam_inventory.get(RouteType.ALB, "late") is not None
+
+
+def test_does_not_delete_a_certificate_the_database_started_using(
+    clean_db, clean_huey, alb_route: DomainRoute, iam_govcloud: FakeIAM
+):
+    prefix = config.GOVCLOUD_IAM_PREFIX
+    old = datetime.now(timezone.utc) - timedelta(days=30)
+    iam_govcloud.expect_list_server_certificates(prefix, ["saved"], upload_date=old)
+    iam_inventory.refresh(RouteType.ALB, real_iam_g, prefix)
+    # a pipeline saved it after the scan
+    certificate = certificate_named(
+        "saved", alb_route, datetime.now(timezone.utc) + timedelta(days=90)
+    )
+    clean_db.add(certificate)
+    clean_db.commit()
+
+    iam_gc.delete_orphaned_certificate.call_local(RouteType.ALB, "saved")
+
+    assert iam_inventory.get(RouteType.ALB, "saved") is not None
+
+
+@pytest.fixture
+def scheduled_deletes(monkeypatch):
+    orphans = {
+        RouteType.ALB: ["alb-1", "alb-2", "alb-3"],
+        RouteType.CDN: ["cdn-1"],
+    }
+    monkeypatch.setattr(iam_gc, "find_orphaned_certificates", orphans.get)
+    scheduled = []
+
+    def schedule(args, delay):
+        scheduled.append((*args, delay))
+
+    monkeypatch.setattr(iam_gc.delete_orphaned_certificate, "schedule", schedule)
+    return scheduled
+
+
+def test_dry_run_only_reports_orphans(scheduled_deletes, monkeypatch):
+    monkeypatch.setattr(config, "IAM_GC_DRY_RUN", True)
+
+    iam_gc.collect_orphaned_certificates.call_local()
+
+    assert scheduled_deletes == []
+
+
+def test_deletes_are_spaced_out_and_capped(scheduled_deletes, monkeypatch):
+    monkeypatch.setattr(config, "IAM_GC_DRY_RUN", False)
+    monkeypatch.setattr(config, "IAM_GC_DELETES_PER_MINUTE", 30)
+    monkeypatch.setattr(config, "IAM_GC_MAX_DELETES_PER_RUN", 2)
+
+    iam_gc.collect_orphaned_certificates.call_local()
+
+    # the cap is per partition, and each partition's deletes start right away
+    assert sorted(scheduled_deletes) == [
+        (RouteType.ALB, "alb-1", 0),
+        (RouteType.ALB, "alb-2", 2),
+        (RouteType.CDN, "cdn-1", 0),
+    ]
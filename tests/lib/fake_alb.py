@@ -22,6 +22,13 @@ class FakeALB(FakeAWS):
             {"ListenerArn": listener_arn},
         )
 
+    def expect_listener_certificates(self, listener_arn, certificate_arns):
+        self.stubber.add_response(
+            "describe_listener_certificates",
+            {"Certificates": [{"CertificateArn": arn} for arn in certificate_arns]},
+            {"ListenerArn": listener_arn},
+        )
+
     def expect_add_certificate_to_listener(self, listener_arn, iam_cert_arn):
         self.stubber.add_response(
             "add_listener_certificates",
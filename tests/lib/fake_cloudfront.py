@@ -155,6 +155,59 @@ class FakeCloudFront(FakeAWS):
             "get_distribution", distribution, {"Id": distribution_id}
         )
 
+    def expect_list_distributions(self, certificate_ids: Dict[str, str]):
+        """certificate_ids maps distribution ids to their IAM certificate ids"""
+        summary_fields = [
+            "Aliases",
+            "Origins",
+            "OriginGroups",
+            "DefaultCacheBehavior",
+            "CacheBehaviors",
+            "CustomErrorResponses",
+            "Comment",
+            "PriceClass",
+            "Enabled",
+            "ViewerCertificate",
+            "IsIPV6Enabled",
+        ]
+        items = []
+        for distribution_id, certificate_id in certificate_ids.items():
+            config = self._distribution_config(
+                distribution_id,
+                [f"{distribution_id}.example.com"],
+                certificate_id,
+                "origin.example.com",
+                "",
+                custom_error_responses={"Quantity": 0},
+            )
+            summary = {field: config[field] for field in summary_fields}
+            summary.update(
+                {
+                    "Id": distribution_id,
+                    "ARN": f"arn:aws:cloudfront::000000000000:distribution/{distribution_id}",
+                    "Status": "Deployed",
+                    "LastModifiedTime": datetime.utcnow(),
+                    "DomainName": f"{distribution_id}.cloudfront.net",
+                    "Restrictions": {
+                        "GeoRestriction": {"RestrictionType": "none", "Quantity": 0}
+                    },
+                    "WebACLId": "",
+                    "HttpVersion": "http2",
+                    "Staging": False,
+                }
+            )
+            items.append(summary)
+        response = {
+            "DistributionList": {
+                "Marker": "",
+                "MaxItems": 100,
+                "IsTruncated": False,
+                "Quantity": len(items),
+                "Items": items,
+            }
+        }
+        self.stubber.add_response("list_distributions", response, {})
+
     def _distribution_config(
         self,
         caller_reference: str,
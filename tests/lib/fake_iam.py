@@ -63,6 +63,15 @@ class FakeIAM(FakeAWS):
             expected_params={"ServerCertificateName": name},
         )
 
+    def expects_delete_server_certificate_returning_delete_conflict(self, name: str):
+        self.stubber.add_client_error(
+            "delete_server_certificate",
+            service_error_code="DeleteConflict",
+            service_message="Certificate is in use by CloudFront.",
+            http_status_code=409,
+            expected_params={"ServerCertificateName": name},
+        )
+
     def expect_get_server_certificate(
         self, name: str, expiration: datetime, path: str = None
     ):
@@ -89,6 +98,31 @@ class FakeIAM(FakeAWS):
             "get_server_certificate", response, {"ServerCertificateName": name}
         )
 
+    def expect_list_server_certificates(
+        self, path_prefix: str, names, marker=None, upload_date=None
+    ):
+        now = datetime.now(timezone.utc)
+        if upload_date is None:
+            upload_date = now
+        request = {"PathPrefix": path_prefix}
+        if marker is not None:
+            request["Marker"] = marker
+        response = {
+            "ServerCertificateMetadataList": [
+                {
+                    "Path": path_prefix,
+                    "ServerCertificateName": name,
+                    "ServerCertificateId": f"ASCA{name.upper()}".ljust(16, "X"),
+                    "Arn": f"arn:aws:iam::000000000000:server-certificate{path_prefix}{name}",
+                    "UploadDate": upload_date,
+                    "Expiration": now + timedelta(days=90),
+                }
+                for name in names
+            ],
+            "IsTruncated": False,
+        }
+        self.stubber.add_response("list_server_certificates", response, request)
+
 
 @pytest.fixture(autouse=True)
 def iam_commercial():
@@ -18,6 +18,73 @@ class FakeS3(FakeAWS):
         response = {"ETag": "whatsanetag", "ServerSideEncryption": "AES256"}
         self.stubber.add_response("put_object", response, request)
 
+    def expect_put_object_error(self, bucket, key, object_body_bytes, code):
+        request = {
+            "Bucket": bucket,
+            "Key": key,
+            "Body": object_body_bytes,
+            "ServerSideEncryption": "AES256",
+        }
+        self.stubber.add_client_error(
+            "put_object", service_error_code=code, expected_params=request
+        )
+
+    def expect_head_object(self, bucket, key):
+        request = {"Bucket": bucket, "Key": key}
+        response = {"ContentLength": 0}
+        self.stubber.add_response("head_object", response, request)
+
+    def expect_head_object_missing(self, bucket, key):
+        request = {"Bucket": bucket, "Key": key}
+        self.stubber.add_client_error(
+            "head_object",
+            service_error_code="404",
+            http_status_code=404,
+            expected_params=request,
+        )
+
+    def expect_head_object_forbidden(self, bucket, key):
+        request = {"Bucket": bucket, "Key": key}
+        self.stubber.add_client_error(
+            "head_object",
+            service_error_code="403",
+            http_status_code=403,
+            expected_params=request,
+        )
+
+    def expect_delete_objects(self, bucket, keys, failed_keys=()):
+        request = {
+            "Bucket": bucket,
+            "Delete": {"Objects": [{"Key": key} for key in keys], "Quiet": True},
+        }
+        errors = [{"Key": key, "Code": "AccessDenied"} for key in failed_keys]
+        self.stubber.add_response("delete_objects", {"Errors": errors}, request)
+
+    def expect_delete_objects_error(self, bucket, keys, code):
+        request = {
+            "Bucket": bucket,
+            "Delete": {"Objects": [{"Key": key} for key in keys], "Quiet": True},
+        }
+        self.stubber.add_client_error(
+            "delete_objects", service_error_code=code, expected_params=request
+        )
+
+    def expect_list_objects_error(self, bucket, prefix, code):
+        request = {"Bucket": bucket, "Prefix": prefix}
+        self.stubber.add_client_error(
+            "list_objects_v2", service_error_code=code, expected_params=request
+        )
+
+    def expect_list_objects(self, bucket, prefix, objects):
+        """objects is a list of (key, last modified, size)"""
+        request = {"Bucket": bucket, "Prefix": prefix}
+        contents = [
+            {"Key": key, "LastModified": last_modified, "Size": size}
+            for key, last_modified, size in objects
+        ]
+        response = {"Contents": contents, "IsTruncated": False}
+        self.stubber.add_response("list_objects_v2", response, request)
+
 
 @pytest.fixture(autouse=True)
 def s3_commercial():
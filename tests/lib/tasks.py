@@ -1,10 +1,12 @@
 from contextlib import contextmanager
+import time
 
 import pytest
 from huey import Huey
 from huey import signals
+from huey.exceptions import RetryTask
 
-from renewer.huey import huey
+from renewer.huey import huey, redis_client
 
 
 @huey.signal(signals.SIGNAL_ERROR)
@@ -25,6 +27,8 @@ def clean_huey():
     # and make assertions about what tasks are enqueued
     try:
         huey.storage.flush_all()
+        for key in redis_client.scan_iter("renewer:*"):
+            redis_client.delete(key)
         yield huey
     finally:
         assert huey.pending_count() == 0
@@ -91,6 +95,19 @@ class Tasks:
             huey.execute(task, None)
 
 
+def run_until_done(task, *args, attempts=30):
+    """
+    Call a task that reschedules itself with RetryTask while it waits on
+    something, checking again until it finishes
+    """
+    for _ in range(attempts):
+        try:
+            return task.call_local(*args)
+        except RetryTask:
+            time.sleep(1)
+    pytest.fail(f"{task.name} didn't finish after {attempts} attempts")
+
+
 @pytest.fixture(scope="function")
 def tasks():
     return Tasks()
@@ -0,0 +1,163 @@
+from datetime import datetime, timedelta, timezone
+
+from acme import messages
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.x509.oid import NameOID
+import josepy
+import pytest
+
+from renewer.acme_client import (
+    AcmeClient,
+    AcmeClientPool,
+    new_network,
+    renewal_info_cert_id,
+)
+from renewer.crypto_pool import generate_private_key_pem
+from renewer.extensions import config
+
+
+class FakeUser:
+    def __init__(self, id_):
+        self.id = id_
+        self.uri = f"https://localhost:14000/my-account/{id_}"
+
+
+class FakeClient:
+    def __init__(self, user):
+        self.user = user
+        self.net = FakeNet()
+        self.directory = None
+
+
+class FakeNet:
+    def __init__(self):
+        self.gets = 0
+
+    def get(self, url):
+        self.gets += 1
+        return FakeResponse()
+
+
+class FakeResponse:
+    def json(self):
+        return {"newOrder": "https://localhost:14000/order-plz"}
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = AcmeClientPool()
+    monkeypatch.setattr(pool, "new_client", FakeClient)
+    return pool
+
+
+def test_clients_are_reused_per_account(pool):
+    with pool.client_for(FakeUser(1)) as first:
+        pass
+    with pool.client_for(FakeUser(1)) as second:
+        pass
+    with pool.client_for(FakeUser(2)) as other:
+        pass
+
+    assert first is second
+    assert other is not first
+
+
+def test_clients_are_checked_out_one_at_a_time(pool):
+    with pool.client_for(FakeUser(1)) as first:
+        with pool.client_for(FakeUser(1)) as second:
+            assert first is not second
+
+
+def test_client_is_discarded_when_task_raises(pool):
+    with pytest.raises(RuntimeError):
+        with pool.client_for(FakeUser(1)) as first:
+            raise RuntimeError("boom")
+    with pool.client_for(FakeUser(1)) as second:
+        pass
+
+    assert first is not second
+
+
+def test_directory_is_cached_until_ttl(monkeypatch):
+    monkeypatch.setattr(config, "ACME_DIRECTORY_TTL_SECONDS", 60)
+    pool = AcmeClientPool()
+    net = FakeNet()
+
+    pool.get_directory(net)
+    pool.get_directory(net)
+    assert net.gets == 1
+
+    pool.directory_fetched_at -= 61
+    pool.get_directory(net)
+    assert net.gets == 2
+
+
+@pytest.mark.parametrize(
+    "key_type,alg", [("rsa", josepy.RS256), ("ecdsa", josepy.ES256)]
+)
+def test_network_signs_with_the_account_key_type(key_type, alg):
+    net = new_network(generate_private_key_pem(key_type))
+
+    assert net.alg == alg
+    assert net.key.public_key() is not None
+
+
+def test_renewal_info_without_ari_support():
+    directory = messages.Directory.from_json(FakeResponse().json())
+    client_acme = AcmeClient(directory, net=FakeNet())
+
+    renewal_info, retry_after = client_acme.renewal_info("not used")
+
+    assert renewal_info is None
+    assert client_acme.net.gets == 0
+    expected = datetime.now(timezone.utc) + timedelta(
+        seconds=config.ACME_RENEWAL_INFO_RETRY_SECONDS
+    )
+    assert abs(retry_after - expected) < timedelta(minutes=1)
+
+
+def test_renewal_info_cert_id():
+    # the example from RFC 9773, section 4.1
+    key = serialization.load_pem_private_key(
+        generate_private_key_pem("ecdsa").encode(), password=None
+    )
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "example.com")])
+    aki = bytes.fromhex("69885B6B87464041E1B37B847BA0AE2CDE01C8D4")
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(0x87654321)
+        .not_valid_before(datetime(2025, 1, 1))
+        .not_valid_after(datetime(2025, 4, 1))
+        .add_extension(x509.AuthorityKeyIdentifier(aki, None, None), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+
+    assert renewal_info_cert_id(cert) == "aYhba4dGQEHhs3uEe6CuLN4ByNQ.AIdlQyE"
+
+
+def test_renewal_info_cert_id_needs_a_key_identifier():
+    key = serialization.load_pem_private_key(
+        generate_private_key_pem("ecdsa").encode(), password=None
+    )
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "example.com")])
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(0x87654321)
+        .not_valid_before(datetime(2025, 1, 1))
+        .not_valid_after(datetime(2025, 4, 1))
+    )
+    without_aki = builder.sign(key, hashes.SHA256())
+    issuer_only = builder.add_extension(
+        x509.AuthorityKeyIdentifier(None, [x509.DirectoryName(name)], 1),
+        critical=False,
+    ).sign(key, hashes.SHA256())
+
+    assert renewal_info_cert_id(without_aki) is None
+    assert renewal_info_cert_id(issuer_only) is None
@@ -16,6 +16,12 @@ from renewer.models.domain import (
 from renewer import extensions
 
 
+def renewal_candidate_ids(session):
+    """every id the renewal scan would find, across its chunks"""
+    chunks = DomainRoute.iter_renewal_candidate_ids(session, 2)
+    return [route_id for chunk in chunks for route_id in chunk]
+
+
 def test_can_get_session():
     with db.SessionHandler() as session:
         result = session.execute(
@@ -122,90 +128,51 @@ def test_need_renewal_basic(clean_db):
     assert not doesnt_need_renewal_route.needs_renewal
 
 
-def test_backport_from_manual_renewal(clean_db, alb, iam_govcloud):
-    # make a route
-    proxy = DomainAlbProxy()
-    proxy.alb_arn = "arn:aws:alb:123"
-    proxy.alb_dns_name = "example.com"
-    proxy.listener_arn = "arn:aws:listener:123"
-    route = DomainRoute()
-    route.state = "provisioned"
-    route.instance_id = "renew-me"
-    route.alb_proxy_arn = "arn:aws:alb:123"
-    old_cert = DomainCertificate()
-    old_cert.route = route
-    old_cert.expires = datetime(year=2021, month=2, day=1, hour=0, minute=0, second=0)
-    old_cert.arn = "arn:aws:iam:1234:server-certificate/domains/local/cf-domains-renew-me-2021-01-01_12-34-56"
-    clean_db.add(proxy)
-    clean_db.add(route)
-    clean_db.add(old_cert)
-    clean_db.commit()
+def test_find_renewal_candidates(clean_db):
+    def make_route(instance_id, state="provisioned", expirations=()):
+        route = DomainRoute()
+        route.state = state
+        route.instance_id = instance_id
+        clean_db.add(route)
+        for expires in expirations:
+            cert = DomainCertificate()
+            cert.route = route
+            cert.expires = expires
+            clean_db.add(cert)
+        return route
 
-    # get the certs for the alb
-    alb.expect_get_certificates_for_listener(
-        "arn:aws:listener:123",
-        7,
-        "arn:aws:iam:1234:server-certificate/domains/local/cf-domains-renew-me-2021-03-12_12-34-12",
+    now = datetime.now()
+    renew_me = make_route(
+        "renew-me", expirations=[now + timedelta(days=10), now - timedelta(days=10)]
     )
-    iam_govcloud.expect_get_server_certificate(
-        "cf-domains-renew-me-2021-03-12_12-34-12",
-        datetime.strptime("2021-03-12T12:34:12Z", "%Y-%m-%dT%H:%M:%SZ"),
+    dont_renew_me = make_route(
+        "dont-renew-me",
+        expirations=[now + timedelta(days=31), now - timedelta(days=31)],
     )
-
-    cert = route.backport_manual_certs()
-    clean_db.add(cert)
+    no_certificates = make_route("no-certificates")
+    make_route("inactive", "deprovisioned", [now + timedelta(days=10)])
     clean_db.commit()
 
-    clean_db.expunge_all()
-    route = clean_db.query(DomainRoute).filter_by(instance_id="renew-me").first()
-    cert = route.certificates[0]
-    assert (
-        cert.iam_server_certificate_arn
-        == "arn:aws:iam:1234:server-certificate/domains/local/cf-domains-renew-me-2021-03-12_12-34-12"
+    assert DomainRoute.has_renewal_candidates(clean_db)
+    candidates = renewal_candidate_ids(clean_db)
+    assert sorted(candidates) == sorted(
+        [renew_me.instance_id, no_certificates.instance_id]
     )
-    assert cert.expires is not None
-    assert cert.iam_server_certificate_name == "cf-domains-renew-me-2021-03-12_12-34-12"
+    assert dont_renew_me.instance_id not in candidates
 
 
-def test_backport_from_manual_renewal_ignores_existing(clean_db, alb, iam_govcloud):
-    # make a route
-    proxy = DomainAlbProxy()
-    proxy.alb_arn = "arn:aws:alb:123"
-    proxy.alb_dns_name = "example.com"
-    proxy.listener_arn = "arn:aws:listener:123"
+def test_has_renewal_candidates_when_nothing_is_due(clean_db):
     route = DomainRoute()
     route.state = "provisioned"
-    route.instance_id = "renew-me"
-    route.alb_proxy_arn = "arn:aws:alb:123"
-    old_cert = DomainCertificate()
-    old_cert.route = route
-    old_cert.expires = datetime(year=2021, month=2, day=1, hour=0, minute=0, second=0)
-    old_cert.iam_server_certificate_arn = "arn:aws:iam:1234:server-certificate/domains/local/cf-domains-renew-me-2021-01-01_12-34-56"
-    old_cert.iam_server_certificate_name = "cf-domains-renew-me-2021-01-01_12-34-56"
-    clean_db.add(proxy)
-    clean_db.add(route)
-    clean_db.add(old_cert)
+    route.instance_id = "dont-renew-me"
+    cert = DomainCertificate()
+    cert.route = route
+    cert.expires = datetime.now() + timedelta(days=60)
+    clean_db.add_all([route, cert])
     clean_db.commit()
 
-    # get the certs for the alb
-    alb.expect_get_certificates_for_listener(
-        "arn:aws:listener:123",
-        7,
-        "arn:aws:iam:1234:server-certificate/domains/local/cf-domains-renew-me-2021-01-01_12-34-56",
-    )
-
-    cert = route.backport_manual_certs()
-    assert cert is None
-
-    clean_db.expunge_all()
-    route = clean_db.query(DomainRoute).filter_by(instance_id="renew-me").first()
-    cert = route.certificates[0]
-    assert (
-        cert.iam_server_certificate_arn
-        == "arn:aws:iam:1234:server-certificate/domains/local/cf-domains-renew-me-2021-01-01_12-34-56"
-    )
-    assert cert.expires is not None
-    assert cert.iam_server_certificate_name == "cf-domains-renew-me-2021-01-01_12-34-56"
+    assert not DomainRoute.has_renewal_candidates(clean_db)
+    assert renewal_candidate_ids(clean_db) == []
 
 
 def test_stores_acmeuser_private_key_pem_encrypted(clean_db):
@@ -297,3 +264,44 @@ def test_get_user(clean_db):
     clean_db.add_all(to_commit)
     clean_db.commit()
     assert DomainAcmeUserV2.get_user(clean_db) is None
+
+
+def test_renewal_candidates_are_scanned_in_chunks(clean_db):
+    now = datetime.now()
+    expected = []
+    for i in range(5):
+        route = DomainRoute()
+        route.state = "provisioned"
+        route.instance_id = f"renew-me-{i}"
+        cert = DomainCertificate()
+        cert.route = route
+        cert.expires = now + timedelta(days=10)
+        clean_db.add_all([route, cert])
+        expected.append(route.instance_id)
+    clean_db.commit()
+
+    chunks = list(DomainRoute.iter_renewal_candidate_ids(clean_db, 2))
+
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert [i for chunk in chunks for i in chunk] == sorted(expected)
+
+
+def test_create_renewal_operations_in_bulk(clean_db):
+    instance_ids = ["route-1", "route-2", "route-3"]
+    for instance_id in instance_ids:
+        route = DomainRoute()
+        route.instance_id = instance_id
+        route.state = "provisioned"
+        clean_db.add(route)
+    clean_db.commit()
+
+    rows = DomainRoute.create_renewal_operations(clean_db, instance_ids)
+
+    assert sorted(route_id for route_id, _ in rows) == instance_ids
+    clean_db.expunge_all()
+    for route_id, operation_id in rows:
+        operation = clean_db.query(DomainOperation).get(operation_id)
+        assert operation.route_guid == route_id
+        assert operation.state == "in progress"
+        assert operation.action == "renew"
+    assert DomainRoute.create_renewal_operations(clean_db, []) == []
@@ -1,4 +1,6 @@
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import time
 import uuid
 
 import pytest
@@ -10,6 +12,12 @@ from renewer.models.cdn import CdnRoute, CdnOperation, CdnAcmeUserV2, CdnCertifi
 from renewer import extensions
 
 
+def renewal_candidate_ids(session):
+    """every id the renewal scan would find, across its chunks"""
+    chunks = CdnRoute.iter_renewal_candidate_ids(session, 2)
+    return [route_id for chunk in chunks for route_id in chunk]
+
+
 def test_can_get_session():
     with db.SessionHandler() as session:
         result = session.execute(
@@ -148,6 +156,51 @@ def test_need_renewal_basic(clean_db):
     assert not doesnt_need_renewal_route.needs_renewal
 
 
+def test_find_renewal_candidates(clean_db):
+    def make_route(instance_id, state="provisioned", expirations=()):
+        route = CdnRoute()
+        route.state = state
+        route.instance_id = instance_id
+        clean_db.add(route)
+        for expires in expirations:
+            cert = CdnCertificate()
+            cert.route = route
+            cert.expires = expires
+            clean_db.add(cert)
+        return route
+
+    now = datetime.now()
+    renew_me = make_route(
+        "renew-me", expirations=[now + timedelta(days=10), now - timedelta(days=10)]
+    )
+    dont_renew_me = make_route(
+        "dont-renew-me",
+        expirations=[now + timedelta(days=31), now - timedelta(days=31)],
+    )
+    no_certificates = make_route("no-certificates")
+    make_route("inactive", "deprovisioned", [now + timedelta(days=10)])
+    clean_db.commit()
+
+    assert CdnRoute.has_renewal_candidates(clean_db)
+    candidates = renewal_candidate_ids(clean_db)
+    assert sorted(candidates) == sorted([renew_me.id, no_certificates.id])
+    assert dont_renew_me.id not in candidates
+
+
+def test_has_renewal_candidates_when_nothing_is_due(clean_db):
+    route = CdnRoute()
+    route.state = "provisioned"
+    route.instance_id = "dont-renew-me"
+    cert = CdnCertificate()
+    cert.route = route
+    cert.expires = datetime.now() + timedelta(days=60)
+    clean_db.add_all([route, cert])
+    clean_db.commit()
+
+    assert not CdnRoute.has_renewal_candidates(clean_db)
+    assert renewal_candidate_ids(clean_db) == []
+
+
 def test_get_user(clean_db):
     """
     setup:
@@ -207,3 +260,216 @@ def test_get_user(clean_db):
     clean_db.add_all(to_commit)
     clean_db.commit()
     assert CdnAcmeUserV2.get_user(clean_db) is None
+
+
+def test_get_user_skips_accounts_locked_by_other_workers(clean_db):
+    users = []
+    for _ in range(2):
+        user = CdnAcmeUserV2()
+        user.email = "me@example.com"
+        user.uri = "uri"
+        users.append(user)
+    clean_db.add_all(users)
+    clean_db.commit()
+
+    other_worker = db.Session()
+    try:
+        # another worker is partway through assigning a route to the first user
+        assert CdnAcmeUserV2.get_user(other_worker).id == users[0].id
+
+        assert CdnAcmeUserV2.get_user(clean_db).id == users[1].id
+    finally:
+        other_worker.rollback()
+        other_worker.close()
+        clean_db.rollback()
+
+
+def test_get_user_waits_when_every_account_is_locked(clean_db):
+    user = CdnAcmeUserV2()
+    user.email = "me@example.com"
+    user.uri = "uri"
+    clean_db.add(user)
+    clean_db.commit()
+
+    other_worker = db.Session()
+    try:
+        assert CdnAcmeUserV2.get_user(other_worker).id == user.id
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            waiting = executor.submit(CdnAcmeUserV2.get_user, clean_db)
+            time.sleep(0.5)
+            # we don't register a new account just because this one is busy
+            assert not waiting.done()
+
+            # the other worker fills the account while we wait for it
+            for _ in range(extensions.config.MAX_ROUTES_PER_USER):
+                route = CdnRoute()
+                route.instance_id = str(uuid.uuid4())
+                route.state = "provisioned"
+                route.acme_user_id = user.id
+                other_worker.add(route)
+            other_worker.commit()
+
+            # so once we get the lock, we notice it's full
+            assert waiting.result(timeout=10) is None
+    finally:
+        other_worker.rollback()
+        other_worker.close()
+        clean_db.rollback()
+
+
+def test_get_user_lets_go_of_full_accounts(clean_db):
+    users = []
+    for _ in range(2):
+        user = CdnAcmeUserV2()
+        user.email = "me@example.com"
+        user.uri = "uri"
+        users.append(user)
+    clean_db.add_all(users)
+    clean_db.commit()
+    first, second = [user.id for user in users]
+
+    filling_worker = db.Session()
+    busy_worker = db.Session()
+    checking_worker = db.Session()
+    try:
+        assert CdnAcmeUserV2.get_user(filling_worker).id == first
+        assert CdnAcmeUserV2.get_user(busy_worker).id == second
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            waiting = executor.submit(CdnAcmeUserV2.get_user, clean_db)
+            time.sleep(0.5)
+
+            # the first account fills up while we wait for it
+            for _ in range(extensions.config.MAX_ROUTES_PER_USER):
+                route = CdnRoute()
+                route.instance_id = str(uuid.uuid4())
+                route.state = "provisioned"
+                route.acme_user_id = first
+                filling_worker.add(route)
+            filling_worker.commit()
+            time.sleep(0.5)
+
+            # we moved on to wait for the second account, and don't hold the
+            # first one meanwhile
+            assert not waiting.done()
+            locked = (
+                checking_worker.query(CdnAcmeUserV2)
+                .filter_by(id=first)
+                .with_for_update(nowait=True)
+                .one()
+            )
+            assert locked.id == first
+            checking_worker.rollback()
+
+            busy_worker.rollback()
+            assert waiting.result(timeout=10).id == second
+    finally:
+        for session in (filling_worker, busy_worker, checking_worker):
+            session.rollback()
+            session.close()
+        clean_db.rollback()
+
+
+def test_renewal_candidates_are_scanned_in_chunks(clean_db):
+    expected = []
+    for i in range(4):
+        route = CdnRoute()
+        route.instance_id = f"route-{i}"
+        route.state = "provisioned"
+        clean_db.add(route)
+        clean_db.commit()
+        expected.append(route.id)
+    inactive = CdnRoute()
+    inactive.instance_id = "inactive"
+    inactive.state = "deprovisioned"
+    clean_db.add(inactive)
+    clean_db.commit()
+
+    # none of the routes has a certificate, so the active ones all need one
+    chunks = list(CdnRoute.iter_renewal_candidate_ids(clean_db, 2))
+
+    assert [len(chunk) for chunk in chunks] == [2, 2]
+    assert [i for chunk in chunks for i in chunk] == sorted(expected)
+
+
+def test_renewal_candidates_use_renew_after(clean_db):
+    now = datetime.now(timezone.utc)
+
+    def make_route(instance_id, renew_after, expires):
+        route = CdnRoute()
+        route.instance_id = instance_id
+        route.state = "provisioned"
+        route.renew_after = renew_after
+        cert = CdnCertificate()
+        cert.route = route
+        cert.expires = expires
+        clean_db.add_all([route, cert])
+        clean_db.commit()
+        return route
+
+    due = make_route("due", now - timedelta(hours=1), now + timedelta(days=60))
+    not_due = make_route("not-due", now + timedelta(days=1), now + timedelta(days=10))
+    unknown = make_route("unknown", None, now + timedelta(days=10))
+
+    candidates = renewal_candidate_ids(clean_db)
+
+    assert sorted(candidates) == sorted([due.id, unknown.id])
+    assert not_due.id not in candidates
+
+
+def test_update_renew_after_only_moves_forward():
+    now = datetime.now(timezone.utc)
+    route = CdnRoute()
+    newer = CdnCertificate()
+    newer.expires = now + timedelta(days=90)
+    older = CdnCertificate()
+    older.expires = now + timedelta(days=10)
+
+    route.update_renew_after(newer)
+    route.update_renew_after(older)
+
+    assert route.renew_after == now + timedelta(days=60)
+
+
+def test_renew_after_follows_renewal_window():
+    now = datetime.now(timezone.utc)
+    start = now + timedelta(days=50)
+    end = now + timedelta(days=52)
+
+    def make_cert(id_):
+        cert = CdnCertificate()
+        cert.id = id_
+        cert.expires = now + timedelta(days=90)
+        cert.renewal_window_start = start
+        cert.renewal_window_end = end
+        return cert
+
+    first = make_cert(1)
+    renew_after = first.renew_after
+
+    assert start <= renew_after <= end
+    # stable between scans, but spread across certificates
+    assert first.renew_after == renew_after
+    assert len({make_cert(i).renew_after for i in range(10)}) > 1
+
+
+def test_renew_after_falls_back_without_renewal_window():
+    now = datetime.now(timezone.utc)
+    cert = CdnCertificate()
+    cert.expires = now + timedelta(days=90)
+
+    assert cert.renew_after == now + timedelta(days=60)
+
+
+def test_follow_renewal_info_can_move_renew_after_earlier():
+    now = datetime.now(timezone.utc)
+    route = CdnRoute()
+    route.renew_after = now + timedelta(days=60)
+    cert = CdnCertificate()
+    cert.id = 1
+    cert.expires = now + timedelta(days=90)
+    cert.renewal_window_start = now - timedelta(hours=2)
+    cert.renewal_window_end = now - timedelta(hours=1)
+
+    route.follow_renewal_info(cert)
+
+    assert route.renew_after <= now
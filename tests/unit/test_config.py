@@ -1,6 +1,7 @@
 import json
 import importlib
 
+from environs import EnvValidationError
 import pytest
 from renewer.config import config_from_env
 
@@ -197,6 +198,24 @@ def test_config_gets_credentials(env, monkeypatch, mocked_env):
     assert raised is None
 
 
+@pytest.mark.parametrize("minutes", ["0", "61"])
+def test_config_rejects_bad_iam_inventory_refresh_interval(
+    minutes, monkeypatch, mocked_env
+):
+    monkeypatch.setenv("ENV", "production")
+    monkeypatch.setenv("IAM_INVENTORY_REFRESH_MINUTES", minutes)
+    with pytest.raises(EnvValidationError):
+        config_from_env()
+
+
+def test_config_rejects_no_iam_gc_deletes(monkeypatch, mocked_env):
+    monkeypatch.setenv("ENV", "production")
+    # the deletes are spaced 60 / IAM_GC_DELETES_PER_MINUTE seconds apart
+    monkeypatch.setenv("IAM_GC_DELETES_PER_MINUTE", "0")
+    with pytest.raises(EnvValidationError):
+        config_from_env()
+
+
 def test_upgrade_config(monkeypatch, vcap_application, vcap_services):
     """
     this is a special test, because the upgrade config assumes we don't want
@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from renewer.dispatcher import RenewalDispatcher
+from renewer.extensions import config
+
+
+class FakeHuey:
+    def __init__(self, pending_counts, scheduled_count=0):
+        self.pending_counts = list(pending_counts)
+        self.scheduled = scheduled_count
+
+    def pending_count(self):
+        if len(self.pending_counts) > 1:
+            return self.pending_counts.pop(0)
+        return self.pending_counts[0]
+
+    def scheduled_count(self):
+        return self.scheduled
+
+
+def idle():
+    return 0
+
+
+@pytest.fixture
+def dispatch_config(monkeypatch):
+    monkeypatch.setattr(config, "RENEWAL_DISPATCH_RATE", 6)
+    monkeypatch.setattr(config, "RENEWAL_DISPATCH_WINDOW", 60)
+    monkeypatch.setattr(config, "RENEWAL_MAX_PENDING_TASKS", 10)
+    monkeypatch.setattr(config, "RENEWAL_MAX_IN_PROGRESS_OPERATIONS", 10)
+    monkeypatch.setattr(config, "RENEWAL_DISPATCH_PAUSE_SECONDS", 5)
+    monkeypatch.setattr(config, "RENEWAL_DISPATCH_MAX_PAUSE_SECONDS", 20)
+
+
+def test_delays_are_spread_over_slots(dispatch_config):
+    dispatcher = RenewalDispatcher(FakeHuey([0]))
+
+    delays = dispatcher.wait_for_capacity(4, idle)
+    delays += dispatcher.wait_for_capacity(2, idle)
+
+    # 6 per minute means one slot every 10 seconds
+    assert len(delays) == 6
+    for slot, delay in enumerate(delays):
+        assert slot * 10 <= delay < (slot + 1) * 10
+
+
+def test_capacity_is_limited_by_window(dispatch_config):
+    dispatcher = RenewalDispatcher(FakeHuey([0]))
+
+    assert len(dispatcher.wait_for_capacity(4, idle)) == 4
+    assert len(dispatcher.wait_for_capacity(4, idle)) == 2
+    assert dispatcher.wait_for_capacity(4, idle) == []
+
+
+def test_pauses_while_queue_is_full(dispatch_config):
+    sleeps = []
+    dispatcher = RenewalDispatcher(FakeHuey([50, 50, 0]), sleeps.append)
+
+    assert len(dispatcher.wait_for_capacity(3, idle)) == 3
+    assert sleeps == [5, 5]
+
+
+def test_scheduled_tasks_count_against_the_queue(dispatch_config):
+    sleeps = []
+    dispatcher = RenewalDispatcher(FakeHuey([5], scheduled_count=5), sleeps.append)
+
+    assert dispatcher.wait_for_capacity(3, idle) == []
+    assert sleeps == [5, 5, 5, 5]
+
+
+def test_gives_up_while_too_many_operations_are_in_progress(dispatch_config):
+    sleeps = []
+    dispatcher = RenewalDispatcher(FakeHuey([0]), sleeps.append)
+
+    assert dispatcher.wait_for_capacity(3, lambda: 50) == []
+    assert sleeps == [5, 5, 5, 5]
+
+
+def test_a_busy_broker_only_holds_back_its_own_scan(dispatch_config):
+    sleeps = []
+    dispatcher = RenewalDispatcher(FakeHuey([0]), sleeps.append)
+
+    assert dispatcher.wait_for_capacity(3, lambda: 50) == []
+    assert len(dispatcher.wait_for_capacity(3, idle)) == 3
+
+
+def test_slots_are_not_handed_out_twice_across_threads(dispatch_config):
+    dispatcher = RenewalDispatcher(FakeHuey([0]))
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        claimed = list(executor.map(lambda _: dispatcher.claim(1), range(10)))
+
+    delays = sorted(delay for delays in claimed for delay in delays)
+    assert len(delays) == 6
+    assert [int(delay // 10) for delay in delays] == list(range(6))
@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta, timezone
+import threading
+
+from renewer.aws import iam_govcloud as real_iam_g
+from renewer.extensions import config
+from renewer.huey import iam_inventory
+from renewer.models.common import RouteType
+
+from tests.lib.fake_iam import FakeIAM
+
+
+def test_lookups_use_the_inventory(clean_huey, iam_govcloud: FakeIAM):
+    iam_govcloud.expect_list_server_certificates(
+        config.GOVCLOUD_IAM_PREFIX, ["first", "second"]
+    )
+
+    count = iam_inventory.refresh(RouteType.ALB, real_iam_g, config.GOVCLOUD_IAM_PREFIX)
+
+    assert count == 2
+    # no get_server_certificate is expected, so these must come from Redis
+    metadata = iam_inventory.server_certificate_metadata(
+        RouteType.ALB, real_iam_g, "second"
+    )
+    assert metadata["ServerCertificateName"] == "second"
+    assert isinstance(metadata["Expiration"], datetime)
+    assert iam_inventory.get_by_arn(RouteType.ALB, metadata["Arn"]) == metadata
+    assert iam_inventory.get(RouteType.CDN, "second") is None
+
+
+def test_lookups_fall_back_to_iam(clean_huey, iam_govcloud: FakeIAM):
+    iam_govcloud.expect_list_server_certificates(config.GOVCLOUD_IAM_PREFIX, ["old"])
+    iam_inventory.refresh(RouteType.ALB, real_iam_g, config.GOVCLOUD_IAM_PREFIX)
+    expiration = datetime.now(timezone.utc) + timedelta(days=90)
+    iam_govcloud.expect_get_server_certificate("new", expiration)
+
+    metadata = iam_inventory.server_certificate_metadata(
+        RouteType.ALB, real_iam_g, "new"
+    )
+
+    assert metadata["Expiration"] == expiration
+    # and the inventory remembers it for next time
+    assert iam_inventory.get(RouteType.ALB, "new") is not None
+
+
+def test_removed_certificates_are_forgotten(clean_huey, iam_govcloud: FakeIAM):
+    iam_govcloud.expect_list_server_certificates(config.GOVCLOUD_IAM_PREFIX, ["gone"])
+    iam_inventory.refresh(RouteType.ALB, real_iam_g, config.GOVCLOUD_IAM_PREFIX)
+
+    iam_inventory.remove(RouteType.ALB, "gone")
+
+    assert iam_inventory.get(RouteType.ALB, "gone") is None
+
+
+class ListingWhileChanging:
+    """an IAM client that uploads and deletes certificates while it's listed"""
+
+    def __init__(self, iam, change):
+        self.iam = iam
+        self.change = change
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, **kwargs):
+        pages = list(
+            self.iam.get_paginator("list_server_certificates").paginate(**kwargs)
+        )
+        self.change()
+        return pages
+
+
+def test_changes_during_a_refresh_are_kept(clean_huey, iam_govcloud: FakeIAM):
+    iam_govcloud.expect_list_server_certificates(
+        config.GOVCLOUD_IAM_PREFIX, ["listed", "deleted"]
+    )
+    now = datetime.now(timezone.utc)
+    uploaded = {
+        "Path": config.GOVCLOUD_IAM_PREFIX,
+        "ServerCertificateName": "new",
+        "ServerCertificateId": "this-needs-to-be-sixteen-digits",
+        "Arn": "arn:aws:iam::000000000000:server-certificate/new",
+        "UploadDate": now,
+        "Expiration": now + timedelta(days=90),
+    }
+
+    def change():
+        iam_inventory.add(RouteType.ALB, uploaded)
+        iam_inventory.remove(RouteType.ALB, "deleted")
+
+    iam = ListingWhileChanging(real_iam_g, change)
+    count = iam_inventory.refresh(RouteType.ALB, iam, config.GOVCLOUD_IAM_PREFIX)
+
+    assert count == 2
+    assert set(iam_inventory.all(RouteType.ALB)) == {"listed", "new"}
+
+
+def test_overlapping_refreshes_take_turns(clean_huey, iam_govcloud: FakeIAM):
+    iam_govcloud.expect_list_server_certificates(config.GOVCLOUD_IAM_PREFIX, ["a"])
+    iam_govcloud.expect_list_server_certificates(config.GOVCLOUD_IAM_PREFIX, ["a", "b"])
+    counts = []
+
+    def refresh():
+        counts.append(
+            iam_inventory.refresh(RouteType.ALB, real_iam_g, config.GOVCLOUD_IAM_PREFIX)
+        )
+
+    # the second refresh starts while the first is listing
+    second = threading.Thread(target=refresh)
+    iam = ListingWhileChanging(real_iam_g, second.start)
+    counts.append(iam_inventory.refresh(RouteType.ALB, iam, config.GOVCLOUD_IAM_PREFIX))
+    second.join()
+
+    assert sorted(counts) == [1, 2]
+    assert set(iam_inventory.all(RouteType.ALB)) == {"a", "b"}
@@ -0,0 +1,46 @@
+from cryptography.hazmat.primitives import serialization
+
+from renewer.extensions import config
+from renewer.huey import key_pool, redis_client
+from renewer.models.common import RouteType
+
+
+def is_private_key(pem: str) -> bool:
+    return serialization.load_pem_private_key(pem.encode(), password=None) is not None
+
+
+def test_take_falls_back_to_generating_a_key(clean_huey):
+    assert key_pool.size(RouteType.ALB, "rsa") == 0
+
+    assert is_private_key(key_pool.take(RouteType.ALB, "rsa"))
+
+
+def test_refill_stops_at_pool_size(clean_huey, monkeypatch):
+    monkeypatch.setattr(config, "KEY_POOL_SIZE", 3)
+
+    assert key_pool.refill(RouteType.CDN, "rsa", 2) == 2
+    assert key_pool.refill(RouteType.CDN, "rsa", 2) == 1
+    assert key_pool.refill(RouteType.CDN, "rsa", 2) == 0
+    assert key_pool.size(RouteType.CDN, "rsa") == 3
+    assert key_pool.size(RouteType.ALB, "rsa") == 0
+
+
+def test_pooled_keys_are_encrypted(clean_huey, monkeypatch):
+    monkeypatch.setattr(config, "KEY_POOL_SIZE", 1)
+    key_pool.refill(RouteType.ALB, "rsa", 1)
+
+    (stored,) = redis_client.lrange(key_pool.key(RouteType.ALB, "rsa"), 0, -1)
+    assert b"PRIVATE KEY" not in stored
+
+    assert is_private_key(key_pool.take(RouteType.ALB, "rsa"))
+    assert key_pool.size(RouteType.ALB, "rsa") == 0
+
+
+def test_pools_are_kept_per_key_type(clean_huey, monkeypatch):
+    monkeypatch.setattr(config, "KEY_POOL_SIZE", 1)
+    key_pool.refill(RouteType.ALB, "ecdsa", 1)
+
+    assert key_pool.size(RouteType.ALB, "rsa") == 0
+    pem = key_pool.take(RouteType.ALB, "ecdsa")
+    assert is_private_key(pem)
+    assert key_pool.size(RouteType.ALB, "ecdsa") == 0